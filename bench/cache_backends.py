@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# bench.cache_backends
+# 
+# Compares the native sharded LRU cache backend with the simplecache
+# backends under a Zipfian key workload, where a miss stores the entry
+# the way the proxy does after fetching it from the origin.
+
+from optparse import OptionParser
+import bisect
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knit.lru import ShardedLRUCache
+
+
+def buildZipfTable(keys, exponent):
+    weights = [1.0 / ((rank + 1) ** exponent) for rank in xrange(keys)]
+    total = sum(weights)
+    table = []
+    cumulative = 0.0
+    for weight in weights:
+        cumulative += weight / total
+        table.append(cumulative)
+    return table
+
+
+def runWorkload(cache, table, operations, concurrency, size):
+    counts = {'hits': 0, 'misses': 0}
+    lock = threading.Lock()
+    perThread = operations / concurrency
+    value = ("x" * size, '200 OK', [('Content-Length', str(size))])
+    
+    def client():
+        rand = random.Random()
+        hits = misses = 0
+        for i in xrange(perThread):
+            key = "GET /objects/%s? " % bisect.bisect(table, rand.random())
+            if cache.get(key):
+                hits += 1
+            else:
+                misses += 1
+                cache.set(key, value, 300)
+        with lock:
+            counts['hits'] += hits
+            counts['misses'] += misses
+    
+    start = time.time()
+    threads = [threading.Thread(target = client) for i in xrange(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start, counts
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--operations", type="int", default=200000, help="Cache lookups per backend")
+    parser.add_option("-c", "--concurrency", type="int", default=8, help="Concurrent threads")
+    parser.add_option("--keys", type="int", default=100000, help="Distinct keys in the workload")
+    parser.add_option("--exponent", type="float", default=0.99, help="Zipf exponent of the key popularity")
+    parser.add_option("--size", type="int", default=4096, help="Entry body size in bytes")
+    parser.add_option("--maxbytes", type="int", default=67108864, help="Byte limit of the native backend")
+    parser.add_option("--shards", type="int", default=16, help="Shards in the native backend")
+    parser.add_option("--backends", default="MemoryCache", help="Comma separated simplecache backends to compare")
+    options, args = parser.parse_args()
+    
+    table = buildZipfTable(options.keys, options.exponent)
+    caches = [("ShardedLRUCache", ShardedLRUCache(maxbytes = options.maxbytes, shards = options.shards))]
+    for backend in options.backends.split(","):
+        try:
+            from knit.simplecache import Cache
+            caches.append((backend, Cache(backend)))
+        except Exception, e:
+            print "Skipping %s: %s" % (backend, e)
+    
+    print "%-16s %10s %8s %10s %10s" % ("backend", "ops/s", "hit %", "evictions", "MB held")
+    for name, cache in caches:
+        elapsed, counts = runWorkload(cache, table, options.operations, options.concurrency, options.size)
+        total = counts['hits'] + counts['misses']
+        stats = cache.getStats() if hasattr(cache, 'getStats') else {}
+        evictions = stats.get('evictions', '-')
+        held = "%.1f" % (stats['bytes'] / 1048576.0) if 'bytes' in stats else '-'
+        print "%-16s %10.1f %8.1f %10s %10s" % (name, total / elapsed, 100.0 * counts['hits'] / total, evictions, held)
+    
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# bench.cache_rules
+# 
+# Measures picking the cache rule for a request URL as the rule count
+# grows, comparing trying each pattern in turn with the compiled rule
+# set, both uncached and through its per-URL memo.
+
+from optparse import OptionParser
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knit.rules import CacheRule, CacheRuleSet
+
+
+BASE_URL = "http://127.0.0.1:8080"
+KEY_FORMAT = "%(REQUEST_METHOD)s %(PATH_INFO)s?%(QUERY_STRING)s"
+
+
+def buildRules(count, unprefixed):
+    rules = []
+    for i in xrange(count):
+        if i % 100 < unprefixed:
+            pattern = r"^.*/assets-%s/.*\.(js|css)$" % i
+        else:
+            pattern = r"^%s/section-%s/" % (re.escape(BASE_URL), i)
+        rules.append(CacheRule(pattern, KEY_FORMAT))
+    rules.append(CacheRule("^.*$", KEY_FORMAT))
+    return rules
+
+
+def buildURLs(count, unprefixed, requests, paths):
+    rand = random.Random(count)
+    urls = []
+    for i in xrange(paths):
+        rule = rand.randrange(count)
+        if rule % 100 < unprefixed:
+            urls.append("%s/static/assets-%s/app-%s.js" % (BASE_URL, rule, i))
+        else:
+            urls.append("%s/section-%s/page-%s" % (BASE_URL, rule, i))
+    return [rand.choice(urls) for i in xrange(requests)]
+
+
+def timeSequential(rules, urls):
+    start = time.time()
+    for url in urls:
+        for rule in rules:
+            if rule.pattern.match(url):
+                break
+    return time.time() - start
+
+
+def timeCompiled(ruleSet, urls):
+    start = time.time()
+    for url in urls:
+        ruleSet.match(url)
+    return time.time() - start
+
+
+def timeMemoized(ruleSet, urls):
+    start = time.time()
+    for url in urls:
+        if ruleSet.getMatch(url) is None:
+            ruleSet.match(url, url)
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--rules", default="10,100,1000,10000", help="Comma separated rule counts")
+    parser.add_option("-n", "--requests", type="int", default=20000, help="URLs matched per rule count")
+    parser.add_option("--paths", type="int", default=2000, help="Distinct URLs in the workload")
+    parser.add_option("--unprefixed", type="int", default=10, help="Percentage of rules without a literal URL prefix")
+    options, args = parser.parse_args()
+    
+    print "%8s %10s %14s %14s %14s" % ("rules", "compile s", "sequential us", "compiled us", "memoized us")
+    for count in [int(count) for count in options.rules.split(",")]:
+        rules = buildRules(count, options.unprefixed)
+        urls = buildURLs(count, options.unprefixed, options.requests, options.paths)
+        
+        start = time.time()
+        ruleSet = CacheRuleSet(rules)
+        compiled = time.time() - start
+        
+        # The compiled set has to agree with first-match-wins ordering
+        for url in urls[:1000]:
+            expected = [rule for rule in rules if rule.pattern.match(url)][0]
+            assert ruleSet.match(url) is expected, url
+        
+        sequential = timeSequential(rules, urls)
+        combined = timeCompiled(ruleSet, urls)
+        memoized = timeMemoized(ruleSet, urls)
+        perRequest = 1000000.0 / len(urls)
+        print "%8s %10.2f %14.2f %14.2f %14.2f" % (count, compiled, sequential * perRequest, combined * perRequest, memoized * perRequest)
+    
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# bench.concurrency
+# 
+# Fires thousands of concurrent requests at a single HTTPProxyServer and
+# checks that every response carries the body and status of its own
+# request. Exits non-zero if any responses were mixed up.
+
+from optparse import OptionParser
+import os
+import random
+import sys
+import threading
+import time
+import Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knit.proxy import HTTPProxyServer
+from knit.simplecache import Cache
+from origin import startOrigin
+
+
+def buildEnviron(path, query):
+    return {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8080',
+        'wsgi.url_scheme': 'http',
+        'HTTP_X_REQUEST_PATH': path,
+    }
+
+
+def runRequest(application, origin, path, query, size):
+    statuses = []
+    def startResponse(status, headers):
+        statuses.append(status)
+    
+    environ = buildEnviron(path, query)
+    response = application(environ, startResponse)
+    try:
+        body = ''.join(response)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    
+    expected = origin.getBody("%s?%s" % (path, query), size)
+    return statuses == ['200 OK'] and body == expected
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--requests", type="int", default=5000, help="Total requests to send")
+    parser.add_option("-c", "--concurrency", type="int", default=200, help="Concurrent client threads")
+    parser.add_option("-k", "--keys", type="int", default=100, help="Distinct URLs to request")
+    parser.add_option("--size", type="int", default=4096, help="Object size in bytes")
+    options, args = parser.parse_args()
+    
+    origin = startOrigin(objectSize = options.size)
+    backend = {'host': origin.server_address[0], 'port': origin.server_address[1]}
+    application = HTTPProxyServer(backend, cache = Cache('MemoryCache'))
+    
+    jobs = Queue.Queue()
+    for i in xrange(options.requests):
+        key = random.randint(0, options.keys - 1)
+        # Every third URL is private, so a share of requests always
+        # streams from the origin alongside the cached ones.
+        cacheControl = 'private' if key % 3 == 0 else 'public,max-age=300'
+        query = "size=%s&cc=%s" % (options.size + key, cacheControl)
+        jobs.put(("/objects/%s" % key, query, options.size + key))
+    
+    results = {'ok': 0, 'mismatched': 0, 'errors': 0}
+    lock = threading.Lock()
+    
+    def worker():
+        while True:
+            try:
+                path, query, size = jobs.get(False)
+            except Queue.Empty:
+                return
+            
+            try:
+                outcome = 'ok' if runRequest(application, origin, path, query, size) else 'mismatched'
+            except Exception:
+                outcome = 'errors'
+            
+            with lock:
+                results[outcome] += 1
+    
+    start = time.time()
+    threads = [threading.Thread(target = worker) for i in xrange(options.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    
+    print "requests:     %s" % options.requests
+    print "concurrency:  %s" % options.concurrency
+    print "elapsed:      %.2fs" % elapsed
+    print "throughput:   %.1f req/s" % (options.requests / elapsed)
+    print "origin hits:  %s" % origin.requests
+    print "ok:           %(ok)s" % results
+    print "mismatched:   %(mismatched)s" % results
+    print "errors:       %(errors)s" % results
+    
+    # Origin handler threads still hold keep-alive connections open, so
+    # skip interpreter teardown rather than letting them race it.
+    sys.stdout.flush()
+    os._exit(1 if results['mismatched'] or results['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
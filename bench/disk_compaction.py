@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# bench.disk_compaction
+# 
+# Consistency check of the disk cache tier across compaction and restart.
+# Random sets, overwrites and deletes run against small segments, and after
+# every round the segments are compacted and the index rebuilt from disk,
+# which has to hold exactly the entries that were neither deleted nor
+# replaced.
+
+from optparse import OptionParser
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knit.disk import SegmentStore
+
+
+def openStore(path, options):
+    return SegmentStore(path, segmentsize = options.segment_size, maxbytes = options.max_bytes, compact = 3600, ratio = options.ratio)
+
+
+def verify(store, model):
+    errors = []
+    for key in set(store.getKeys()) | set(model):
+        entry = store.get(key)
+        body = str(entry[0]) if entry else None
+        if body != model.get(key):
+            errors.append(key)
+    return errors
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--rounds", type="int", default=50, help="Compaction and reload rounds")
+    parser.add_option("--operations", type="int", default=200, help="Operations per round")
+    parser.add_option("--keys", type="int", default=40, help="Distinct keys in the workload")
+    parser.add_option("--segment-size", type="int", default=65536, help="Segment size in bytes")
+    parser.add_option("--max-bytes", type="int", default=67108864, help="Byte limit of the tier")
+    parser.add_option("--ratio", type="float", default=0.5, help="Live ratio below which segments are compacted")
+    parser.add_option("--seed", type="int", default=None, help="Random seed")
+    options, args = parser.parse_args()
+    
+    rand = random.Random(options.seed)
+    path = tempfile.mkdtemp(prefix = "knit-disk-")
+    model = {}
+    failures = compactions = 0
+    start = time.time()
+    try:
+        store = openStore(path, options)
+        for round in xrange(options.rounds):
+            for i in xrange(options.operations):
+                key = "GET /objects/%s? " % rand.randrange(options.keys)
+                if rand.random() < 0.3:
+                    store.delete(key)
+                    model.pop(key, None)
+                else:
+                    body = os.urandom(rand.choice((64, 512, 4096, 16384)))
+                    store.set(key, (body, '200 OK', []))
+                    model[key] = body
+            
+            store._SegmentStore__compact()
+            compactions += store.getStats()['compactions']
+            store.stop()
+            store = openStore(path, options)
+            
+            errors = verify(store, model)
+            if errors:
+                failures += 1
+                print "round %s: %s keys differ after reload, e.g. %r" % (round, len(errors), errors[0])
+        
+        segments = store.getStats()['segments']
+        store.stop()
+    finally:
+        shutil.rmtree(path, ignore_errors = True)
+    
+    print "%s rounds in %.2fs, %s compactions, %s segments, %s failed" % (options.rounds, time.time() - start, compactions, segments, failures)
+    sys.stdout.flush()
+    os._exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# bench.loadtest
+# 
+# Starts a local stub origin and a mesh of Knit node processes linked with
+# --discover, replays a Zipfian or trace-driven request mix against them
+# and reports throughput, latency percentiles, hit ratio, origin offload
+# and mesh traffic as JSON, so runs can be compared across commits.
+
+from optparse import OptionParser
+import bisect
+import httplib
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import yaml
+
+from cache_backends import buildZipfTable
+from origin import startOrigin
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATS_PATH = "/_knit/stats"
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL_PATTERN = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def findFreePort():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def fetchStats(port):
+    conn = httplib.HTTPConnection('127.0.0.1', port, timeout = 5)
+    try:
+        conn.request('GET', STATS_PATH)
+        response = conn.getresponse()
+        return parseStats(response.read())
+    finally:
+        conn.close()
+
+
+def parseStats(text):
+    samples = []
+    for line in text.splitlines():
+        match = SAMPLE_PATTERN.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples.append((name, dict(LABEL_PATTERN.findall(labels or '')), float(value)))
+    return samples
+
+
+def sumStats(samples, name, **labels):
+    return sum(value for sampleName, sampleLabels, value in samples
+               if sampleName == name and all(sampleLabels.get(key) == label for key, label in labels.iteritems()))
+
+
+def getPercentile(values, percentile):
+    if not values:
+        return 0.0
+    return values[int(round(percentile * (len(values) - 1)))]
+
+
+def getCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = ROOT, stderr = open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def buildRequests(options):
+    if options.trace:
+        with open(options.trace) as f:
+            paths = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        return [paths[i % len(paths)] for i in xrange(options.requests)]
+    
+    table = buildZipfTable(options.objects, options.exponent)
+    rand = random.Random(options.seed)
+    return ["/objects/%s" % bisect.bisect(table, rand.random()) for i in xrange(options.requests)]
+
+
+def startNodes(options, origin, workdir):
+    nodes = []
+    for index in xrange(options.nodes):
+        node = {'index': index, 'mesh': findFreePort(), 'http': findFreePort()}
+        settings = {
+            'mesh': {'port': node['mesh']},
+            'http': {
+                'backend': {'host': origin.server_address[0], 'port': origin.server_address[1]},
+                'frontend': {'host': '127.0.0.1', 'port': node['http']},
+            },
+            'cache': {'backend': options.backend},
+            'stats': {'enabled': True, 'path': STATS_PATH},
+            'log': {'level': 'WARNING', 'stream': os.path.join(workdir, "node-%s.log" % index)},
+        }
+        path = os.path.join(workdir, "node-%s.yml" % index)
+        with open(path, 'w') as f:
+            yaml.safe_dump(settings, f, default_flow_style = False)
+        
+        command = [sys.executable, os.path.join(ROOT, 'knit', '__main__.py'), '--settings', path, '--%s' % options.server]
+        if nodes:
+            command.extend(['--discover', '127.0.0.1:%s' % nodes[0]['mesh']])
+        node['process'] = subprocess.Popen(command, cwd = workdir)
+        nodes.append(node)
+        
+        # Each node has to be reachable before the next one discovers it
+        waitFor(lambda: fetchStats(node['http']), options.timeout)
+    
+    waitFor(lambda: all(sumStats(fetchStats(node['http']), 'knit_mesh_membership_alive') >= options.nodes for node in nodes), options.timeout)
+    return nodes
+
+
+def stopNodes(nodes):
+    for node in nodes:
+        if node['process'].poll() is None:
+            node['process'].kill()
+        node['process'].wait()
+
+
+def waitFor(predicate, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if predicate():
+                return
+        except (socket.error, httplib.HTTPException):
+            pass
+        if time.time() > deadline:
+            raise RuntimeError("Timed out waiting for the Knit nodes to start")
+        time.sleep(0.1)
+
+
+def runLoad(nodes, origin, requests, concurrency):
+    jobs = list(enumerate(requests))
+    jobs.reverse()
+    latencies = []
+    results = {'ok': 0, 'mismatched': 0, 'errors': 0}
+    lock = threading.Lock()
+    
+    def getExpectedBody(path):
+        params = dict(urlparse.parse_qsl(urlparse.urlparse(path).query))
+        return origin.getBody(path, int(params.get('size', origin.objectSize)))
+    
+    def worker():
+        local = []
+        while True:
+            with lock:
+                if not jobs:
+                    break
+                index, path = jobs.pop()
+            
+            node = nodes[index % len(nodes)]
+            start = time.time()
+            try:
+                conn = httplib.HTTPConnection('127.0.0.1', node['http'], timeout = 30)
+                conn.request('GET', path)
+                response = conn.getresponse()
+                body = response.read()
+                conn.close()
+                outcome = 'ok' if response.status == 200 and body == getExpectedBody(path) else 'mismatched'
+            except (socket.error, httplib.HTTPException):
+                outcome = 'errors'
+            local.append(time.time() - start)
+            
+            with lock:
+                results[outcome] += 1
+        
+        with lock:
+            latencies.extend(local)
+    
+    start = time.time()
+    threads = [threading.Thread(target = worker) for i in xrange(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start, sorted(latencies), results
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--nodes", type="int", default=3, help="Knit node processes in the mesh")
+    parser.add_option("-n", "--requests", type="int", default=10000, help="Requests to replay")
+    parser.add_option("-c", "--concurrency", type="int", default=32, help="Concurrent client threads")
+    parser.add_option("--objects", type="int", default=1000, help="Distinct objects in the Zipfian mix")
+    parser.add_option("--exponent", type="float", default=0.99, help="Zipf exponent of the object popularity")
+    parser.add_option("--trace", metavar="FILE", help="Replay request paths from FILE, one per line, instead of a Zipfian mix")
+    parser.add_option("--size", type="int", default=4096, help="Origin object size in bytes")
+    parser.add_option("--latency", type="float", default=0.0, help="Origin latency in seconds")
+    parser.add_option("--cache-control", dest="cacheControl", default="public, max-age=300", help="Origin Cache-Control header")
+    parser.add_option("--backend", default="ShardedLRUCache", help="Cache backend of the nodes")
+    parser.add_option("--server", default="evented", choices=["evented", "devel"], help="Node HTTP server: evented or devel")
+    parser.add_option("--seed", type="int", default=1, help="Seed of the Zipfian request mix")
+    parser.add_option("--timeout", type="float", default=30, help="Seconds to wait for the mesh to form")
+    parser.add_option("-o", "--output", metavar="FILE", help="Write the JSON report to FILE as well as stdout")
+    options, args = parser.parse_args()
+    
+    origin = startOrigin(objectSize = options.size, latency = options.latency, cacheControl = options.cacheControl)
+    workdir = tempfile.mkdtemp(prefix = "knit-loadtest-")
+    nodes = []
+    try:
+        nodes = startNodes(options, origin, workdir)
+        requests = buildRequests(options)
+        elapsed, latencies, results = runLoad(nodes, origin, requests, options.concurrency)
+        nodeStats = [fetchStats(node['http']) for node in nodes]
+    finally:
+        stopNodes(nodes)
+        shutil.rmtree(workdir, True)
+    
+    lookups = sum(sumStats(stats, 'knit_cache_rule_lookups_total') for stats in nodeStats)
+    hits = sum(sumStats(stats, 'knit_cache_rule_lookups_total', outcome = 'hits') + sumStats(stats, 'knit_cache_rule_lookups_total', outcome = 'stale') for stats in nodeStats)
+    report = {
+        'commit': getCommit(),
+        'timestamp': time.time(),
+        'config': dict(options.__dict__),
+        'requests': len(latencies),
+        'results': results,
+        'duration': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'latency': {
+            'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'p50': getPercentile(latencies, 0.5),
+            'p90': getPercentile(latencies, 0.9),
+            'p99': getPercentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0.0,
+        },
+        'hitRatio': hits / lookups if lookups else 0.0,
+        'originRequests': origin.requests,
+        'originOffload': 1.0 - float(origin.requests) / len(latencies) if latencies else 0.0,
+        'meshBytesSent': sum(sumStats(stats, 'knit_mesh_sent_bytes_total') for stats in nodeStats),
+        'nodes': [{
+            'lookups': sumStats(stats, 'knit_cache_rule_lookups_total'),
+            'entries': sumStats(stats, 'knit_cache_entries'),
+            'meshBytesSent': sumStats(stats, 'knit_mesh_sent_bytes_total'),
+        } for stats in nodeStats],
+    }
+    
+    output = json.dumps(report, indent = 2, sort_keys = True)
+    print output
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    
+    sys.stdout.flush()
+    os._exit(1 if results['mismatched'] or results['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
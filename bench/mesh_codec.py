@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# bench.mesh_codec
+# 
+# Microbenchmark of the mesh payload codec for typical cache entries,
+# compared with the former YAML + base64 message encoding.
+
+from optparse import OptionParser
+import base64
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knit import codec
+
+SIZES = (1024, 10240, 102400, 1048576, 10485760)
+
+
+def buildEntry(size):
+    body = os.urandom(size)
+    headers = [('Content-Type', 'application/octet-stream'), ('Content-Length', str(size)), ('Cache-Control', 'public, max-age=300')]
+    return "GET /objects/%s? " % size, (body, '200 OK', headers), 300
+
+
+def legacyDumps(data):
+    import yaml
+    return base64.b64encode("&&".join(("token", "SaveCacheEntry", yaml.dump(data)))) + ";;"
+
+
+def legacyLoads(message):
+    import yaml
+    token, action, data = base64.b64decode(message[:-2]).split("&&", 2)
+    return yaml.load(data)
+
+
+def measure(fn, arg, budget):
+    runs = 0
+    start = time.time()
+    while True:
+        result = fn(arg)
+        runs += 1
+        elapsed = time.time() - start
+        if elapsed >= budget:
+            return elapsed / runs, result
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--budget", type="float", default=0.5, help="Seconds to spend per measurement")
+    parser.add_option("--legacy-max", type="int", default=102400, help="Largest entry to run through the legacy encoding")
+    options, args = parser.parse_args()
+    
+    print "%10s %-8s %12s %12s %12s %8s" % ("size", "codec", "encode", "decode", "wire bytes", "MB/s")
+    for size in SIZES:
+        entry = buildEntry(size)
+        codecs = [("binary", codec.dumps, codec.loads)]
+        if size <= options.legacy_max:
+            codecs.append(("legacy", legacyDumps, legacyLoads))
+        
+        for name, dumps, loads in codecs:
+            encodeTime, message = measure(dumps, entry, options.budget)
+            decodeTime, decoded = measure(loads, message, options.budget)
+            assert decoded[1][0] == entry[1][0]
+            
+            throughput = size / (encodeTime + decodeTime) / 1048576
+            print "%10s %-8s %10.3fms %10.3fms %12s %8.1f" % (size, name, encodeTime * 1000, decodeTime * 1000, len(message), throughput)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# bench.mesh_gossip
+# 
+# Starts a mesh of separate node processes and measures how long gossip
+# membership takes to converge after the nodes join and after one of
+# them is killed, along with the gossip traffic each node generates.
+
+from optparse import OptionParser
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knit.mesh import MeshServer
+
+
+REPORT_INTERVAL = 0.05
+
+
+def runNode(index, port, seed, settings, reports, addresses):
+    server = MeshServer(port, 128)
+    server.setConnectionSettings(settings)
+    server.listen()
+    addresses.put((index, server.getServerAddress()))
+    
+    if seed:
+        server.discoverMesh(seed)
+    
+    while True:
+        reports.put((index, time.time(), server.getMembershipStats()))
+        time.sleep(REPORT_INTERVAL)
+
+
+def waitForView(reports, views, nodes, predicate, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            index, stamp, stats = reports.get(timeout = 1)
+        except Exception:
+            continue
+        
+        views[index] = stats
+        if all(index in views and predicate(views[index]) for index in nodes):
+            return time.time()
+    return None
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--nodes", type="int", default=8, help="Number of node processes")
+    parser.add_option("--interval", type="float", default=0.2, help="Gossip interval in seconds")
+    parser.add_option("--fanout", type="int", default=2, help="Peers contacted per gossip round")
+    parser.add_option("--suspect", type="float", default=1.0, help="Silence before a node is suspected")
+    parser.add_option("--dead", type="float", default=3.0, help="Silence before a node is declared dead")
+    parser.add_option("--port", type="int", default=44000, help="First port to try for the mesh servers")
+    options, args = parser.parse_args()
+    
+    settings = {
+        'persistent': True,
+        'timeout': 2,
+        'gossip': {
+            'interval': options.interval,
+            'fanout': options.fanout,
+            'suspect': options.suspect,
+            'dead': options.dead,
+        },
+    }
+    
+    reports = multiprocessing.Queue()
+    addresses = multiprocessing.Queue()
+    processes = []
+    seed = None
+    start = time.time()
+    for i in xrange(options.nodes):
+        # Spread the ports out; each server scans upward for a free one.
+        p = multiprocessing.Process(target = runNode, args = (i, options.port + i * 10, seed, settings, reports, addresses))
+        p.daemon = True
+        p.start()
+        processes.append(p)
+        if seed is None:
+            index, seed = addresses.get()
+    
+    nodes = range(options.nodes)
+    views = {}
+    joined = waitForView(reports, views, nodes, lambda stats: stats['alive'] == options.nodes, 60)
+    
+    victim = options.nodes - 1
+    os.kill(processes[victim].pid, signal.SIGKILL)
+    killed = time.time()
+    
+    survivors = nodes[:-1]
+    detected = waitForView(reports, views, survivors, lambda stats: stats['alive'] == options.nodes - 1 and not stats['suspect'], 60)
+    elapsed = time.time() - start
+    
+    print "%-26s %10s" % ("phase", "seconds")
+    print "%-26s %10s" % ("join convergence", "%.2f" % (joined - start) if joined else "timeout")
+    print "%-26s %10s" % ("failure convergence", "%.2f" % (detected - killed) if detected else "timeout")
+    print
+    print "%-6s %12s %12s %10s" % ("node", "exchanges/s", "bytes/s", "failed")
+    for index in survivors:
+        stats = views[index]
+        print "%-6s %12.1f %12.1f %10s" % (index, stats['exchanges'] / elapsed, stats['bytes'] / elapsed, stats['failed'])
+    
+    for p in processes:
+        if p.is_alive():
+            os.kill(p.pid, signal.SIGKILL)
+    
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
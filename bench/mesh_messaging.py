@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# bench.mesh_messaging
+# 
+# Compares mesh message throughput over persistent, multiplexed peer
+# connections with the connect-per-message design.
+
+from optparse import OptionParser
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knit.mesh import MeshServer, Node
+
+
+def runClients(node, messages, concurrency, payload):
+    counts = {'ok': 0, 'failed': 0}
+    lock = threading.Lock()
+    perThread = messages / concurrency
+    
+    def client():
+        for i in xrange(perThread):
+            try:
+                node.sendMessage("Echo", payload)
+                outcome = 'ok'
+            except Exception:
+                outcome = 'failed'
+            with lock:
+                counts[outcome] += 1
+    
+    start = time.time()
+    threads = [threading.Thread(target = client) for i in xrange(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start, counts
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--messages", type="int", default=5000, help="Messages per mode")
+    parser.add_option("-c", "--concurrency", type="int", default=8, help="Concurrent senders")
+    parser.add_option("--size", type="int", default=256, help="Payload size in bytes")
+    parser.add_option("--port", type="int", default=43000, help="First port to try for the mesh servers")
+    options, args = parser.parse_args()
+    
+    server = MeshServer(options.port, 128)
+    server.listen()
+    payload = "x" * options.size
+    
+    print "%-12s %10s %10s %8s" % ("mode", "msgs/s", "elapsed", "failed")
+    for persistent in (False, True):
+        client = MeshServer(options.port + 1, 128)
+        client.setConnectionSettings({'persistent': persistent})
+        node = Node(client, server.getServerAddress())
+        
+        elapsed, counts = runClients(node, options.messages, options.concurrency, payload)
+        mode = "persistent" if persistent else "per-message"
+        print "%-12s %10.1f %9.2fs %8s" % (mode, counts['ok'] / elapsed, elapsed, counts['failed'])
+        node.close()
+    
+    server.stop()
+    
+    # Mesh connection threads are daemons blocked in recv; skip
+    # interpreter teardown rather than letting them race it.
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# bench.mesh_recv
+# 
+# Measures how mesh message receive time scales with payload size, for
+# MessagingSocket.recv and for the former concatenate-and-scan loop.
+
+from optparse import OptionParser
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knit.mesh import MessagingSocket
+
+SIZES = (65536, 262144, 1048576, 4194304, 16777216, 33554432)
+
+
+class LocalServer(object):
+    def getServerToken(self):
+        return "0" * 32
+
+
+def legacyRecv(sock):
+    response = ''
+    while True:
+        chunk = sock.recv(1024)
+        response = response + chunk
+        if chunk == '' or response.endswith(";;"):
+            return response
+
+
+def timeReceive(size, legacy):
+    sender, receiver = socket.socketpair()
+    body = "x" * size
+    
+    if legacy:
+        message = "y" * size + ";;"
+        send = lambda: sender.sendall(message)
+        recv = lambda: legacyRecv(receiver)
+    else:
+        messaging = MessagingSocket(sender, LocalServer())
+        send = lambda: messaging.send("SaveCacheEntry", ("key", (body, "200 OK", []), 300))
+        recv = MessagingSocket(receiver, LocalServer()).recv
+    
+    t = threading.Thread(target = send)
+    t.daemon = True
+    start = time.time()
+    t.start()
+    recv()
+    elapsed = time.time() - start
+    t.join()
+    
+    sender.close()
+    receiver.close()
+    return elapsed
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--legacy-max", type="int", default=4194304, help="Largest payload to run through the legacy loop")
+    options, args = parser.parse_args()
+    
+    print "%10s %-8s %10s %12s" % ("size", "recv", "elapsed", "ms per MB")
+    for size in SIZES:
+        modes = [("framed", False)]
+        if size <= options.legacy_max:
+            modes.append(("legacy", True))
+        
+        for name, legacy in modes:
+            elapsed = timeReceive(size, legacy)
+            print "%10s %-8s %9.2fms %12.2f" % (size, name, elapsed * 1000, elapsed * 1000 / (size / 1048576.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# 
+# bench.origin
+# 
+# Stub HTTP origin used by the benchmarks. Every response body is derived
+# from the request path so callers can verify what they were sent.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import hashlib
+import threading
+import time
+import urlparse
+
+
+class OriginRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        self.server.countRequest()
+        
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        size = int(params.get('size', self.server.objectSize))
+        latency = float(params.get('latency', self.server.latency))
+        cacheControl = params.get('cc', self.server.cacheControl)
+        
+        if latency:
+            time.sleep(latency)
+        
+        body = self.server.getBody(self.path, size)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            if cacheControl:
+                self.send_header('Cache-Control', cacheControl)
+            self.end_headers()
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        if cacheControl:
+            self.send_header('Cache-Control', cacheControl)
+        self.end_headers()
+        
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+    
+    do_HEAD = do_GET
+    
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+    
+    def __init__(self, address, objectSize = 1024, latency = 0, cacheControl = 'public, max-age=300'):
+        HTTPServer.__init__(self, address, OriginRequestHandler)
+        self.objectSize = objectSize
+        self.latency = latency
+        self.cacheControl = cacheControl
+        self.requests = 0
+        self.__lock = threading.Lock()
+    
+    def countRequest(self):
+        with self.__lock:
+            self.requests += 1
+    
+    def getBody(self, path, size):
+        seed = "%s\n" % path
+        body = seed * (size / len(seed) + 1)
+        return body[:size]
+    
+    def start(self):
+        t = threading.Thread(target = self.serve_forever)
+        t.daemon = True
+        t.start()
+        return t
+
+
+def startOrigin(host = '127.0.0.1', port = 0, **config):
+    server = OriginServer((host, port), **config)
+    server.start()
+    return server
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# bench.stats_overhead
+# 
+# Measures what the per-phase latency histograms cost on the proxy's
+# request path, serving the same cached and uncached requests with the
+# stats turned off and then on, and how long rendering the stats takes.
+
+from optparse import OptionParser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knit.lru import ShardedLRUCache
+from knit.proxy import HTTPProxyServer
+from knit.stats import getStatsRegistry
+from origin import startOrigin
+
+
+def runRequests(proxy, requests, paths):
+    def startResponse(status, headers):
+        pass
+    
+    start = time.time()
+    for i in xrange(requests):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/objects/%s' % (i % paths),
+            'QUERY_STRING': '',
+            'wsgi.url_scheme': 'http',
+        }
+        response = proxy(environ, startResponse)
+        for chunk in response:
+            pass
+        response.close()
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--requests", type="int", default=50000, help="Requests per run")
+    parser.add_option("--paths", type="int", default=1000, help="Distinct paths; all but the first pass are cache hits")
+    parser.add_option("--runs", type="int", default=3, help="Runs per setting, the fastest is reported")
+    options, args = parser.parse_args()
+    
+    origin = startOrigin()
+    backend = {'host': '127.0.0.1', 'port': origin.server_address[1]}
+    
+    proxies = {}
+    for enabled in (False, True):
+        proxies[enabled] = HTTPProxyServer(backend, cache = ShardedLRUCache())
+        if enabled:
+            proxies[enabled].setStats({'enabled': True, 'path': '/_knit/stats'})
+        runRequests(proxies[enabled], options.paths, options.paths)
+    
+    # Runs alternate between the settings so drift affects both alike
+    results = {False: [], True: []}
+    for i in xrange(options.runs):
+        for enabled in (False, True):
+            results[enabled].append(runRequests(proxies[enabled], options.requests, options.paths))
+    
+    print "%-10s %12s %12s" % ("stats", "requests/s", "us/request")
+    for enabled in (False, True):
+        elapsed = results[enabled] = min(results[enabled])
+        print "%-10s %12.1f %12.2f" % ("on" if enabled else "off", options.requests / elapsed, elapsed * 1000000 / options.requests)
+    
+    print "Overhead: %.1f%%" % (100.0 * (results[True] - results[False]) / results[False])
+    
+    start = time.time()
+    output = getStatsRegistry().render()
+    print "Rendered %s lines of stats in %.2fms" % (output.count("\n"), (time.time() - start) * 1000)
+    
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,28 +20,84 @@ from proxy import (
     HTTPProxyServer
 )
 
+from evented import (
+    EventedProxyServer
+)
+
+from disk import (
+    SegmentStore
+)
+
+from agent import (
+    AgentCache,
+    AgentServer
+)
+
+from shm import (
+    SharedMemoryCache
+)
+
 
 class KnitMeshProxy(object):
+    BACKEND_SETTINGS = {'ShardedLRUCache': 'cache.lru', 'SharedMemoryCache': 'cache.shm'}
+    
     settings = {}
     options = None
     meshServer = None
     meshThread = None
+    agentServer = None
     
     def __init__(self):
         self.__setupLogging()
-        self.__buildMeshServer()
+        if not self.isWorkerMode():
+            self.__buildMeshServer()
     
     
     def getWSGIApplication(self):
+        # Workers of a host agent leave the mesh to the agent and share
+        # its cache instead of joining as nodes of their own.
+        if self.isWorkerMode():
+            return self.__initProxyServer(self.__buildAgentCache())
+        
         self.__discoverMeshNetwork()
         self.__startMeshServer()
-        return self.__initProxyServer()
+        application = self.__initProxyServer(self.__buildMeshCache())
+        self.__warmUpCache()
+        return application
+    
+    
+    def isAgentMode(self):
+        return self.__getEnvironmentSetting('agent')
     
     
     def isDevelopmentMode(self):
         return self.__getEnvironmentSetting('devel')
     
     
+    def isEventedMode(self):
+        return self.__getEnvironmentSetting('evented')
+    
+    
+    def isWorkerMode(self):
+        return bool(self.__getConfigSetting('mesh.agent.enabled')) and not self.isAgentMode()
+    
+    
+    def startAgent(self):
+        self.__setupErrorHandling()
+        self.__discoverMeshNetwork()
+        self.__startMeshServer()
+        
+        cache = self.__buildMeshCache('SharedMemoryCache')
+        cache.setLocalCopies(True)
+        self.__warmUpCache()
+        
+        self.agentServer = AgentServer(self.__getConfigSetting('mesh.agent.socket'), cache, self.meshServer)
+        self.meshServer.setFlightGroup(self.agentServer.getFlightGroup())
+        self.agentServer.listen()
+        while self.meshThread.isAlive():
+            self.meshThread.join(1)
+    
+    
     def startDevelopmentServer(self, application):
         self.__setupErrorHandling()
         httpFrontend = self.__getConfigSetting('http.frontend')
@@ -50,10 +106,40 @@ class KnitMeshProxy(object):
         httpd.serve_forever()
     
     
+    def startEventedServer(self, application):
+        self.__setupErrorHandling()
+        httpFrontend = self.__getConfigSetting('http.frontend')
+        httpBackend = self.__getConfigSetting('http.backend')
+        logging.info("Running evented HTTP server on %(host)s:%(port)s" % httpFrontend)
+        server = EventedProxyServer(application, httpBackend, (httpFrontend['host'], httpFrontend['port']))
+        server.serveForever()
+    
+    
     def __buildMeshServer(self):
         port = self.__getConfigSetting('mesh.port')
         queuedConnections = self.__getConfigSetting('mesh.queue')
         self.meshServer = MeshServer(port, queuedConnections)
+        self.meshServer.setConnectionSettings(self.__getConfigSetting('mesh'))
+    
+    
+    def __buildAgentCache(self):
+        path = self.__getConfigSetting('mesh.agent.socket')
+        logging.info("Using host agent at %s" % path)
+        cache = AgentCache(path, SharedMemoryCache(**(self.__getConfigSetting('cache.shm') or {})))
+        cache.setStats(self.__getConfigSetting('stats'))
+        return cache
+    
+    
+    def __buildMeshCache(self, cacheBackend = None):
+        cacheBackend = cacheBackend or self.__getConfigSetting('cache.backend')
+        cacheConfig = {}
+        if cacheBackend in MeshCache.NATIVE_BACKENDS:
+            cacheConfig = self.__getConfigSetting(self.BACKEND_SETTINGS[cacheBackend]) or {}
+        cache = MeshCache(self.meshServer, cacheBackend, **cacheConfig)
+        self.__setupDiskTier(cache)
+        self.meshServer.setCacheBackend(cache)
+        self.meshServer.setStats(self.__getConfigSetting('stats'))
+        return cache
     
     
     def __discoverMeshNetwork(self):
@@ -106,17 +192,25 @@ class KnitMeshProxy(object):
         return value
     
     
-    def __initProxyServer(self):
-        cacheBackend = self.__getConfigSetting('cache.backend')
-        cache = MeshCache(self.meshServer, cacheBackend)
-        self.meshServer.setCacheBackend(cache)
-        
+    def __initProxyServer(self, cache):
         httpBackend = self.__getConfigSetting('http.backend')
         logging.info("Using HTTP backend %(host)s:%(port)s" % httpBackend)
         
         server = HTTPProxyServer(httpBackend, cache = cache)
         server.setCacheMethods(self.__getConfigSetting('cache.methods'))
+        server.setCacheKeys(self.__getConfigSetting('cache.keys'))
         server.setCacheRules(self.__getConfigSetting('cache.rules'))
+        server.setMaxCacheableSize(self.__getConfigSetting('cache.maxsize'))
+        server.setStreamChunkSize(self.__getConfigSetting('http.chunksize'))
+        server.setConnectionPoolSettings(self.__getConfigSetting('http.pool'))
+        server.setCoalescing(self.__getConfigSetting('cache.coalesce'))
+        server.setRevalidation(self.__getConfigSetting('cache.revalidate'))
+        server.setNegativeCaching(self.__getConfigSetting('cache.negative'))
+        server.setProtection(self.__getConfigSetting('cache.protect'))
+        server.setCompression(self.__getConfigSetting('cache.compress'))
+        server.setStats(self.__getConfigSetting('stats'))
+        if self.meshServer:
+            self.meshServer.setFlightGroup(server.getFlightGroup())
         return server
     
     
@@ -138,6 +232,14 @@ class KnitMeshProxy(object):
             help="Run HTTP Development Server. Production environments should use a real WSGI Server instead.", 
             action="store_true")
         
+        parser.add_option("--evented", 
+            help="Run the single threaded, non-blocking HTTP server instead of a WSGI server.", 
+            action="store_true")
+        
+        parser.add_option("--agent", 
+            help="Run the host agent, which joins the mesh on behalf of the proxy workers on this host.", 
+            action="store_true")
+        
         options, args = parser.parse_args()
         self.options = options
         return options
@@ -160,12 +262,26 @@ class KnitMeshProxy(object):
         return settings
     
     
+    def __setupDiskTier(self, cache):
+        settings = dict(self.__getConfigSetting('cache.disk') or {})
+        if not settings.pop('enabled', False):
+            return
+        
+        path = settings.pop('path')
+        minSize = settings.pop('minsize', None)
+        logging.info("Using disk cache tier in %s" % path)
+        cache.setDiskTier(SegmentStore(path, **settings), minSize)
+    
+    
     def __setupErrorHandling(self):
         def die(signum, frame):
             logging.critical("Caught signal %s." % signum)
             logging.critical("Waiting for threads to exit.")
-            self.meshServer.stop()
-            self.meshThread.join()
+            if self.agentServer:
+                self.agentServer.stop()
+            if self.meshServer:
+                self.meshServer.stop()
+                self.meshThread.join()
             logging.critical("Main thread exiting now.")
             sys.exit()
         
@@ -187,10 +303,21 @@ class KnitMeshProxy(object):
     
     def __startMeshServer(self):
         self.meshThread = self.meshServer.listen()
+    
+    
+    def __warmUpCache(self):
+        if self.__getEnvironmentSetting('discover'):
+            self.meshServer.warmUp()
 
 
 proxy = KnitMeshProxy()
-application = proxy.getWSGIApplication()
 
-if proxy.isDevelopmentMode():
-    proxy.startDevelopmentServer(application)
+if proxy.isAgentMode():
+    proxy.startAgent()
+else:
+    application = proxy.getWSGIApplication()
+    
+    if proxy.isEventedMode():
+        proxy.startEventedServer(application)
+    elif proxy.isDevelopmentMode():
+        proxy.startDevelopmentServer(application)
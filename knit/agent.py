@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.agent
+# 
+# Module containing the host level mesh agent. One agent process per host
+# owns the mesh node and its peer connections, and keeps its cache in a
+# shared memory segment. Proxy workers on the host read that segment
+# directly and send misses and writes to the agent over a Unix socket.
+
+import logging
+import os
+import socket
+import threading
+import codec
+from flight import FlightGroup
+from mesh import MessagingSocket
+from stats import getStatsRegistry
+
+
+class AgentSocket(MessagingSocket):
+    SENT_BYTES = 'knit_agent_sent_bytes_total'
+
+
+class AgentServer(object):
+    TOKEN = "agent"
+    BACKLOG = 128
+    ACCEPT_TIMEOUT = 1
+    
+    __path = None
+    __cache = None
+    __meshServer = None
+    __sock = None
+    __stopping = False
+    __flights = None
+    __fetchers = None
+    __lock = None
+    
+    def __init__(self, path, cache, meshServer):
+        self.__path = path
+        self.__cache = cache
+        self.__meshServer = meshServer
+        self.__flights = FlightGroup()
+        self.__fetchers = {}
+        self.__lock = threading.Lock()
+    
+    
+    def doBeginFlight(self, clientToken, requestData):
+        # Workers fetch on their own, so the flight lasts until the last
+        # worker that reported the key is done with it.
+        with self.__lock:
+            flight = self.__flights.begin(requestData)[0]
+            self.__fetchers.setdefault(requestData, (flight, set()))[1].add(clientToken)
+        return True
+    
+    
+    def doCollectStats(self, clientToken, requestData):
+        return self.__meshServer.collectStats()
+    
+    
+    def doEndFlight(self, clientToken, requestData):
+        with self.__lock:
+            self.__endFlight(clientToken, requestData)
+        return True
+    
+    
+    def doGet(self, clientToken, requestData):
+        return self.__cache.get(requestData)
+    
+    
+    def doSet(self, clientToken, requestData):
+        key, value, expire, replicate = requestData
+        return self.__cache.set(key, value, expire, replicate)
+    
+    
+    def doTouch(self, clientToken, requestData):
+        key, parts, expire = requestData
+        return self.__cache.touch(key, parts, expire)
+    
+    
+    def doWaitForRemoteFetch(self, clientToken, requestData):
+        key, timeout = requestData
+        return self.__cache.waitForRemoteFetch(key, timeout)
+    
+    
+    def getFlightGroup(self):
+        return self.__flights
+    
+    
+    def getServerToken(self):
+        return self.TOKEN
+    
+    
+    def listen(self):
+        # A socket left behind by an agent that died is simply replaced
+        try:
+            os.unlink(self.__path)
+        except OSError:
+            pass
+        
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__sock.bind(self.__path)
+        self.__sock.listen(self.BACKLOG)
+        self.__sock.settimeout(self.ACCEPT_TIMEOUT)
+        logging.info("Host agent listening on %s" % self.__path)
+        
+        t = threading.Thread(target = self.__acceptConnections)
+        t.daemon = True
+        t.start()
+        return t
+    
+    
+    def stop(self):
+        logging.critical("Sending halt signal to host agent.")
+        self.__stopping = True
+    
+    
+    def __acceptConnections(self):
+        while not self.__stopping:
+            try:
+                sock, remoteAddress = self.__sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error, e:
+                logging.error("Failed to accept worker connection: %s" % e)
+                continue
+            
+            sock.settimeout(None)
+            t = threading.Thread(target = self.__serveConnection, args = (AgentSocket(sock, self), ))
+            t.daemon = True
+            t.start()
+        
+        self.__sock.close()
+        try:
+            os.unlink(self.__path)
+        except OSError:
+            pass
+    
+    
+    def __endFlight(self, clientToken, key):
+        flight, clientTokens = self.__fetchers.get(key, (None, set()))
+        clientTokens.discard(clientToken)
+        if flight and not clientTokens:
+            del self.__fetchers[key]
+            self.__flights.end(key, flight)
+    
+    
+    def __endFlights(self, clientToken):
+        with self.__lock:
+            for key, (flight, clientTokens) in self.__fetchers.items():
+                if clientToken in clientTokens:
+                    self.__endFlight(clientToken, key)
+    
+    
+    def __resolveAction(self, action):
+        fnName = "do%s" % action
+        if hasattr(self, fnName):
+            fn = getattr(self, fnName)
+            if callable(fn):
+                return fn
+    
+    
+    def __serveConnection(self, messaging):
+        # Each worker connection carries one request at a time, so it gets
+        # a thread of its own for as long as the worker keeps it open.
+        clientToken = None
+        while not self.__stopping:
+            try:
+                message = messaging.recv()
+            except Exception, e:
+                logging.error("Dropping worker connection: %s" % e)
+                message = None
+            
+            if not message:
+                break
+            
+            clientToken, action, requestId, requestData = message
+            fn = self.__resolveAction(action)
+            try:
+                responseData = fn(clientToken, requestData) if fn else None
+            except Exception:
+                logging.exception("Failed to handle %s from %s" % (action, clientToken))
+                responseData = None
+            
+            try:
+                messaging.sendAck(responseData, requestId)
+            except RuntimeError, e:
+                logging.error("Failed to acknowledge %s from %s: %s" % (action, clientToken, e))
+                break
+        
+        # Fetches a worker started do not outlive its connection, which
+        # only closes when the worker is gone or failed to reach the agent.
+        if clientToken:
+            self.__endFlights(clientToken)
+        messaging.close()
+
+
+class AgentCache(object):
+    TIMEOUT = 30
+    
+    __path = None
+    __store = None
+    __timeout = TIMEOUT
+    __local = None
+    
+    def __init__(self, path, store, timeout = None):
+        self.__path = path
+        self.__store = store
+        self.__timeout = timeout or self.TIMEOUT
+        self.__local = threading.local()
+    
+    
+    def beginFlight(self, key):
+        return self.__request('BeginFlight', key)
+    
+    
+    def collectStats(self):
+        return self.__request('CollectStats') or []
+    
+    
+    def endFlight(self, key):
+        return self.__request('EndFlight', key)
+    
+    
+    def get(self, key, fetch = True):
+        # Entries any worker on the host fetched are already in the shared
+        # segment; only misses go to the agent, which asks the mesh.
+        value = self.__store.get(key)
+        if value or not fetch:
+            return value
+        return self.__request('Get', key)
+    
+    
+    def getServerToken(self):
+        # Looked up on every message, as workers may be forked after import
+        return "worker-%s" % os.getpid()
+    
+    
+    def getStats(self):
+        return self.__store.getStats()
+    
+    
+    def set(self, key, value, expire = 0, replicate = True):
+        return self.__request('Set', (key, value, expire, replicate))
+    
+    
+    def setStats(self, settings):
+        if not settings or not settings.get('enabled'):
+            return
+        registry = getStatsRegistry()
+        registry.enable()
+        registry.addCollector(self.collectStats)
+    
+    
+    def touch(self, key, parts, expire = 0):
+        return self.__request('Touch', (key, tuple(parts), expire))
+    
+    
+    def waitForRemoteFetch(self, key, timeout):
+        return self.__request('WaitForRemoteFetch', (key, timeout))
+    
+    
+    def __connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.__timeout)
+        try:
+            sock.connect(self.__path)
+        except socket.error:
+            sock.close()
+            raise
+        return AgentSocket(sock, self)
+    
+    
+    def __request(self, action, data = None):
+        # A worker without its agent keeps serving: lookups miss and
+        # writes are dropped until the agent is reachable again.
+        messaging = getattr(self.__local, 'messaging', None)
+        try:
+            if not messaging:
+                messaging = self.__local.messaging = self.__connect()
+            messaging.send(action, data)
+            message = messaging.recv()
+            if not message:
+                raise RuntimeError("Connection closed by host agent")
+        except (socket.error, RuntimeError, codec.CodecError), e:
+            logging.error("Request %s to host agent at %s failed: %s" % (action, self.__path, e))
+            if messaging:
+                messaging.close()
+            self.__local.messaging = None
+            return None
+        return message[3]
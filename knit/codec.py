@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.codec
+# 
+# Module containing a compact, type tagged binary encoding for mesh
+# message payloads. Strings are written as a length followed by their
+# raw bytes, so cache bodies go over the wire without any escaping.
+# Decoding works directly on a memoryview of a receive buffer, copying
+# each string out of it exactly once.
+
+import struct
+
+
+NONE = 'N'
+TRUE = 'T'
+FALSE = 'F'
+INT = 'i'
+LONG = 'l'
+FLOAT = 'd'
+BYTES = 's'
+UNICODE = 'u'
+TUPLE = 't'
+LIST = 'L'
+DICT = 'D'
+
+INT_FORMAT = struct.Struct('!q')
+FLOAT_FORMAT = struct.Struct('!d')
+LENGTH_FORMAT = struct.Struct('!I')
+
+INT_MIN = -(2 ** 63)
+INT_MAX = (2 ** 63) - 1
+
+
+class CodecError(ValueError):
+    pass
+
+
+def dumps(data):
+    parts = encode(data)
+    try:
+        return ''.join(parts)
+    except TypeError:
+        return ''.join(str(part) for part in parts)
+
+
+def encode(data, parts = None):
+    if parts is None:
+        parts = []
+    
+    if data is None:
+        parts.append(NONE)
+    elif data is True:
+        parts.append(TRUE)
+    elif data is False:
+        parts.append(FALSE)
+    elif isinstance(data, (str, buffer)):
+        parts.append(BYTES + LENGTH_FORMAT.pack(len(data)))
+        parts.append(data)
+    elif isinstance(data, unicode):
+        data = data.encode('utf-8')
+        parts.append(UNICODE + LENGTH_FORMAT.pack(len(data)))
+        parts.append(data)
+    elif isinstance(data, (int, long)) and INT_MIN <= data <= INT_MAX:
+        parts.append(INT + INT_FORMAT.pack(data))
+    elif isinstance(data, long):
+        data = str(data)
+        parts.append(LONG + LENGTH_FORMAT.pack(len(data)))
+        parts.append(data)
+    elif isinstance(data, float):
+        parts.append(FLOAT + FLOAT_FORMAT.pack(data))
+    elif isinstance(data, tuple):
+        parts.append(TUPLE + LENGTH_FORMAT.pack(len(data)))
+        for item in data:
+            encode(item, parts)
+    elif isinstance(data, list):
+        parts.append(LIST + LENGTH_FORMAT.pack(len(data)))
+        for item in data:
+            encode(item, parts)
+    elif isinstance(data, dict):
+        parts.append(DICT + LENGTH_FORMAT.pack(len(data)))
+        for key, value in data.iteritems():
+            encode(key, parts)
+            encode(value, parts)
+    else:
+        raise CodecError("Can not encode values of type %s" % type(data).__name__)
+    
+    return parts
+
+
+def sizeof(data):
+    if isinstance(data, (str, unicode, buffer)):
+        return len(data)
+    if isinstance(data, (tuple, list)):
+        return sum(sizeof(item) for item in data)
+    if isinstance(data, dict):
+        return sum(sizeof(key) + sizeof(value) for key, value in data.iteritems())
+    return INT_FORMAT.size
+
+
+def loads(data):
+    value, offset = decode(data)
+    if offset != len(data):
+        raise CodecError("Trailing data after decoded value")
+    return value
+
+
+def decode(data, offset = 0):
+    try:
+        tag = data[offset]
+    except IndexError:
+        raise CodecError("Unexpected end of data")
+    offset += 1
+    
+    if tag == NONE:
+        return None, offset
+    if tag == TRUE:
+        return True, offset
+    if tag == FALSE:
+        return False, offset
+    if tag == INT:
+        return INT_FORMAT.unpack_from(data, offset)[0], offset + INT_FORMAT.size
+    if tag == FLOAT:
+        return FLOAT_FORMAT.unpack_from(data, offset)[0], offset + FLOAT_FORMAT.size
+    
+    length = LENGTH_FORMAT.unpack_from(data, offset)[0]
+    offset += LENGTH_FORMAT.size
+    
+    if tag in (BYTES, UNICODE, LONG):
+        end = offset + length
+        if end > len(data):
+            raise CodecError("Unexpected end of data")
+        value = data[offset:end]
+        if isinstance(value, memoryview):
+            value = value.tobytes()
+        
+        if tag == UNICODE:
+            value = value.decode('utf-8')
+        elif tag == LONG:
+            value = long(value)
+        return value, end
+    
+    if tag in (TUPLE, LIST):
+        items = []
+        for i in xrange(length):
+            item, offset = decode(data, offset)
+            items.append(item)
+        return (tuple(items) if tag == TUPLE else items), offset
+    
+    if tag == DICT:
+        items = {}
+        for i in xrange(length):
+            key, offset = decode(data, offset)
+            value, offset = decode(data, offset)
+            items[key] = value
+        return items, offset
+    
+    raise CodecError("Unknown type tag %r" % tag)
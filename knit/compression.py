@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.compression
+# 
+# Module containing the compression of cached response bodies. Bodies are
+# stored compressed once, served as stored to clients accepting the
+# encoding and decompressed only for those that do not.
+
+import fnmatch
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def getAvailableEncodings():
+    encodings = ['gzip']
+    if zstandard:
+        encodings.insert(0, 'zstd')
+    return encodings
+
+
+def parseAcceptEncoding(header):
+    accepted = {}
+    for part in (header or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    
+    if 'x-gzip' in accepted and 'gzip' not in accepted:
+        accepted['gzip'] = accepted['x-gzip']
+    return accepted
+
+
+class BodyCompressor(object):
+    ENCODINGS = ('zstd', 'gzip')
+    LEVEL = 6
+    MIN_SIZE = 1024
+    TYPES = ('text/*', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+    
+    __encoding = None
+    __level = LEVEL
+    __minSize = MIN_SIZE
+    __types = TYPES
+    __lock = None
+    __stats = None
+    
+    def __init__(self, encodings = None, level = None, minsize = None, types = None):
+        available = getAvailableEncodings()
+        preferred = [encoding for encoding in (encodings or self.ENCODINGS) if encoding in available]
+        self.__encoding = preferred[0] if preferred else 'gzip'
+        self.__level = level or self.LEVEL
+        self.__minSize = minsize or self.MIN_SIZE
+        self.__types = types or self.TYPES
+        self.__lock = threading.Lock()
+        self.__stats = {
+            'compressed': 0,
+            'skipped': 0,
+            'bytesIn': 0,
+            'bytesOut': 0,
+            'compressTime': 0.0,
+            'servedEncoded': 0,
+            'decompressed': 0,
+            'decompressTime': 0.0,
+        }
+    
+    
+    def compress(self, body, headers):
+        if not self.__isCompressible(body, headers):
+            return None, body
+        
+        start = time.time()
+        if self.__encoding == 'zstd':
+            data = zstandard.ZstdCompressor(level = self.__level).compress(body)
+        else:
+            compressor = zlib.compressobj(self.__level, zlib.DEFLATED, GZIP_WBITS)
+            data = compressor.compress(body) + compressor.flush()
+        elapsed = time.time() - start
+        
+        # Bodies that barely shrink are not worth decompressing later
+        if len(data) >= len(body) * 0.9:
+            self.__count(skipped = 1, compressTime = elapsed)
+            return None, body
+        
+        self.__count(compressed = 1, bytesIn = len(body), bytesOut = len(data), compressTime = elapsed)
+        return self.__encoding, data
+    
+    
+    def decode(self, encoding, body, acceptEncoding):
+        accepted = parseAcceptEncoding(acceptEncoding)
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            self.__count(servedEncoded = 1)
+            return body, True
+        return self.decompress(encoding, body), False
+    
+    
+    def decompress(self, encoding, body):
+        start = time.time()
+        if encoding == 'zstd':
+            data = zstandard.ZstdDecompressor().decompress(str(body))
+        else:
+            data = zlib.decompress(body, GZIP_WBITS)
+        self.__count(decompressed = 1, decompressTime = time.time() - start)
+        return data
+    
+    
+    def getStats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+        stats['encoding'] = self.__encoding
+        stats['ratio'] = float(stats['bytesOut']) / stats['bytesIn'] if stats['bytesIn'] else 1.0
+        stats['compressRate'] = stats['bytesIn'] / stats['compressTime'] if stats['compressTime'] else 0.0
+        return stats
+    
+    
+    def __count(self, **counts):
+        with self.__lock:
+            for name, value in counts.iteritems():
+                self.__stats[name] += value
+    
+    
+    def __isCompressible(self, body, headers):
+        if len(body) < self.__minSize or 'Content-Encoding' in headers:
+            return False
+        if 'no-transform' in headers.get('Cache-Control', '').lower():
+            return False
+        
+        contentType = headers.get('Content-Type', '').split(';')[0].strip().lower()
+        return any(fnmatch.fnmatchcase(contentType, pattern) for pattern in self.__types)
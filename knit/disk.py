@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.disk
+# 
+# Module containing the on-disk cache tier. Entries are appended to
+# preallocated, memory mapped segment files and located through an
+# in-memory index, which is rebuilt on startup by walking the record
+# headers. Bodies are handed out as buffers over the mapped pages.
+
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+import codec
+
+
+class SegmentStore(object):
+    SEGMENT_SIZE = 268435456
+    MAX_BYTES = 10737418240
+    COMPACT_INTERVAL = 60
+    COMPACT_RATIO = 0.5
+    
+    MAGIC = "KS"
+    ENTRY = 0
+    TOMBSTONE = 1
+    TOUCH = 2
+    HEADER = struct.Struct('!2sBIIQdI')
+    SEGMENT_NAME = "segment-%08d.dat"
+    SEGMENT_PATTERN = re.compile(r'^segment-(\d{8})\.dat$')
+    
+    __path = None
+    __segmentSize = SEGMENT_SIZE
+    __maxBytes = MAX_BYTES
+    __compactInterval = COMPACT_INTERVAL
+    __compactRatio = COMPACT_RATIO
+    __lock = None
+    __index = None
+    __tombstones = None
+    __segments = None
+    __activeId = None
+    __offset = 0
+    __stopping = False
+    __stats = None
+    
+    def __init__(self, path, segmentsize = None, maxbytes = None, compact = None, ratio = None):
+        self.__path = path
+        self.__segmentSize = segmentsize or self.SEGMENT_SIZE
+        self.__maxBytes = maxbytes or self.MAX_BYTES
+        self.__compactInterval = compact or self.COMPACT_INTERVAL
+        self.__compactRatio = ratio or self.COMPACT_RATIO
+        self.__lock = threading.RLock()
+        self.__index = {}
+        self.__tombstones = {}
+        self.__segments = {}
+        self.__stats = {'hits': 0, 'misses': 0, 'writes': 0, 'compactions': 0, 'dropped': 0}
+        
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.__load()
+        
+        t = threading.Thread(target = self.__compactLoop)
+        t.daemon = True
+        t.start()
+    
+    
+    def delete(self, key):
+        with self.__lock:
+            if self.__index.pop(key, None):
+                self.__tombstones[key] = self.__append(key, '', '', 0, self.TOMBSTONE)[0]
+    
+    
+    def get(self, key):
+        with self.__lock:
+            location = self.__index.get(key)
+            if not location:
+                self.__stats['misses'] += 1
+                return None
+            
+            metaSegmentId, metaOffset, metaLength, bodySegmentId, bodyOffset, bodyLength, expiresAt = location
+            if expiresAt and expiresAt < time.time():
+                self.__expire(key, location)
+                self.__stats['misses'] += 1
+                return None
+            
+            metaSegment = self.__segments[metaSegmentId]
+            bodySegment = self.__segments[bodySegmentId]
+            self.__stats['hits'] += 1
+        
+        # The body stays in the page cache; the buffer keeps the mapping
+        # alive even if compaction drops the segment meanwhile.
+        meta = codec.loads(metaSegment[metaOffset:metaOffset + metaLength])
+        return (buffer(bodySegment, bodyOffset, bodyLength), ) + tuple(meta)
+    
+    
+    def getKeys(self):
+        now = time.time()
+        with self.__lock:
+            return [key for key, location in self.__index.iteritems() if not location[6] or location[6] > now]
+    
+    
+    def getStats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['entries'] = len(self.__index)
+            stats['segments'] = len(self.__segments)
+            stats['bytes'] = sum(location[5] for location in self.__index.itervalues())
+        return stats
+    
+    
+    def getTimeToLive(self, key):
+        location = self.__index.get(key)
+        if not location:
+            return None
+        if not location[6]:
+            return 0
+        timeToLive = location[6] - time.time()
+        return timeToLive if timeToLive > 0 else None
+    
+    
+    def set(self, key, value, expire = 0):
+        body, meta = value[0], codec.dumps(tuple(value[1:]))
+        expiresAt = (time.time() + expire) if expire else 0
+        with self.__lock:
+            self.__index[key] = self.__append(key, meta, body, expiresAt, self.ENTRY)
+            self.__tombstones.pop(key, None)
+            self.__stats['writes'] += 1
+        return True
+    
+    
+    def stop(self):
+        self.__stopping = True
+    
+    
+    def touch(self, key, value, expire = 0):
+        meta = codec.dumps(tuple(value))
+        expiresAt = (time.time() + expire) if expire else 0
+        with self.__lock:
+            location = self.__index.get(key)
+            if not location:
+                return False
+            
+            # The new record carries only the metadata; the index keeps
+            # pointing at the body already on disk.
+            touched = self.__append(key, meta, '', expiresAt, self.TOUCH)
+            if location[3] not in self.__segments:
+                self.__index.pop(key, None)
+                return False
+            self.__index[key] = touched[:3] + location[3:6] + (expiresAt, )
+        return True
+    
+    
+    def __append(self, key, meta, body, expiresAt, flags):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        
+        length = self.HEADER.size + len(key) + len(meta) + len(body)
+        if self.__activeId is None or self.__offset + length > self.__segmentSize:
+            self.__roll(length)
+        
+        segment = self.__segments[self.__activeId]
+        offset = self.__offset
+        crc = zlib.crc32(body, zlib.crc32(meta, zlib.crc32(key))) & 0xffffffff
+        header = self.HEADER.pack(self.MAGIC, flags, len(key), len(meta), len(body), expiresAt, crc)
+        
+        position = offset
+        for part in (header, key, meta, body):
+            segment[position:position + len(part)] = part
+            position += len(part)
+        self.__offset = position
+        
+        metaOffset = offset + self.HEADER.size + len(key)
+        return self.__activeId, metaOffset, len(meta), self.__activeId, metaOffset + len(meta), len(body), expiresAt
+    
+    
+    def __compact(self):
+        now = time.time()
+        with self.__lock:
+            live = dict((segmentId, 0) for segmentId in self.__segments)
+            for key, location in self.__index.items():
+                if location[6] and location[6] < now:
+                    self.__expire(key, location)
+                    continue
+                live[location[3]] += location[5]
+            candidates = [segmentId for segmentId, size in live.iteritems() if segmentId != self.__activeId and size < self.__segmentSize * self.__compactRatio]
+        
+        for segmentId in sorted(candidates):
+            self.__compactSegment(segmentId)
+    
+    
+    def __compactLoop(self):
+        while not self.__stopping:
+            time.sleep(self.__compactInterval)
+            try:
+                self.__compact()
+            except Exception:
+                logging.exception("Failed to compact disk cache segments")
+    
+    
+    def __compactSegment(self, segmentId):
+        moved = 0
+        with self.__lock:
+            if segmentId not in self.__segments:
+                return
+            
+            # Moving entries may roll over and drop the oldest segment,
+            # which takes its entries out of the index as well.
+            for key, location in self.__index.items():
+                if segmentId not in (location[0], location[3]) or self.__index.get(key) is not location:
+                    continue
+                
+                metaSegmentId, metaOffset, metaLength, bodySegmentId, bodyOffset, bodyLength, expiresAt = location
+                meta = self.__segments[metaSegmentId][metaOffset:metaOffset + metaLength]
+                body = self.__segments[bodySegmentId][bodyOffset:bodyOffset + bodyLength]
+                self.__index[key] = self.__append(key, meta, body, expiresAt, self.ENTRY)
+                moved += 1
+            
+            # A tombstone has to outlive every older segment, which may
+            # still hold the record it deletes and would bring it back
+            # when the index is rebuilt.
+            for key, tombstoneId in self.__tombstones.items():
+                if tombstoneId != segmentId or self.__tombstones.get(key) != segmentId:
+                    continue
+                if self.__segments and min(self.__segments) < segmentId:
+                    self.__tombstones[key] = self.__append(key, '', '', 0, self.TOMBSTONE)[0]
+                else:
+                    del self.__tombstones[key]
+            
+            self.__dropSegment(segmentId)
+            self.__stats['compactions'] += 1
+        logging.info("Compacted disk cache segment %s, moved %s live entries" % (segmentId, moved))
+    
+    
+    def __dropSegment(self, segmentId):
+        # The mapping itself is released once no served buffer refers to it
+        if self.__segments.pop(segmentId, None) is None:
+            return
+        try:
+            os.unlink(self.__getSegmentPath(segmentId))
+        except OSError, e:
+            logging.error("Failed to remove disk cache segment %s: %s" % (segmentId, e))
+        
+        for key, location in self.__index.items():
+            if segmentId in (location[0], location[3]):
+                del self.__index[key]
+                self.__stats['dropped'] += 1
+        
+        # Only the oldest segment is ever dropped with tombstones still in
+        # it, and no older record is left for them to delete.
+        for key, tombstoneId in self.__tombstones.items():
+            if tombstoneId == segmentId:
+                del self.__tombstones[key]
+    
+    
+    def __expire(self, key, location):
+        # The expired record shadows older copies on disk until it is
+        # compacted away, so it is remembered like a tombstone.
+        self.__index.pop(key, None)
+        self.__tombstones[key] = location[0]
+    
+    
+    def __getSegmentPath(self, segmentId):
+        return os.path.join(self.__path, self.SEGMENT_NAME % segmentId)
+    
+    
+    def __load(self):
+        start = time.time()
+        segmentIds = []
+        for name in os.listdir(self.__path):
+            match = self.SEGMENT_PATTERN.match(name)
+            if match:
+                segmentIds.append(int(match.group(1)))
+        
+        for segmentId in sorted(segmentIds):
+            self.__segments[segmentId] = self.__openSegment(segmentId)
+            self.__offset = self.__scanSegment(segmentId)
+            self.__activeId = segmentId
+        
+        logging.info("Loaded disk cache index of %s entries from %s segments in %.2fs" % (len(self.__index), len(segmentIds), time.time() - start))
+    
+    
+    def __openSegment(self, segmentId):
+        with open(self.__getSegmentPath(segmentId), 'a+b') as f:
+            f.truncate(self.__segmentSize)
+            return mmap.mmap(f.fileno(), self.__segmentSize)
+    
+    
+    def __roll(self, length):
+        if length > self.__segmentSize:
+            raise ValueError("Entry of %s bytes does not fit in a disk cache segment" % length)
+        
+        # Whole segments are the unit of eviction once the tier is full
+        while self.__segments and (len(self.__segments) + 1) * self.__segmentSize > self.__maxBytes:
+            self.__dropSegment(min(self.__segments))
+        
+        self.__activeId = (self.__activeId + 1) if self.__activeId is not None else 0
+        self.__segments[self.__activeId] = self.__openSegment(self.__activeId)
+        self.__offset = 0
+    
+    
+    def __scanSegment(self, segmentId):
+        segment = self.__segments[segmentId]
+        now = time.time()
+        offset = 0
+        while offset + self.HEADER.size <= self.__segmentSize:
+            magic, flags, keyLength, metaLength, bodyLength, expiresAt, crc = self.HEADER.unpack_from(segment, offset)
+            end = offset + self.HEADER.size + keyLength + metaLength + bodyLength
+            if magic != self.MAGIC or end > self.__segmentSize:
+                break
+            
+            keyOffset = offset + self.HEADER.size
+            metaOffset = keyOffset + keyLength
+            key = segment[keyOffset:metaOffset]
+            meta = segment[metaOffset:metaOffset + metaLength]
+            
+            # The checksum covers the body too, which may not have reached
+            # the disk when the header did.
+            body = buffer(segment, metaOffset + metaLength, bodyLength)
+            if zlib.crc32(body, zlib.crc32(meta, zlib.crc32(key))) & 0xffffffff != crc:
+                logging.warning("Disk cache segment %s is torn at offset %s" % (segmentId, offset))
+                break
+            
+            # Later records supersede earlier ones, including tombstones
+            if flags == self.TOMBSTONE or (expiresAt and expiresAt < now):
+                self.__index.pop(key, None)
+                self.__tombstones[key] = segmentId
+            elif flags == self.TOUCH:
+                location = self.__index.get(key)
+                if location:
+                    self.__index[key] = (segmentId, metaOffset, metaLength) + location[3:6] + (expiresAt, )
+            else:
+                self.__index[key] = segmentId, metaOffset, metaLength, segmentId, metaOffset + metaLength, bodyLength, expiresAt
+                self.__tombstones.pop(key, None)
+            offset = end
+        return offset
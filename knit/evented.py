@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.evented
+# 
+# Module containing a single threaded, non-blocking HTTP front end for
+# the proxy. Client and origin sockets are multiplexed on one asyncore
+# loop, so slow clients and slow origin fetches only cost a socket each.
+
+import asynchat
+import asyncore
+import logging
+import os
+import socket
+import threading
+import urllib
+import Queue
+
+
+class EventedProxyServer(asyncore.dispatcher):
+    CONNECTION_BACKLOG = 1024
+    
+    __proxy = None
+    __backendAddress = None
+    __inflight = None
+    __trigger = None
+    
+    def __init__(self, proxy, backend, address):
+        asyncore.dispatcher.__init__(self)
+        self.__proxy = proxy
+        self.__inflight = {}
+        self.__trigger = LoopTrigger()
+        
+        # Resolve the backend once; name lookups would otherwise block the loop.
+        info = socket.getaddrinfo(backend['host'], backend['port'], socket.AF_INET, socket.SOCK_STREAM)
+        self.__backendAddress = info[0][4]
+        
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(self.CONNECTION_BACKLOG)
+    
+    
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error, e:
+            logging.error("Failed to accept connection: %s" % e)
+            return
+        
+        if pair:
+            sock, remoteAddress = pair
+            ClientConnection(self, sock, remoteAddress)
+    
+    
+    def handleRequest(self, client, environ):
+        statsResponse = self.__proxy.getStatsResponse(environ)
+        if statsResponse:
+            status, responseHeaders, body = statsResponse
+            client.sendResponse(status, responseHeaders)
+            client.sendBody(body)
+            client.finish()
+            return
+        
+        # Lookups that may go to other nodes block, so the loop only looks
+        # in the local cache and hands misses to a thread of their own.
+        client.ranges = self.__proxy.getRangeFilter(environ)
+        cacheKey, responseParts = self.__proxy.lookupCacheEntry(environ, fetch = False)
+        if not responseParts and cacheKey and cacheKey not in self.__inflight and self.__proxy.hasRemoteLookups():
+            t = threading.Thread(target = self.__lookupRemotely, args = (client, environ, cacheKey))
+            t.daemon = True
+            t.start()
+            return
+        
+        self.__respond(client, environ, cacheKey, responseParts)
+    
+    
+    def releaseFetch(self, cacheKey, fetch):
+        if cacheKey and self.__inflight.get(cacheKey) is fetch:
+            del self.__inflight[cacheKey]
+    
+    
+    def serveForever(self):
+        asyncore.loop(use_poll = True)
+    
+    
+    def __lookupRemotely(self, client, environ, cacheKey):
+        try:
+            cacheKey, responseParts = self.__proxy.lookupCacheEntry(environ)
+        except Exception:
+            logging.exception("Failed to look up key %s" % cacheKey)
+            responseParts = None
+        self.__trigger.call(self.__respond, client, environ, cacheKey, responseParts)
+    
+    
+    def __respond(self, client, environ, cacheKey, responseParts):
+        if responseParts:
+            body, status, responseHeaders = responseParts[:3]
+            client.sendResponse(status, responseHeaders)
+            client.sendBody(body)
+            client.finish()
+            return
+        
+        fetch = self.__inflight.get(cacheKey) if cacheKey else None
+        if fetch and fetch.attach(client):
+            return
+        
+        # A range passed on to the backend is only of use to this client
+        method, path, headers = self.__proxy.getBackendRequest(environ)
+        fetch = OriginConnection(self, self.__proxy, self.__backendAddress, cacheKey, method, path, headers)
+        fetch.attach(client)
+        if cacheKey and 'Range' not in headers:
+            self.__inflight[cacheKey] = fetch
+
+
+class LoopTrigger(asyncore.file_dispatcher):
+    # Runs calls handed over by other threads on the loop thread, which a
+    # write to the pipe wakes up.
+    __calls = None
+    __wakeWrite = None
+    
+    def __init__(self):
+        wakeRead, self.__wakeWrite = os.pipe()
+        asyncore.file_dispatcher.__init__(self, wakeRead)
+        os.close(wakeRead)
+        self.__calls = Queue.Queue()
+    
+    
+    def call(self, fn, *args):
+        self.__calls.put((fn, args))
+        os.write(self.__wakeWrite, "x")
+    
+    
+    def handle_read(self):
+        self.recv(4096)
+        while True:
+            try:
+                fn, args = self.__calls.get_nowait()
+            except Queue.Empty:
+                break
+            
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception("Failed to run call on the loop")
+    
+    
+    def writable(self):
+        return False
+
+
+class ClientConnection(asynchat.async_chat):
+    MAX_HEADER_SIZE = 65536
+    TERMINATOR = "\r\n\r\n"
+    
+    ac_out_buffer_size = 65536
+    
+    __server = None
+    __remoteAddress = None
+    __incoming = None
+    environ = None
+    ranges = None
+    
+    def __init__(self, server, sock, remoteAddress):
+        asynchat.async_chat.__init__(self, sock)
+        self.__server = server
+        self.__remoteAddress = remoteAddress
+        self.__incoming = []
+        self.set_terminator(self.TERMINATOR)
+    
+    
+    def collect_incoming_data(self, data):
+        self.__incoming.append(data)
+        if sum(len(part) for part in self.__incoming) > self.MAX_HEADER_SIZE:
+            self.sendError("431 Request Header Fields Too Large")
+    
+    
+    def found_terminator(self):
+        # Request bodies are not forwarded to the backend, so stop reading.
+        self.set_terminator(None)
+        self.collect_incoming_data = lambda data: None
+        
+        try:
+            self.environ = self.__parseRequest(''.join(self.__incoming))
+        except ValueError:
+            self.sendError("400 Bad Request")
+            return
+        
+        self.__incoming = []
+        self.__server.handleRequest(self, self.environ)
+    
+    
+    def finish(self):
+        if self.connected:
+            self.close_when_done()
+    
+    
+    def getPendingWrites(self):
+        if not self.connected:
+            return 0
+        return len(self.producer_fifo)
+    
+    
+    def handle_error(self):
+        logging.exception("Error on client connection from %s:%s" % self.__remoteAddress)
+        self.close()
+    
+    
+    def sendBody(self, chunk):
+        if not chunk or not self.connected:
+            return
+        
+        pieces = self.ranges.write(chunk) if self.ranges else (chunk, )
+        for piece in pieces:
+            # Mapped bodies from the disk tier and ranges cut from bodies
+            # go out as slices, without being copied into strings first.
+            if isinstance(piece, buffer):
+                self.push_with_producer(BufferProducer(piece, self.ac_out_buffer_size))
+            else:
+                self.push(piece)
+    
+    
+    def sendError(self, status):
+        self.sendResponse(status, [('Content-Length', '0')])
+        self.finish()
+    
+    
+    def sendResponse(self, status, responseHeaders):
+        if not self.connected:
+            return
+        
+        if self.ranges:
+            status, responseHeaders = self.ranges.start(status, responseHeaders)
+        
+        lines = ["HTTP/1.1 %s" % status]
+        lines.extend("%s: %s" % header for header in responseHeaders)
+        lines.append("Connection: close")
+        self.push("\r\n".join(lines) + self.TERMINATOR)
+    
+    
+    def __parseRequest(self, data):
+        lines = data.split("\r\n")
+        method, uri, protocol = lines[0].split(" ", 2)
+        path, _, query = uri.partition("?")
+        
+        # The raw URI is what goes to the backend; the decoded path is only
+        # used to match rules and build cache keys.
+        environ = {
+            'REQUEST_METHOD': method,
+            'RAW_URI': uri,
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': self.__remoteAddress[0],
+            'wsgi.url_scheme': 'http',
+        }
+        
+        for line in lines[1:]:
+            if not line:
+                continue
+            key, value = line.split(":", 1)
+            key = key.strip().upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = "HTTP_%s" % key
+            environ[key] = value.strip()
+        
+        return environ
+
+
+class BufferProducer(object):
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.offset = 0
+    
+    def more(self):
+        if self.offset >= len(self.data):
+            return ''
+        chunk = buffer(self.data, self.offset, self.size)
+        self.offset += self.size
+        return chunk
+
+
+class OriginConnection(asynchat.async_chat):
+    MAX_PENDING_WRITES = 16
+    TERMINATOR = "\r\n\r\n"
+    
+    __server = None
+    __proxy = None
+    __address = None
+    __cacheKey = None
+    __finished = False
+    __clients = None
+    __incoming = None
+    __prefix = None
+    __buffer = None
+    __timeout = -1
+    __status = None
+    __responseHeaders = None
+    
+    def __init__(self, server, proxy, address, cacheKey, method, path, headers):
+        asynchat.async_chat.__init__(self)
+        self.__server = server
+        self.__proxy = proxy
+        self.__address = address
+        self.__cacheKey = cacheKey
+        self.__clients = []
+        self.__incoming = []
+        self.__prefix = []
+        self.ac_in_buffer_size = proxy.getStreamChunkSize()
+        
+        # HTTP/1.0 keeps the origin from using chunked transfer encoding;
+        # the body simply runs until the origin closes the connection.
+        lines = ["%s %s HTTP/1.0" % (method, path)]
+        lines.extend("%s: %s" % header for header in headers.iteritems())
+        lines.append("Connection: close")
+        self.push("\r\n".join(lines) + self.TERMINATOR)
+        
+        self.set_terminator(self.TERMINATOR)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+    
+    
+    def attach(self, client):
+        # Late joiners replay what has been received so far, which is only
+        # possible while the whole body is still being buffered for caching.
+        if self.__status and self.__prefix is None:
+            return False
+        
+        self.__clients.append(client)
+        if self.__status:
+            client.sendResponse(self.__status, self.__responseHeaders)
+            for chunk in self.__prefix:
+                client.sendBody(chunk)
+        return True
+    
+    
+    def collect_incoming_data(self, data):
+        if not self.__status:
+            self.__incoming.append(data)
+            return
+        
+        if self.__buffer and not self.__buffer.write(data):
+            logging.debug("Response for key %s exceeds max cacheable size" % self.__cacheKey)
+            self.__detach()
+        
+        if self.__prefix is not None:
+            self.__prefix.append(data)
+        
+        for client in self.__clients:
+            client.sendBody(data)
+    
+    
+    def found_terminator(self):
+        lines = ''.join(self.__incoming).split("\r\n")
+        self.__incoming = []
+        
+        version, status = lines[0].split(" ", 1)
+        headers = []
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers.append((key.strip(), value.strip()))
+        
+        self.__status = status
+        self.__responseHeaders = self.__proxy.getResponseHeaders(headers)
+        if status.startswith('5') and self.__serveFallback():
+            return
+        
+        environ = self.__clients[0].environ if self.__clients else None
+        self.__buffer, self.__timeout = self.__proxy.openCacheBuffer(self.__cacheKey, status, self.__responseHeaders, environ)
+        
+        # Responses that may not be cached under the coalesced key are not
+        # shared; send any coalesced clients back to the origin on their own,
+        # still caching their response if this one varies.
+        clients, self.__clients = self.__clients[:1], self.__clients[1:]
+        if not self.__buffer or self.__buffer.cacheKey != self.__cacheKey:
+            self.__server.releaseFetch(self.__cacheKey, self)
+            self.__prefix = None
+            cacheKey = self.__cacheKey if self.__buffer else None
+            for client in self.__clients:
+                method, path, headers = self.__proxy.getBackendRequest(client.environ)
+                OriginConnection(self.__server, self.__proxy, self.__address, cacheKey, method, path, headers).attach(client)
+        else:
+            clients.extend(self.__clients)
+        self.__clients = clients
+        
+        for client in self.__clients:
+            client.sendResponse(self.__status, self.__responseHeaders)
+        
+        self.set_terminator(None)
+    
+    
+    def handle_close(self):
+        if self.__finished:
+            return
+        self.__finished = True
+        
+        if not self.__status:
+            if not self.__serveFallback():
+                for client in self.__clients:
+                    client.sendError("502 Bad Gateway")
+        else:
+            if self.__buffer:
+                self.__proxy.commitCacheBuffer(self.__cacheKey, self.__buffer, self.__status, self.__responseHeaders, self.__timeout)
+            for client in self.__clients:
+                client.finish()
+        
+        self.__server.releaseFetch(self.__cacheKey, self)
+        self.close()
+    
+    
+    def handle_error(self):
+        logging.exception("Error fetching %s from backend" % self.__cacheKey)
+        self.__buffer = None
+        self.handle_close()
+    
+    
+    def readable(self):
+        for client in self.__clients:
+            if client.getPendingWrites() > self.MAX_PENDING_WRITES:
+                return False
+        return asynchat.async_chat.readable(self)
+    
+    
+    def __detach(self):
+        self.__buffer = None
+        self.__prefix = None
+        self.__server.releaseFetch(self.__cacheKey, self)
+    
+    
+    def __serveFallback(self):
+        # Clients waiting on a failed fetch get the last good copy instead,
+        # when one may still be served.
+        if not self.__clients or not self.__proxy.getFallbackEntry(self.__cacheKey, self.__clients[0].environ):
+            return False
+        
+        logging.warning("Serving stale key %s after backend failure" % self.__cacheKey)
+        for client in self.__clients:
+            responseParts = self.__proxy.getFallbackEntry(self.__cacheKey, client.environ)
+            if not responseParts:
+                client.sendError("502 Bad Gateway")
+                continue
+            body, status, responseHeaders = responseParts
+            client.sendResponse(status, responseHeaders)
+            client.sendBody(body)
+            client.finish()
+        
+        self.__clients = []
+        self.__buffer = None
+        self.__prefix = None
+        self.__finished = True
+        self.set_terminator(None)
+        self.__server.releaseFetch(self.__cacheKey, self)
+        self.close()
+        return True
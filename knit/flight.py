@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.flight
+# 
+# Module containing components for coalescing concurrent backend
+# fetches of the same cache key into a single request.
+
+import threading
+import Queue
+
+
+class Flight(object):
+    RESPONSE = 'response'
+    CHUNK = 'chunk'
+    DONE = 'done'
+    FAILED = 'failed'
+    
+    __lock = None
+    __joinable = True
+    __finished = False
+    __events = None
+    __subscribers = None
+    
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__events = []
+        self.__subscribers = []
+    
+    
+    def abandon(self):
+        self.__publish((self.FAILED, ), final = True)
+    
+    
+    def complete(self):
+        self.__publish((self.DONE, ), final = True)
+    
+    
+    def detach(self):
+        with self.__lock:
+            self.__joinable = False
+            self.__events = []
+    
+    
+    def hasSubscribers(self):
+        with self.__lock:
+            return bool(self.__subscribers)
+    
+    
+    def join(self):
+        with self.__lock:
+            if not self.__joinable:
+                return None
+            
+            queue = Queue.Queue()
+            for event in self.__events:
+                queue.put(event)
+            
+            if not self.__finished:
+                self.__subscribers.append(queue)
+            return queue
+    
+    
+    def publishChunk(self, chunk):
+        self.__publish((self.CHUNK, chunk))
+    
+    
+    def publishResponse(self, status, headers):
+        self.__publish((self.RESPONSE, status, headers))
+    
+    
+    def __publish(self, event, final = False):
+        with self.__lock:
+            if self.__finished:
+                return
+            
+            if self.__joinable:
+                self.__events.append(event)
+            
+            for queue in self.__subscribers:
+                queue.put(event)
+            
+            if final:
+                self.__finished = True
+                self.__subscribers = []
+
+
+class FlightGroup(object):
+    __lock = None
+    __flights = None
+    
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__flights = {}
+    
+    
+    def begin(self, key):
+        with self.__lock:
+            flight = self.__flights.get(key)
+            if flight:
+                return flight, False
+            
+            flight = Flight()
+            self.__flights[key] = flight
+            return flight, True
+    
+    
+    def end(self, key, flight):
+        with self.__lock:
+            if self.__flights.get(key) is flight:
+                del self.__flights[key]
+    
+    
+    def isInFlight(self, key):
+        with self.__lock:
+            return key in self.__flights
+
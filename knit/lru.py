@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.lru
+# 
+# Module containing Knit's native in-process cache backend, an LRU
+# bounded by the total size of its entries in bytes. Keys are spread
+# over independently locked shards so concurrent requests rarely
+# contend, and expired entries are reaped in the background.
+
+import threading
+import time
+import codec
+
+
+class LRUShard(object):
+    # Entries are [prev, next, key, value, expiresAt, size] links of a
+    # circular list kept in recency order; collections.OrderedDict is
+    # pure Python here and several times slower.
+    __lock = None
+    __links = None
+    __root = None
+    __maxBytes = 0
+    __bytes = 0
+    
+    def __init__(self, maxBytes):
+        self.__lock = threading.Lock()
+        self.__links = {}
+        self.__root = []
+        self.__root[:] = [self.__root, self.__root, None, None, 0, 0]
+        self.__maxBytes = maxBytes
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'rejected': 0}
+    
+    def delete(self, key):
+        with self.__lock:
+            self.__remove(key)
+    
+    def get(self, key):
+        with self.__lock:
+            link = self.__links.get(key)
+            if not link:
+                self.stats['misses'] += 1
+                return None
+            
+            if link[4] and link[4] < time.time():
+                self.__remove(key)
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+            
+            # Move the link to the most recently used end, before the root
+            prev, next = link[0], link[1]
+            prev[1] = next
+            next[0] = prev
+            root = self.__root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            
+            self.stats['hits'] += 1
+            return link[3]
+    
+    def getBytes(self):
+        return self.__bytes
+    
+    def getKeys(self):
+        now = time.time()
+        with self.__lock:
+            return [key for key, link in self.__links.iteritems() if not link[4] or link[4] > now]
+    
+    def getSize(self):
+        return len(self.__links)
+    
+    def getTimeToLive(self, key):
+        with self.__lock:
+            link = self.__links.get(key)
+            if not link:
+                return None
+            expiresAt = link[4]
+        if not expiresAt:
+            return 0
+        timeToLive = expiresAt - time.time()
+        return timeToLive if timeToLive > 0 else None
+    
+    def reap(self):
+        now = time.time()
+        with self.__lock:
+            expired = [key for key, link in self.__links.iteritems() if link[4] and link[4] < now]
+            for key in expired:
+                self.__remove(key)
+            self.stats['expirations'] += len(expired)
+        return len(expired)
+    
+    def set(self, key, value, expire = 0):
+        size = codec.sizeof(key) + codec.sizeof(value)
+        with self.__lock:
+            self.__remove(key)
+            if size > self.__maxBytes:
+                self.stats['rejected'] += 1
+                return False
+            
+            root = self.__root
+            last = root[0]
+            link = [last, root, key, value, (time.time() + expire) if expire else 0, size]
+            last[1] = root[0] = self.__links[key] = link
+            self.__bytes += size
+            
+            while self.__bytes > self.__maxBytes:
+                self.__remove(root[1][2])
+                self.stats['evictions'] += 1
+            return True
+    
+    def __remove(self, key):
+        link = self.__links.pop(key, None)
+        if link:
+            prev, next = link[0], link[1]
+            prev[1] = next
+            next[0] = prev
+            self.__bytes -= link[5]
+
+
+class ShardedLRUCache(object):
+    SHARDS = 16
+    MAX_BYTES = 268435456
+    REAP_INTERVAL = 30
+    
+    __shards = None
+    __reapInterval = REAP_INTERVAL
+    __reaper = None
+    __stopping = False
+    
+    def __init__(self, maxbytes = None, shards = None, reap = None):
+        maxBytes = maxbytes or self.MAX_BYTES
+        count = shards or self.SHARDS
+        self.__shards = [LRUShard(maxBytes / count) for i in xrange(count)]
+        self.__reapInterval = reap or self.REAP_INTERVAL
+        
+        self.__reaper = threading.Thread(target = self.__reap)
+        self.__reaper.daemon = True
+        self.__reaper.start()
+    
+    
+    def delete(self, key):
+        self.__getShard(key).delete(key)
+    
+    
+    def get(self, key):
+        return self.__getShard(key).get(key)
+    
+    
+    def getKeys(self):
+        keys = []
+        for shard in self.__shards:
+            keys.extend(shard.getKeys())
+        return keys
+    
+    
+    def getStats(self):
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'rejected': 0, 'bytes': 0, 'entries': 0}
+        for shard in self.__shards:
+            for name, count in shard.stats.iteritems():
+                stats[name] += count
+            stats['bytes'] += shard.getBytes()
+            stats['entries'] += shard.getSize()
+        return stats
+    
+    
+    def getTimeToLive(self, key):
+        return self.__getShard(key).getTimeToLive(key)
+    
+    
+    def set(self, key, value, expire = 0):
+        return self.__getShard(key).set(key, value, expire)
+    
+    
+    def stop(self):
+        self.__stopping = True
+    
+    
+    def __getShard(self, key):
+        return self.__shards[hash(key) % len(self.__shards)]
+    
+    
+    def __reap(self):
+        while not self.__stopping:
+            time.sleep(self.__reapInterval)
+            for shard in self.__shards:
+                shard.reap()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.membership
+# 
+# Module containing a gossip based membership table for the mesh. Every
+# node bumps its own heartbeat each round and exchanges its table with a
+# few random peers; a node whose heartbeat stops advancing is suspected
+# and later declared dead, and that verdict spreads the same way.
+
+import threading
+import time
+
+
+class Membership(object):
+    ALIVE = 'alive'
+    SUSPECT = 'suspect'
+    DEAD = 'dead'
+    
+    SUSPECT_TIMEOUT = 5
+    DEAD_TIMEOUT = 15
+    FORGOTTEN_TIMEOUT = 3600
+    
+    # At equal heartbeats the more severe state wins
+    SEVERITY = {ALIVE: 0, SUSPECT: 1, DEAD: 2}
+    
+    __lock = None
+    __localToken = None
+    __members = None
+    __forgotten = None
+    __suspectTimeout = SUSPECT_TIMEOUT
+    __deadTimeout = DEAD_TIMEOUT
+    
+    def __init__(self, localToken, localAddress, suspect = None, dead = None):
+        self.__lock = threading.Lock()
+        self.__localToken = localToken
+        self.__suspectTimeout = suspect or self.SUSPECT_TIMEOUT
+        self.__deadTimeout = dead or self.DEAD_TIMEOUT
+        self.__members = {}
+        self.__forgotten = {}
+        self.__members[localToken] = Member(tuple(localAddress), 0, self.ALIVE)
+    
+    
+    def alive(self, token, address):
+        with self.__lock:
+            member = self.__members.get(token)
+            if not member:
+                self.__members[token] = Member(tuple(address), 0, self.ALIVE)
+                return
+            
+            member.setState(self.ALIVE)
+            member.seen()
+    
+    
+    def getDigest(self):
+        with self.__lock:
+            return [(token, member.address, member.heartbeat, member.state) for token, member in self.__members.iteritems()]
+    
+    
+    def getPeers(self):
+        with self.__lock:
+            return [token for token, member in self.__members.iteritems() if token != self.__localToken and member.state != self.DEAD]
+    
+    
+    def getStats(self):
+        stats = {self.ALIVE: 0, self.SUSPECT: 0, self.DEAD: 0}
+        with self.__lock:
+            for token, member in self.__members.iteritems():
+                stats[member.state] += 1
+        return stats
+    
+    
+    def isAvailable(self, token):
+        with self.__lock:
+            member = self.__members.get(token)
+            return bool(member) and member.state == self.ALIVE
+    
+    
+    def kill(self, token):
+        with self.__lock:
+            member = self.__members.get(token)
+            if member and token != self.__localToken:
+                member.setState(self.DEAD)
+    
+    
+    def merge(self, digest):
+        joined = []
+        left = []
+        with self.__lock:
+            for token, address, heartbeat, state in digest:
+                if token == self.__localToken:
+                    self.__refute(heartbeat, state)
+                    continue
+                
+                member = self.__members.get(token)
+                if not member:
+                    # Lagging peers still gossip members that died here
+                    # before; only a newer heartbeat brings them back.
+                    forgotten = self.__forgotten.get(token)
+                    if forgotten and heartbeat <= forgotten[0]:
+                        continue
+                    if state != self.DEAD:
+                        self.__members[token] = Member(tuple(address), heartbeat, state)
+                        joined.append((token, tuple(address)))
+                    continue
+                
+                if heartbeat < member.heartbeat:
+                    continue
+                if heartbeat == member.heartbeat and self.SEVERITY[state] <= self.SEVERITY[member.state]:
+                    continue
+                
+                wasDead = member.state == self.DEAD
+                if heartbeat > member.heartbeat:
+                    member.seen()
+                member.heartbeat = heartbeat
+                
+                # Suspicion is local to each node; a peer's suspicion only
+                # matters once it is backed by a newer heartbeat.
+                if state == self.DEAD and not wasDead:
+                    member.setState(self.DEAD)
+                    left.append(token)
+                elif state != self.DEAD and wasDead:
+                    member.setState(self.ALIVE)
+                    joined.append((token, member.address))
+                elif state == self.ALIVE:
+                    member.setState(self.ALIVE)
+        return joined, left
+    
+    
+    def suspect(self, token):
+        with self.__lock:
+            member = self.__members.get(token)
+            if member and member.state == self.ALIVE and token != self.__localToken:
+                member.setState(self.SUSPECT)
+    
+    
+    def touch(self, token):
+        with self.__lock:
+            member = self.__members.get(token)
+            if member and member.state != self.DEAD:
+                member.seen()
+    
+    
+    def tick(self):
+        now = time.time()
+        dead = []
+        with self.__lock:
+            self.__members[self.__localToken].heartbeat += 1
+            
+            for token, member in self.__members.items():
+                if token == self.__localToken:
+                    continue
+                
+                silence = now - member.lastSeen
+                if member.state == self.DEAD:
+                    # Keep tombstones long enough to spread, then forget them
+                    if now - member.changed > self.__deadTimeout:
+                        del self.__members[token]
+                        self.__forgotten[token] = member.heartbeat, now
+                elif silence > self.__deadTimeout:
+                    member.setState(self.DEAD)
+                    dead.append(token)
+                elif silence > self.__suspectTimeout and member.state == self.ALIVE:
+                    member.setState(self.SUSPECT)
+            
+            for token, (heartbeat, forgottenAt) in self.__forgotten.items():
+                if now - forgottenAt > self.FORGOTTEN_TIMEOUT:
+                    del self.__forgotten[token]
+        return dead
+    
+    
+    def __refute(self, heartbeat, state):
+        # Another node believes this one is failing; outbid its view
+        local = self.__members[self.__localToken]
+        if state != self.ALIVE and heartbeat >= local.heartbeat:
+            local.heartbeat = heartbeat + 1
+
+
+class Member(object):
+    address = None
+    heartbeat = 0
+    state = None
+    lastSeen = 0
+    changed = 0
+    
+    def __init__(self, address, heartbeat, state):
+        self.address = address
+        self.heartbeat = heartbeat
+        self.state = state
+        self.lastSeen = self.changed = time.time()
+    
+    def seen(self):
+        self.lastSeen = time.time()
+        if self.state == Membership.SUSPECT:
+            self.setState(Membership.ALIVE)
+    
+    def setState(self, state):
+        self.state = state
+        self.changed = time.time()
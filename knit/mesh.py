@@ -5,46 +5,239 @@
 # Module containing components for building and comunicating
 # over a mesh network.
 
+import collections
+import errno
 import hashlib
+import os
 import time
 import random
+import select
 import socket
 import logging
-import yaml
-import base64
+import struct
 import threading
-import sys
+import itertools
 import Queue
 from simplecache import Cache
+from lru import ShardedLRUCache
+from shm import SharedMemoryCache
+from ring import HashRing
+from membership import Membership
+from warmup import WarmUp, getKeyDigest, hashKey
+from stats import getSamples, getStatsRegistry
+import codec
 
 
 class MeshCache(Cache):
+    POLL_INTERVAL = 0.05
+    PRUNE_INTERVAL = 1000
+    NATIVE_BACKENDS = {'ShardedLRUCache': ShardedLRUCache, 'SharedMemoryCache': SharedMemoryCache}
+    DISK_MIN_SIZE = 65536
+    
     def __init__(self, meshServer, backend, **config):
         self.meshServer = meshServer
-        Cache.__init__(self, backend, **config)
+        self.__expiries = {}
+        self.__writes = 0
+        self.__store = None
+        self.__disk = None
+        self.__diskMinSize = self.DISK_MIN_SIZE
+        self.__localCopies = False
+        if backend in self.NATIVE_BACKENDS:
+            self.__store = self.NATIVE_BACKENDS[backend](**config)
+        else:
+            Cache.__init__(self, backend, **config)
+    
+    def get(self, key, fetch = True):
+        value = self.__store.get(key) if self.__store else Cache.get(self, key)
+        if not value and self.__disk:
+            value = self.__disk.get(key)
+        if value or not fetch:
+            return value
+        
+        # Pull the entry from a peer that announced it, which is much
+        # cheaper than going back to the origin.
+        entry = self.meshServer.fetchCacheEntry(key)
+        if not entry:
+            return value
+        
+        # Nodes outside the key's owners route lookups without keeping
+        # a copy, so total capacity grows with the mesh.
+        value, expire = entry
+        if self.__localCopies or self.meshServer.isOwner(key):
+            self.__write(key, value, expire)
+        return value
+    
+    def evict(self, key):
+        if self.__disk:
+            self.__disk.delete(key)
+        self.__delete(key)
+    
+    def getDiskStats(self):
+        if not self.__disk:
+            return None
+        return self.__disk.getStats()
+    
+    def getKeys(self):
+        if self.__store:
+            keys = self.__store.getKeys()
+        else:
+            now = time.time()
+            keys = [key for key, expiresAt in self.__expiries.items() if not expiresAt or expiresAt > now]
+        
+        if self.__disk:
+            keys = list(set(keys).union(self.__disk.getKeys()))
+        return keys
+    
+    def getStats(self):
+        if not self.__store:
+            return None
+        return self.__store.getStats()
+    
+    def getTimeToLive(self, key):
+        if self.__disk:
+            timeToLive = self.__disk.getTimeToLive(key)
+            if timeToLive is not None:
+                return timeToLive
+        
+        if self.__store:
+            return self.__store.getTimeToLive(key)
+        expiresAt = self.__expiries.get(key)
+        if expiresAt is None:
+            return None
+        if not expiresAt:
+            return 0
+        timeToLive = expiresAt - time.time()
+        return timeToLive if timeToLive > 0 else None
+    
+    def waitForRemoteFetch(self, key, timeout):
+        if not self.meshServer.findRemoteFlight(key):
+            return None
+        
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            value = self.get(key)
+            if value:
+                return value
+            time.sleep(self.POLL_INTERVAL)
+        return None
     
     def set(self, key, value, expire = 0, replicate = True):
         if replicate:
             self.meshServer.replicateCacheEntry(key, value, expire)
+            if not self.__localCopies and not self.meshServer.isOwner(key):
+                return
+        return self.__write(key, value, expire)
+    
+    def touch(self, key, parts, expire = 0, replicate = True):
+        if replicate:
+            self.meshServer.touchCacheEntry(key, parts, expire)
+        
+        # Only the metadata changes; the stored body is reused as it is.
+        if self.__disk and self.__disk.touch(key, parts, expire):
+            return True
+        
+        value = self.get(key, fetch = False)
+        if not value:
+            return False
+        return self.__write(key, (value[0], ) + tuple(parts), expire)
+    
+    def setDiskTier(self, disk, minSize = None):
+        self.__disk = disk
+        self.__diskMinSize = minSize or self.DISK_MIN_SIZE
+    
+    def setLocalCopies(self, enabled):
+        # A host agent keeps whatever its workers fetched, owned or not,
+        # since every worker on the host reads from the same store.
+        self.__localCopies = enabled
+    
+    def __delete(self, key):
+        if self.__store:
+            return self.__store.delete(key)
+        self.__expiries.pop(key, None)
+        Cache.delete(self, key)
+    
+    def __setExpiry(self, key, expire):
+        self.__expiries[key] = (time.time() + expire) if expire else 0
+        
+        self.__writes += 1
+        if self.__writes % self.PRUNE_INTERVAL == 0:
+            now = time.time()
+            for indexedKey, expiresAt in self.__expiries.items():
+                if expiresAt and expiresAt < now:
+                    self.__expiries.pop(indexedKey, None)
+    
+    def __write(self, key, value, expire):
+        # Large bodies live only on disk and small ones only in memory,
+        # so neither tier can shadow a newer copy held by the other.
+        if self.__disk:
+            if len(value[0]) >= self.__diskMinSize:
+                self.__delete(key)
+                return self.__disk.set(key, value, expire)
+            if self.__disk.getTimeToLive(key) is not None:
+                self.__disk.delete(key)
+        
+        # The native store keeps its own expiry times
+        if self.__store:
+            return self.__store.set(key, value, expire)
+        self.__setExpiry(key, expire)
         return Cache.set(self, key, value, expire)
 
 
 
 class MeshServer(object):
-    SIG_STOP = 1
-    SOCKET_TIMEOUT = 1
     PORT_RANGE = 1000
+    WORKERS = 8
+    BACKLOG = 256
+    BACKPRESSURE_INTERVAL = 0.05
+    GOSSIP_INTERVAL = 1
+    GOSSIP_FANOUT = 2
     
     __token = None
     __localAddress = None
-    __nodes = {}
+    __nodes = None
     __sock = None
-    __controlQueue = None
     __cacheBackend = None
+    __flightGroup = None
+    __connectionSettings = None
+    __connections = None
+    __replicators = None
+    __replicationMode = 'push'
+    __directory = None
+    __directorySize = 100000
+    __directoryLock = None
+    __ring = None
+    __ringLock = None
+    __replicas = 0
+    __membership = None
+    __gossipInterval = GOSSIP_INTERVAL
+    __gossipFanout = GOSSIP_FANOUT
+    __gossipPending = None
+    __gossipStats = None
+    __gossipLock = None
+    __warmUp = None
+    __workerCount = WORKERS
+    __workQueue = None
+    __rearmQueue = None
+    __wakeRead = None
+    __wakeWrite = None
+    __stopping = False
     
     def __init__(self, port, queuedConnections):
+        self.__nodes = {}
+        self.__replicators = {}
+        self.__directory = collections.OrderedDict()
+        self.__directoryLock = threading.Lock()
+        self.__ring = HashRing([self.getServerToken()])
+        self.__ringLock = threading.Lock()
+        self.__connections = {}
+        self.__connectionSettings = {}
         self.__sock = self.__getServerSocket(port, queuedConnections)
-        self.__controlQueue = Queue.Queue()
+        self.__membership = Membership(self.getServerToken(), self.__localAddress)
+        self.__gossipPending = set()
+        self.__gossipStats = {'rounds': 0, 'exchanges': 0, 'failed': 0, 'bytes': 0}
+        self.__gossipLock = threading.Lock()
+        self.__rearmQueue = Queue.Queue()
+        self.__wakeRead, self.__wakeWrite = os.pipe()
     
     
     def discoverMesh(self, remoteAddress):
@@ -57,24 +250,169 @@ class MeshServer(object):
         return self.__nodes
     
     
+    def doAnnounceCacheEntries(self, clientNode, requestData):
+        logging.debug("Cache entry announcement from %s for %s keys" % (clientNode.getToken(), len(requestData)))
+        now = time.time()
+        with self.__directoryLock:
+            for key, digest, expire in requestData:
+                self.__directory.pop(key, None)
+                self.__directory[key] = clientNode.getToken(), digest, (now + expire) if expire else 0
+                if len(self.__directory) > self.__directorySize:
+                    self.__directory.popitem(last = False)
+    
+    
+    def doEcho(self, clientNode, requestData):
+        return requestData
+    
+    
+    def doFetchCacheEntry(self, clientNode, requestData):
+        # Entries expired but not yet reaped have no time to live left, and
+        # must not be handed out with 0, which means they never expire.
+        value = self.__cacheBackend.get(requestData, fetch = False)
+        timeToLive = self.__cacheBackend.getTimeToLive(requestData)
+        if not value or timeToLive is None:
+            return None
+        return value, timeToLive
+    
+    
+    def doFetchCacheEntries(self, clientNode, requestData):
+        keys, maxBytes = requestData
+        entries = []
+        size = 0
+        processed = 0
+        for key in keys:
+            if size >= maxBytes:
+                break
+            processed += 1
+            
+            value = self.__cacheBackend.get(key, fetch = False)
+            timeToLive = self.__cacheBackend.getTimeToLive(key)
+            if value and timeToLive is not None:
+                entries.append((key, value, timeToLive))
+                size += codec.sizeof(key) + codec.sizeof(value)
+        return processed, entries
+    
+    
+    def doGetBucketKeys(self, clientNode, requestData):
+        buckets, wanted = requestData
+        wanted = set(wanted)
+        return [key for key in self.__getKeysOwnedBy(clientNode.getToken()) if hashKey(key, buckets)[0] in wanted]
+    
+    
+    def doGetKeyDigest(self, clientNode, requestData):
+        return getKeyDigest(self.__getKeysOwnedBy(clientNode.getToken()), requestData)
+    
+    
     def doGetNodeList(self, clientNode, requestData):
         nodes = {}
-        for token, node in self.__nodes.iteritems():
+        for token, node in self.__nodes.items():
             if token != clientNode.getToken():
                 nodes[token] = node.getAddress()
         return nodes
     
     
+    def doGossip(self, clientNode, requestData):
+        self.__mergeMembership(requestData)
+        return self.__membership.getDigest()
+    
+    
+    def doQueryFlight(self, clientNode, requestData):
+        if not self.__flightGroup:
+            return False
+        return self.__flightGroup.isInFlight(requestData)
+    
+    
     def doRegisterNewServer(self, clientNode, requestData):
         self.__addNode(requestData, clientNode.getToken())
     
     
+    def doTouchCacheEntries(self, clientNode, requestData):
+        logging.debug("Cache entry refresh from %s for %s keys" % (clientNode.getToken(), len(requestData)))
+        for key, parts, expire in requestData:
+            self.__cacheBackend.touch(key, parts, expire, replicate = False)
+    
+    
+    def doUnregisterServer(self, clientNode, requestData):
+        self.__removeNode(clientNode.getToken())
+    
+    
     def doSaveCacheEntry(self, clientNode, requestData):
         key, value, expire = requestData
         logging.debug("Cache entry push from %s for key %s" % (clientNode.getToken(), key))
         self.__cacheBackend.set(key, value, expire, replicate = False)
     
     
+    def doSaveCacheEntries(self, clientNode, requestData):
+        logging.debug("Cache entry push from %s for %s keys" % (clientNode.getToken(), len(requestData)))
+        for key, value, expire in requestData:
+            self.__cacheBackend.set(key, value, expire, replicate = False)
+    
+    
+    def collectStats(self):
+        samples = getSamples('knit_mesh_membership', self.getMembershipStats())
+        for token, stats in self.getReplicationStats().iteritems():
+            samples.extend(getSamples('knit_mesh_replication', stats, {'peer': token}))
+        samples.extend(getSamples('knit_mesh_warmup', self.getWarmUpStats() or {}))
+        return samples
+    
+    
+    def fetchCacheEntry(self, key):
+        if self.__replicas:
+            return self.__fetchFromOwners(key)
+        return self.__fetchFromDirectory(key)
+    
+    
+    def findRemoteFlight(self, key):
+        for token, node in self.__nodes.items():
+            if not self.__membership.isAvailable(token):
+                continue
+            
+            try:
+                recvToken, recvAction, recvData = node.sendMessage("QueryFlight", key)
+            except socket.error, e:
+                logging.error("Failed to query %s for in-flight fetches: %s" % (token, e))
+                continue
+            
+            if recvData:
+                logging.debug("Node %s is already fetching key %s" % (token, key))
+                return node
+        return None
+    
+    
+    def getConnectionSettings(self):
+        return self.__connectionSettings
+    
+    
+    def getDigest(self, value):
+        return hashlib.sha1(codec.dumps(value)).hexdigest()
+    
+    
+    def getMembershipStats(self):
+        with self.__gossipLock:
+            stats = dict(self.__gossipStats)
+        stats.update(self.__membership.getStats())
+        return stats
+    
+    
+    def getOwners(self, key):
+        if not self.__replicas:
+            return list(self.__ring.getTokens())
+        return self.__ring.getOwners(key, self.__replicas)
+    
+    
+    def getReplicationStats(self):
+        stats = {}
+        for token, replicator in self.__replicators.items():
+            stats[token] = replicator.getStats()
+        return stats
+    
+    
+    def getWarmUpStats(self):
+        if not self.__warmUp:
+            return None
+        return self.__warmUp.getStats()
+    
+    
     def getServerAddress(self):
         return self.__localAddress
     
@@ -85,7 +423,20 @@ class MeshServer(object):
         return self.__token
     
     
+    def isOwner(self, key):
+        if not self.__replicas:
+            return True
+        return self.getServerToken() in self.__ring.getOwners(key, self.__replicas)
+    
+    
     def listen(self):
+        self.__workerCount = self.__connectionSettings.get('workers', self.WORKERS)
+        self.__workQueue = Queue.Queue(self.__connectionSettings.get('backlog', self.BACKLOG))
+        
+        gossip = threading.Thread(target = self.__gossip)
+        gossip.daemon = True
+        gossip.start()
+        
         t = threading.Thread(target = self.__daemon)
         t.daemon = True
         t.start()
@@ -93,55 +444,240 @@ class MeshServer(object):
     
     
     def replicateCacheEntry(self, key, value, expire):
-        self.__broadcast('SaveCacheEntry', (key, value, expire))
+        if not self.__replicators:
+            return
+        
+        # In announce mode only the key, expiry and a digest go out; peers
+        # pull the body on demand through FetchCacheEntry.
+        if self.__replicationMode == 'announce' and not self.__replicas:
+            value = self.getDigest(value)
+        
+        # Suspected peers are skipped rather than queued for, since the
+        # sender would only stall on them until they are declared dead.
+        for token in self.getOwners(key):
+            replicator = self.__replicators.get(token)
+            if replicator and self.__membership.isAvailable(token):
+                replicator.enqueue(key, value, expire)
     
     
     def setCacheBackend(self, backend):
         self.__cacheBackend = backend
     
     
+    def setConnectionSettings(self, settings):
+        if not settings:
+            return
+        self.__connectionSettings = dict(settings)
+        
+        replication = self.__connectionSettings.get('replication') or {}
+        self.__replicationMode = replication.get('mode', self.__replicationMode)
+        self.__directorySize = replication.get('directory', self.__directorySize)
+        
+        ring = self.__connectionSettings.get('ring') or {}
+        self.__replicas = ring.get('replicas', self.__replicas)
+        self.__ring = HashRing(self.__ring.getTokens(), ring.get('vnodes'))
+        
+        gossip = self.__connectionSettings.get('gossip') or {}
+        self.__gossipInterval = gossip.get('interval', self.__gossipInterval)
+        self.__gossipFanout = gossip.get('fanout', self.__gossipFanout)
+        self.__membership = Membership(self.getServerToken(), self.__localAddress, gossip.get('suspect'), gossip.get('dead'))
+    
+    
+    def setStats(self, settings):
+        if not settings or not settings.get('enabled'):
+            return
+        registry = getStatsRegistry()
+        registry.enable()
+        registry.addCollector(self.collectStats)
+    
+    
+    def setFlightGroup(self, flightGroup):
+        self.__flightGroup = flightGroup
+    
+    
     def stop(self):
         logging.critical("Sending halt signal to mesh server.")
-        self.__controlQueue.put(self.SIG_STOP)
+        for token, node in self.__nodes.items():
+            try:
+                node.sendMessage("UnregisterServer")
+            except (socket.error, RuntimeError), e:
+                logging.error("Failed to unregister from %s: %s" % (token, e))
+        
+        self.__stopping = True
+        self.__wake()
+        for replicator in self.__replicators.values():
+            replicator.stop()
+    
+    
+    def touchCacheEntry(self, key, parts, expire):
+        # Announced entries are pulled on demand, so peers revalidate them
+        # on their own instead.
+        if not self.__replicators or (self.__replicationMode == 'announce' and not self.__replicas):
+            return
+        
+        for token in self.getOwners(key):
+            replicator = self.__replicators.get(token)
+            if replicator and self.__membership.isAvailable(token):
+                replicator.enqueue(key, parts, expire, touch = True)
+    
+    
+    def warmUp(self):
+        settings = dict(self.__connectionSettings.get('warmup') or {})
+        if not settings.pop('enabled', True) or not self.__cacheBackend:
+            return None
+        if self.__warmUp and self.__warmUp.isRunning():
+            return None
+        
+        nodes = [(token, node) for token, node in self.__nodes.items() if self.__membership.isAvailable(token)]
+        self.__warmUp = WarmUp(self.__cacheBackend, **settings)
+        t = threading.Thread(target = self.__warmUp.run, args = (nodes, ))
+        t.daemon = True
+        t.start()
+        return t
+    
+    
+    def __acceptConnections(self):
+        while True:
+            try:
+                client, remoteAddress = self.__sock.accept()
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    logging.error("Failed to accept mesh connection: %s" % e)
+                return
+            
+            logging.debug("Incoming Connection from %s:%s" % remoteAddress)
+            client.setblocking(1)
+            connection = ServerConnection(client, remoteAddress, self)
+            self.__connections[client.fileno()] = connection
     
     
     def __addNode(self, remoteAddress, token = None):
         if token == self.getServerToken():
             return
+        node = self.__nodes.get(token) if token else None
+        if node:
+            return node
         
         remoteAddress = tuple(remoteAddress)
         logging.info("Found New Node: %s:%s" % remoteAddress)
         
         node = Node(self, remoteAddress, token)
         self.__nodes[node.getToken()] = node
+        self.__membership.alive(node.getToken(), remoteAddress)
+        
+        if node.getToken() not in self.__replicators:
+            settings = dict(self.__connectionSettings.get('replication') or {})
+            settings.pop('mode', None)
+            settings.pop('directory', None)
+            announce = self.__replicationMode == 'announce' and not self.__replicas
+            action = 'AnnounceCacheEntries' if announce else 'SaveCacheEntries'
+            self.__replicators[node.getToken()] = PeerReplicator(node, action, **settings)
+        
+        self.__updateRing(added = [node.getToken()])
         return node
     
     
-    def __broadcast(self, action, data):
-        def daemon():
-            for token, node in self.__nodes.iteritems():
-                recvToken, recvAction, recvData = node.sendMessage(action, data)
-                if recvAction != MessagingSocket.ACKNOWLEDGE:
-                    logging.error("Failed to receive acknowledgement from %s/%s" % (node.getToken(), action))
-        t = threading.Thread(target = daemon)
-        t.daemon = True
-        t.start()
+    def __daemon(self):
+        workers = []
+        for i in range(self.__workerCount):
+            t = threading.Thread(target = self.__work)
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        
+        try:
+            self.__selectLoop()
+        finally:
+            logging.critical("Mesh server exiting now.")
+            for t in workers:
+                self.__workQueue.put(None)
+            for connection in self.__connections.values():
+                connection.close()
+            self.__sock.close()
     
     
-    def __daemon(self):
+    def __drainWakePipe(self):
+        try:
+            os.read(self.__wakeRead, 4096)
+        except OSError:
+            pass
+        
         while True:
             try:
-                msg = self.__controlQueue.get(False)
-                if msg == self.SIG_STOP:
-                    logging.critical("Mesh server exiting now.")
-                    sys.exit()
+                connection = self.__rearmQueue.get(False)
             except Queue.Empty:
-                pass
+                return
+            if not connection.closed:
+                self.__connections[connection.fileno] = connection
+    
+    
+    def __exchangeGossip(self, token, node):
+        digest = self.__membership.getDigest()
+        try:
+            recvToken, recvAction, recvData = node.sendMessage("Gossip", digest)
+        except (socket.error, RuntimeError), e:
+            logging.info("Gossip with %s failed, suspecting it: %s" % (token, e))
+            self.__membership.suspect(token)
+            with self.__gossipLock:
+                self.__gossipStats['failed'] += 1
+            return
+        finally:
+            self.__gossipPending.discard(token)
+        
+        size = len(codec.dumps(digest)) + len(codec.dumps(recvData))
+        with self.__gossipLock:
+            self.__gossipStats['exchanges'] += 1
+            self.__gossipStats['bytes'] += size
+        self.__membership.touch(token)
+        self.__mergeMembership(recvData)
+    
+    
+    def __fetchFromDirectory(self, key):
+        with self.__directoryLock:
+            location = self.__directory.get(key)
+        if not location:
+            return None
+        
+        token, digest, expiresAt = location
+        node = self.__nodes.get(token)
+        if not node or (expiresAt and expiresAt < time.time()):
+            return None
+        
+        try:
+            recvToken, recvAction, entry = node.sendMessage("FetchCacheEntry", key)
+        except (socket.error, RuntimeError), e:
+            logging.error("Failed to fetch key %s from %s: %s" % (key, token, e))
+            return None
+        
+        if not entry:
+            return None
+        
+        value, expire = entry
+        if self.getDigest(value) != digest:
+            logging.error("Digest mismatch fetching key %s from %s" % (key, token))
+            return None
+        
+        logging.debug("Fetched key %s from %s" % (key, token))
+        return value, expire
+    
+    
+    def __fetchFromOwners(self, key):
+        for token in self.getOwners(key):
+            node = self.__nodes.get(token)
+            if not node or not self.__membership.isAvailable(token):
+                continue
             
             try:
-                self.__handleServerConnection()
-            except Exception, e:
-                logging.exception("Caught Exception: %s" % e)
+                recvToken, recvAction, entry = node.sendMessage("FetchCacheEntry", key)
+            except (socket.error, RuntimeError), e:
+                logging.error("Failed to fetch key %s from %s: %s" % (key, token, e))
+                continue
+            
+            if entry:
+                logging.debug("Fetched key %s from owner %s" % (key, token))
+                value, expire = entry
+                return value, expire
+        return None
     
     
     def __generateServerToken(self):
@@ -157,13 +693,20 @@ class MeshServer(object):
         return hashlib.md5(token).hexdigest()
     
     
+    def __getKeysOwnedBy(self, token):
+        if not self.__replicas:
+            return self.__cacheBackend.getKeys()
+        return [key for key in self.__cacheBackend.getKeys() if token in self.getOwners(key)]
+    
+    
     def __getNode(self, clientToken, remoteAddress):
-        if clientToken in self.__nodes.keys():
-            return self.__nodes[clientToken]
+        node = self.__nodes.get(clientToken)
+        if node:
+            return node
         
         return Node(self, remoteAddress, clientToken)
-
-
+    
+    
     def __getServerSocket(self, port, queuedConnections):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         
@@ -175,35 +718,125 @@ class MeshServer(object):
             except socket.error:
                 port += 1
         
-        server.settimeout(self.SOCKET_TIMEOUT)
+        server.setblocking(0)
         server.listen(queuedConnections)
         logging.info("Mesh Server listening on %s:%s" % self.__localAddress)
         return server
-
-
-    def __handleServerConnection(self):
-        # Wait for connection
+    
+    
+    def __gossip(self):
+        while not self.__stopping:
+            time.sleep(self.__gossipInterval)
+            with self.__gossipLock:
+                self.__gossipStats['rounds'] += 1
+            
+            for token in self.__membership.tick():
+                logging.warning("Node %s stopped responding, declaring it dead" % token)
+                self.__removeNode(token)
+            
+            # Each exchange runs on its own thread so an unreachable peer
+            # never holds back the heartbeat of this node. Nodes may be
+            # unregistered by other threads meanwhile, and are then skipped.
+            peers = [token for token in self.__membership.getPeers() if token in self.__nodes and token not in self.__gossipPending]
+            for token in random.sample(peers, min(self.__gossipFanout, len(peers))):
+                node = self.__nodes.get(token)
+                if not node:
+                    continue
+                
+                self.__gossipPending.add(token)
+                t = threading.Thread(target = self.__exchangeGossip, args = (token, node))
+                t.daemon = True
+                t.start()
+    
+    
+    def __handleMessage(self, connection):
         try:
-            client, remoteAddress = self.__sock.accept()
-        except socket.timeout:
-            return
+            message = connection.messaging.recv()
+        except Exception, e:
+            logging.error("Dropping connection from %s:%s: %s" % (connection.remoteAddress + (e, )))
+            message = None
         
-        logging.debug("Incoming Connection from %s:%s" % remoteAddress)
+        if not message:
+            connection.close()
+            return
         
-        # Process the request
-        messaging = MessagingSocket(client, self)
-        clientToken, action, requestData = messaging.recv()
+        # Hand the connection back to the selector before processing, so
+        # further messages from the same peer are read by other workers.
+        self.__rearm(connection)
         
         # Find the client Node
-        node = self.__getNode(clientToken, remoteAddress)
+        clientToken, action, requestId, requestData = message
+        node = self.__getNode(clientToken, connection.remoteAddress)
+        self.__membership.touch(clientToken)
         
         # Perform the requested action
         fn = self.__resolveAction(action)
         responseData = fn(node, requestData) if fn else None
         
         # Send an Acknowledgement along with the response data
-        messaging.sendAck(responseData)
-        messaging.close()
+        try:
+            with connection.sendLock:
+                connection.messaging.sendAck(responseData, requestId)
+        except RuntimeError, e:
+            logging.error("Failed to acknowledge %s from %s:%s: %s" % ((action, ) + connection.remoteAddress + (e, )))
+            connection.close()
+    
+    
+    def __mergeMembership(self, digest):
+        joined, left = self.__membership.merge(digest)
+        for token, remoteAddress in joined:
+            self.__addNode(remoteAddress, token)
+        for token in left:
+            logging.info("Node %s was declared dead by the mesh" % token)
+            self.__removeNode(token)
+    
+    
+    def __rearm(self, connection):
+        self.__rearmQueue.put(connection)
+        self.__wake()
+    
+    
+    def __rebalance(self, previous, ring):
+        moved = evicted = 0
+        localToken = self.getServerToken()
+        for key in self.__cacheBackend.getKeys():
+            before = previous.getOwners(key, self.__replicas)
+            after = ring.getOwners(key, self.__replicas)
+            if before == after:
+                continue
+            
+            # Only the first surviving previous owner hands the key over,
+            # so joining nodes receive each entry once.
+            survivors = [token for token in before if token in ring]
+            if survivors and survivors[0] == localToken:
+                value = self.__cacheBackend.get(key, fetch = False)
+                expire = self.__cacheBackend.getTimeToLive(key)
+                if value and expire is not None:
+                    for token in after:
+                        replicator = self.__replicators.get(token)
+                        if token not in before and replicator:
+                            replicator.enqueue(key, value, expire)
+                            moved += 1
+            
+            if localToken not in after:
+                self.__cacheBackend.evict(key)
+                evicted += 1
+        
+        logging.info("Rebalanced ring of %s nodes: handed over %s keys, evicted %s" % (len(ring), moved, evicted))
+    
+    
+    def __removeNode(self, token):
+        self.__membership.kill(token)
+        node = self.__nodes.pop(token, None)
+        if not node:
+            return
+        
+        logging.info("Node Left: %s:%s" % node.getAddress())
+        replicator = self.__replicators.pop(token, None)
+        if replicator:
+            replicator.stop()
+        node.close()
+        self.__updateRing(removed = [token])
     
     
     def __resolveAction(self, action):
@@ -212,12 +845,87 @@ class MeshServer(object):
             fn = getattr(self, fnName)
             if callable(fn):
                 return fn
+    
+    
+    def __selectLoop(self):
+        while not self.__stopping:
+            readers = [self.__wakeRead]
+            
+            # With every worker busy and the queue full, stop reading so
+            # that peers are pushed back on by TCP flow control.
+            if not self.__workQueue.full():
+                readers.append(self.__sock)
+                readers.extend(self.__connections.keys())
+            
+            try:
+                readable, writable, failed = select.select(readers, [], [], self.BACKPRESSURE_INTERVAL)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            
+            for fd in readable:
+                if fd == self.__wakeRead:
+                    self.__drainWakePipe()
+                elif fd is self.__sock:
+                    self.__acceptConnections()
+                else:
+                    connection = self.__connections.pop(fd)
+                    try:
+                        self.__workQueue.put(connection, False)
+                    except Queue.Full:
+                        self.__connections[fd] = connection
+    
+    
+    def __updateRing(self, added = (), removed = ()):
+        # Lookups read the ring without locking, so changes are made to
+        # a copy which then replaces it.
+        with self.__ringLock:
+            previous = self.__ring
+            ring = previous.copy()
+            for token in added:
+                ring.add(token)
+            for token in removed:
+                ring.remove(token)
+            self.__ring = ring
+        
+        if self.__replicas and self.__cacheBackend and ring.getTokens() != previous.getTokens():
+            t = threading.Thread(target = self.__rebalance, args = (previous, ring))
+            t.daemon = True
+            t.start()
+    
+    
+    def __wake(self):
+        try:
+            os.write(self.__wakeWrite, 'x')
+        except OSError:
+            pass
+    
+    
+    def __work(self):
+        while True:
+            connection = self.__workQueue.get()
+            if connection is None:
+                return
+            
+            try:
+                self.__handleMessage(connection)
+            except Exception, e:
+                logging.exception("Caught Exception: %s" % e)
+
+
+
+
 
 
 class MessagingSocket(object):
-    SEPERATOR = "&&"
-    DELIMITER = ";;"
+    MAGIC = "KN"
+    VERSION = 1
+    HEADER = struct.Struct('!2sBBIBBI')
     ACKNOWLEDGE = "Ok."
+    COALESCE_SIZE = 65536
+    RECV_SIZE = 65536
+    SENT_BYTES = 'knit_mesh_sent_bytes_total'
     
     __sock = None
     __localServer = None
@@ -235,80 +943,409 @@ class MessagingSocket(object):
             pass
     
     
-    def send(self, action, data):
-        message = self.__assembleMessage(action, data)
+    def send(self, action, data, requestId = 0):
+        parts = self.__assembleMessage(action, data, requestId)
         
+        # Small parts are joined into a single write; large bodies are
+        # written as they are rather than copied into the frame.
         totalsent = 0
-        while totalsent < len(message):
-            chunk = message[totalsent:]
-            sent = self.__sock.send(chunk)
-            if sent == 0:
-                raise RuntimeError("Socket connection broken during send.")
-            totalsent = totalsent + sent
+        pending = []
+        pendingSize = 0
+        for part in parts:
+            if len(part) < self.COALESCE_SIZE:
+                pending.append(str(part) if isinstance(part, buffer) else part)
+                pendingSize += len(part)
+                if pendingSize < self.COALESCE_SIZE:
+                    continue
+            
+            if pending:
+                totalsent += self.__sendAll(''.join(pending))
+                pending = []
+                pendingSize = 0
+            
+            if len(part) >= self.COALESCE_SIZE:
+                totalsent += self.__sendAll(part)
         
+        if pending:
+            totalsent += self.__sendAll(''.join(pending))
+        
+        registry = getStatsRegistry()
+        if registry.isEnabled():
+            registry.increment(self.SENT_BYTES, totalsent, action = action)
         return totalsent
     
     
-    def sendAck(self, data):
-        return self.send(self.ACKNOWLEDGE, data)
+    def sendAck(self, data, requestId = 0):
+        return self.send(self.ACKNOWLEDGE, data, requestId)
     
     
     def recv(self):
-        response = ''
+        header = self.__recvInto(bytearray(self.HEADER.size))
+        if header is None:
+            return None
         
-        while True:
+        magic, version, flags, requestId, tokenLength, actionLength, payloadLength = self.HEADER.unpack_from(header)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise RuntimeError("Attempted to decode malformed message header: %r" % str(header))
+        
+        # The frame length is known up front, so the whole message is read
+        # into one preallocated buffer and decoded in place.
+        message = self.__recvInto(bytearray(tokenLength + actionLength + payloadLength))
+        if message is None:
+            raise RuntimeError("Socket connection broken during recv.")
+        
+        return self.__disassembleMessage(memoryview(message), requestId, tokenLength, actionLength)
+    
+    
+    def __assembleMessage(self, action, data = None, requestId = 0):
+        token = self.__localServer.getServerToken()
+        payload = codec.encode(data)
+        payloadLength = sum(len(part) for part in payload)
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, 0, requestId, len(token), len(action), payloadLength)
+        return [header, token, action] + payload
+    
+    
+    def __disassembleMessage(self, message, requestId, tokenLength, actionLength):
+        senderToken = message[:tokenLength].tobytes()
+        action = message[tokenLength:tokenLength + actionLength].tobytes()
+        data, offset = codec.decode(message, tokenLength + actionLength)
+        return senderToken, action, requestId, data
+    
+    
+    def __recvInto(self, buffer):
+        view = memoryview(buffer)
+        length = len(buffer)
+        received = 0
+        
+        while received < length:
             try:
-                chunk = self.__sock.recv(1024)
-                response = response + chunk
+                count = self.__sock.recv_into(view[received:], min(length - received, self.RECV_SIZE))
             except socket.error, e:
-                chunk = ''
                 # UGLY Hack around BSD platforms raising errors when sockets are
                 # temp unavailable. TODO: Make this prettier
                 if str(e) == "[Errno 35] Resource temporarily unavailable":
                     time.sleep(0)
                     continue
+                raise
             
-            if chunk == '' or response.endswith(self.DELIMITER):
-                break
+            if count == 0:
+                return None
+            
+            received += count
         
-        return self.__disassembleMessage(response)
+        return buffer
     
     
-    def __assembleMessage(self, action, data = None):
-        data = yaml.dump(data)
-        parts = self.__localServer.getServerToken(), action, data
-        message = self.SEPERATOR.join(parts)
-        message = base64.b64encode(message)
-        message = message + self.DELIMITER
-        return message
+    def __sendAll(self, data):
+        try:
+            self.__sock.sendall(data)
+        except socket.error, e:
+            raise RuntimeError("Socket connection broken during send: %s" % e)
+        return len(data)
+
+
+class ServerConnection(object):
+    closed = False
+    
+    def __init__(self, sock, remoteAddress, localServer):
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.remoteAddress = remoteAddress
+        self.messaging = MessagingSocket(sock, localServer)
+        self.sendLock = threading.Lock()
+    
+    def close(self):
+        self.closed = True
+        self.messaging.close()
+
+
+class PeerConnection(object):
+    TIMEOUT = 10
+    BACKOFF_INITIAL = 0.5
+    BACKOFF_MAX = 30
     
+    __localServer = None
+    __address = None
+    __messaging = None
+    __lock = None
+    __sendLock = None
+    __pending = None
+    __requestIds = None
+    __timeout = None
+    __backoffInitial = None
+    __backoffMax = None
+    __failures = 0
+    __retryAt = 0
     
-    def __disassembleMessage(self, message):
-        if not message.endswith(self.DELIMITER):
-            raise RuntimeError("Attempted to decode malformed message: %s" % message)
+    def __init__(self, localServer, remoteAddress):
+        self.__localServer = localServer
+        self.__address = tuple(remoteAddress)
+        self.__lock = threading.Lock()
+        self.__sendLock = threading.Lock()
+        self.__pending = {}
+        self.__requestIds = itertools.count(1)
         
-        message = message[:-len(self.DELIMITER)]
-        message = base64.b64decode(message)
-        senderToken, action, data = message.split(self.SEPERATOR)
-        data = yaml.load(data)
-        return senderToken, action, data
+        settings = localServer.getConnectionSettings()
+        self.__timeout = settings.get('timeout', self.TIMEOUT)
+        self.__backoffInitial = settings.get('backoff', self.BACKOFF_INITIAL)
+        self.__backoffMax = settings.get('backoffmax', self.BACKOFF_MAX)
+    
+    
+    def close(self):
+        with self.__lock:
+            messaging, self.__messaging = self.__messaging, None
+        if messaging:
+            messaging.close()
+    
+    
+    def request(self, action, data = None):
+        messaging = self.__connect()
+        reply = PendingReply()
+        
+        with self.__lock:
+            requestId = self.__requestIds.next()
+            self.__pending[requestId] = reply
+        
+        try:
+            with self.__sendLock:
+                messaging.send(action, data, requestId)
+        except (socket.error, RuntimeError), e:
+            self.__disconnect(messaging, e)
+        
+        if not reply.wait(self.__timeout):
+            with self.__lock:
+                self.__pending.pop(requestId, None)
+            raise socket.timeout("No reply from %s:%s to %s" % (self.__address + (action, )))
+        
+        return reply.getResult()
+    
+    
+    def __connect(self):
+        with self.__lock:
+            if self.__messaging:
+                return self.__messaging
+            
+            if time.time() < self.__retryAt:
+                raise socket.error("Backing off reconnect to %s:%s" % self.__address)
+            
+            try:
+                s = socket.create_connection(self.__address, self.__timeout)
+                s.settimeout(None)
+            except socket.error:
+                self.__failures += 1
+                backoff = min(self.__backoffMax, self.__backoffInitial * (2 ** (self.__failures - 1)))
+                self.__retryAt = time.time() + backoff
+                raise
+            
+            self.__failures = 0
+            self.__retryAt = 0
+            messaging = self.__messaging = MessagingSocket(s, self.__localServer)
+        
+        # The connection may already be dropped and replaced by another
+        # thread, so only the socket opened here is handed on.
+        t = threading.Thread(target = self.__readReplies, args = (messaging, ))
+        t.daemon = True
+        t.start()
+        return messaging
+    
+    
+    def __disconnect(self, messaging, error):
+        with self.__lock:
+            if self.__messaging is messaging:
+                self.__messaging = None
+            pending, self.__pending = self.__pending, {}
+        
+        messaging.close()
+        logging.debug("Lost connection to %s:%s: %s" % (self.__address + (error, )))
+        for reply in pending.itervalues():
+            reply.fail(socket.error("Connection to %s:%s lost: %s" % (self.__address + (error, ))))
+    
+    
+    def __readReplies(self, messaging):
+        try:
+            while True:
+                message = messaging.recv()
+                if not message:
+                    raise socket.error("Connection closed by peer")
+                
+                token, action, requestId, data = message
+                with self.__lock:
+                    reply = self.__pending.pop(requestId, None)
+                if reply:
+                    reply.set((token, action, data))
+        except Exception, e:
+            self.__disconnect(messaging, e)
+
+
+class PeerReplicator(object):
+    QUEUE_SIZE = 1000
+    BATCH_SIZE = 64
+    BATCH_BYTES = 1048576
+    FLUSH_INTERVAL = 0.05
+    
+    __node = None
+    __action = None
+    __entries = None
+    __condition = None
+    __stopping = False
+    __stats = None
+    
+    def __init__(self, node, action, queue = None, batch = None, batchbytes = None, flush = None):
+        self.__node = node
+        self.__action = action
+        self.__queueSize = queue or self.QUEUE_SIZE
+        self.__batchSize = batch or self.BATCH_SIZE
+        self.__batchBytes = batchbytes or self.BATCH_BYTES
+        self.__flushInterval = flush or self.FLUSH_INTERVAL
+        self.__entries = collections.OrderedDict()
+        self.__condition = threading.Condition()
+        self.__stats = {'queued': 0, 'sent': 0, 'batches': 0, 'coalesced': 0, 'dropped': 0, 'failed': 0}
+        
+        t = threading.Thread(target = self.__daemon)
+        t.daemon = True
+        t.start()
+    
+    
+    def enqueue(self, key, value, expire, touch = False):
+        with self.__condition:
+            # A newer write for a queued key replaces the older one; when the
+            # peer has fallen too far behind, its oldest entries are dropped.
+            queued = self.__entries.pop(key, None)
+            if queued:
+                self.__stats['coalesced'] += 1
+            elif len(self.__entries) >= self.__queueSize:
+                self.__entries.popitem(last = False)
+                self.__stats['dropped'] += 1
+            
+            # A refresh of a queued write is folded into that write.
+            if touch and queued and not queued[2]:
+                value, touch = (queued[0][0], ) + tuple(value), False
+            
+            self.__entries[key] = value, expire, touch
+            self.__stats['queued'] += 1
+            
+            if len(self.__entries) == 1 or len(self.__entries) >= self.__batchSize:
+                self.__condition.notify()
+    
+    
+    def getStats(self):
+        with self.__condition:
+            stats = dict(self.__stats)
+            stats['depth'] = len(self.__entries)
+        return stats
+    
+    
+    def stop(self):
+        with self.__condition:
+            self.__stopping = True
+            self.__condition.notify()
+    
+    
+    def __daemon(self):
+        while True:
+            batch = self.__nextBatch()
+            if batch is None:
+                return
+            
+            failed = False
+            for action, entries in self.__splitBatch(batch):
+                try:
+                    recvToken, recvAction, recvData = self.__node.sendMessage(action, entries)
+                    failed = failed or recvAction != MessagingSocket.ACKNOWLEDGE
+                except (socket.error, RuntimeError), e:
+                    logging.debug("Replication to %s failed: %s" % (self.__node.getToken(), e))
+                    failed = True
+            
+            with self.__condition:
+                if failed:
+                    self.__stats['failed'] += len(batch)
+                else:
+                    self.__stats['sent'] += len(batch)
+                    self.__stats['batches'] += 1
+    
+    
+    def __nextBatch(self):
+        with self.__condition:
+            while not self.__entries and not self.__stopping:
+                self.__condition.wait()
+            
+            # Give small writes a moment to accumulate into a fuller batch.
+            if len(self.__entries) < self.__batchSize and not self.__stopping:
+                self.__condition.wait(self.__flushInterval)
+            
+            if self.__stopping:
+                return None
+            
+            batch = []
+            batchBytes = 0
+            while self.__entries and len(batch) < self.__batchSize:
+                key, (value, expire, touch) = self.__entries.popitem(last = False)
+                batch.append((key, value, expire, touch))
+                batchBytes += codec.sizeof(value)
+                if batchBytes >= self.__batchBytes:
+                    break
+            
+            return batch
+    
+    
+    def __splitBatch(self, batch):
+        writes = [(key, value, expire) for key, value, expire, touch in batch if not touch]
+        touches = [(key, value, expire) for key, value, expire, touch in batch if touch]
+        if writes:
+            yield self.__action, writes
+        if touches:
+            yield 'TouchCacheEntries', touches
+
+
+class PendingReply(object):
+    __event = None
+    __result = None
+    __error = None
+    
+    def __init__(self):
+        self.__event = threading.Event()
+    
+    def fail(self, error):
+        self.__error = error
+        self.__event.set()
+    
+    def getResult(self):
+        if self.__error:
+            raise self.__error
+        return self.__result
+    
+    def set(self, result):
+        self.__result = result
+        self.__event.set()
+    
+    def wait(self, timeout):
+        return self.__event.wait(timeout)
 
 
 class Node(object):
     __localServer = None
     __address = None
     __token = None
+    __connection = None
     
     def __init__(self, localServer, remoteAddress, token = None):
         self.__localServer = localServer
         self.__address = tuple(remoteAddress)
         
+        if localServer.getConnectionSettings().get('persistent', True):
+            self.__connection = PeerConnection(localServer, self.__address)
+        
         if not token:
             token, action, data = self.__sendRegisterNewServer()
         
         self.__token = token
     
     
+    def close(self):
+        if self.__connection:
+            self.__connection.close()
+    
+    
     def getAddress(self):
         return self.__address
     
@@ -318,17 +1355,35 @@ class Node(object):
     
     
     def sendMessage(self, action, data = None):
+        registry = getStatsRegistry()
+        if not registry.isEnabled():
+            return self.__sendMessage(action, data)
+        
+        peer = self.__token or "%s:%s" % self.__address
+        start = time.time()
+        try:
+            response = self.__sendMessage(action, data)
+        except Exception:
+            registry.increment('knit_mesh_message_failures_total', peer = peer, action = action)
+            raise
+        registry.observe('knit_mesh_message_seconds', time.time() - start, peer = peer, action = action)
+        return response
+    
+    
+    def __sendMessage(self, action, data = None):
+        if self.__connection:
+            return self.__connection.request(action, data)
+        
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect(self.__address)
         
         messaging = MessagingSocket(s, self.__localServer)
         messaging.send(action, data)
-        response = messaging.recv()
+        token, action, requestId, data = messaging.recv()
         messaging.close()
         
-        return response
+        return token, action, data
     
     
     def __sendRegisterNewServer(self):
         return self.sendMessage("RegisterNewServer", self.__localServer.getServerAddress())
-
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.pool
+# 
+# Module containing keep-alive connection pools for backend requests
+
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+
+
+__pools = {}
+__poolsLock = threading.Lock()
+
+
+def getConnectionPool(backend, scheme = 'http', **settings):
+    key = os.getpid(), scheme, backend['host'], int(backend['port'])
+    
+    with __poolsLock:
+        if key not in __pools:
+            __pools[key] = ConnectionPool(backend['host'], backend['port'], scheme, **settings)
+        return __pools[key]
+
+
+def getConnectionPoolStats():
+    pid = os.getpid()
+    stats = {}
+    with __poolsLock:
+        for key, pool in __pools.iteritems():
+            if key[0] == pid:
+                stats["%s://%s:%s" % key[1:]] = pool.getStats()
+    return stats
+
+
+class PooledConnection(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.requests = 0
+        self.lastUsed = time.time()
+
+
+class ConnectionPool(object):
+    __host = None
+    __port = None
+    __scheme = None
+    __size = 10
+    __idleTimeout = 30
+    __maxRequests = 100
+    __timeout = 30
+    __idle = None
+    __lock = None
+    __stats = None
+    
+    def __init__(self, host, port, scheme = 'http', size = None, idle = None, requests = None, timeout = None):
+        self.__host = host
+        self.__port = int(port)
+        self.__scheme = scheme
+        self.__size = size or self.__size
+        self.__idleTimeout = idle or self.__idleTimeout
+        self.__maxRequests = requests or self.__maxRequests
+        self.__timeout = timeout or self.__timeout
+        self.__idle = []
+        self.__lock = threading.Lock()
+        self.__stats = {'hits': 0, 'misses': 0, 'expired': 0, 'retired': 0, 'discarded': 0}
+    
+    
+    def acquire(self):
+        now = time.time()
+        with self.__lock:
+            while self.__idle:
+                conn = self.__idle.pop()
+                if (now - conn.lastUsed) > self.__idleTimeout:
+                    self.__stats['expired'] += 1
+                    self.__closeConnection(conn)
+                    continue
+                
+                self.__stats['hits'] += 1
+                return conn
+            
+            self.__stats['misses'] += 1
+        
+        return self.__openConnection()
+    
+    
+    def discard(self, conn):
+        with self.__lock:
+            self.__stats['discarded'] += 1
+        self.__closeConnection(conn)
+    
+    
+    def getStats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['idle'] = len(self.__idle)
+        
+        lookups = stats['hits'] + stats['misses']
+        stats['reuse'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+    
+    
+    def release(self, conn):
+        conn.requests += 1
+        conn.lastUsed = time.time()
+        
+        with self.__lock:
+            if conn.requests >= self.__maxRequests:
+                self.__stats['retired'] += 1
+            elif len(self.__idle) < self.__size:
+                self.__idle.append(conn)
+                return
+        
+        self.__closeConnection(conn)
+    
+    
+    def urlopen(self, method, path, headers):
+        conn = self.acquire()
+        
+        # A reused connection may have been closed by the backend while it
+        # sat idle, so give it one retry on a fresh connection.
+        while True:
+            try:
+                conn.connection.request(method, path, headers = headers)
+                return conn, conn.connection.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                reused = conn.requests > 0
+                self.discard(conn)
+                if not reused:
+                    raise
+                
+                logging.debug("Retrying stale backend connection to %s:%s: %s" % (self.__host, self.__port, e))
+                conn = self.__openConnection()
+    
+    
+    def __closeConnection(self, conn):
+        try:
+            conn.connection.close()
+        except (httplib.HTTPException, socket.error):
+            pass
+    
+    
+    def __openConnection(self):
+        if self.__scheme == 'https':
+            connection = httplib.HTTPSConnection(self.__host, self.__port, timeout = self.__timeout)
+        else:
+            connection = httplib.HTTPConnection(self.__host, self.__port, timeout = self.__timeout)
+        return PooledConnection(connection)
+
@@ -6,9 +6,18 @@
 
 from wsgiref.util import is_hop_by_hop
 import logging
-import requests
-import re
+import threading
+import time
+import urllib
+import Queue
 from simplecache import Cache
+from compression import BodyCompressor
+from flight import Flight, FlightGroup
+from lru import LRUShard
+from pool import getConnectionPool, getConnectionPoolStats
+from ranges import RangeFilter
+from rules import CacheRule, CacheRuleSet
+from stats import CONTENT_TYPE, getSamples, getStatsRegistry
 
 
 class WSGIEnviron(object):
@@ -26,22 +35,112 @@ class WSGIEnviron(object):
         self.data[key] = value
 
 
+class ProxyRequest(object):
+    ranges = None
+    
+    def __init__(self, environ, startResponse = None):
+        self.environ = WSGIEnviron(environ)
+        self.startResponse = startResponse
+
+
+class ProxyResponse(ProxyRequest):
+    def __init__(self, environ, startResponse, handler, onClose = None):
+        ProxyRequest.__init__(self, environ, startResponse)
+        self.started = time.time()
+        self.__onClose = onClose
+        self.__body = handler(self)
+    
+    def __iter__(self):
+        return self.__body
+    
+    def close(self):
+        self.__body.close()
+        if self.__onClose:
+            self.__onClose(self)
+
+
+class StreamBuffer(object):
+    def __init__(self, maxSize, cacheKey = None, primaryKey = None, vary = None):
+        self.maxSize = maxSize
+        self.cacheKey = cacheKey
+        self.primaryKey = primaryKey
+        self.vary = vary
+        self.negative = False
+        self.size = 0
+        self.chunks = []
+    
+    def getvalue(self):
+        return ''.join(self.chunks)
+    
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.maxSize:
+            self.chunks = []
+            return False
+        self.chunks.append(chunk)
+        return True
+
+
 class HTTPProxyServer:
+    PATH_SAFE = "/;=@!$&'()*+,:~"
+    UNCACHEABLE_BYTES = 1048576
+    UNCACHEABLE_TIMEOUT = 300
+    FAILING_BYTES = 1048576
+    
     __backend = None
     __cache = None
+    __flights = None
+    __coalesce = True
+    __coalesceMesh = False
+    __coalesceTimeout = 10
+    __poolSettings = {}
     __cacheMethods = []
     __cacheRules = []
-    __preventCachingControls = ('private', 'no-cache', 'no-store', 'must-revalidate', 'proxy-revalidate')
+    __cacheRuleSettings = []
+    __cacheKeySettings = {}
+    __compression = False
+    __compressor = None
+    __statsPath = None
+    __phaseHistograms = None
+    __maxCacheableSize = 10485760
+    __streamChunkSize = 65536
+    __revalidation = True
+    __staleRetention = 3600
+    __revalidating = None
+    __revalidatingLock = None
+    __uncacheable = None
+    __failing = None
+    __negativeCaching = False
+    __negativeTimeouts = {}
+    __negativeReplicate = True
+    __protect = False
+    __protectRetention = 86400
+    __protectBackoff = 5
+    __preventCachingControls = ('private', 'no-cache', 'no-store')
+    __revalidateControls = ('must-revalidate', 'proxy-revalidate')
     
     
     def __init__(self, backend, cache = None):
         self.__backend = backend
         self.__cache = cache or Cache('DummyCache')
+        self.__flights = FlightGroup()
+        self.__compressor = BodyCompressor()
+        self.__revalidating = set()
+        self.__revalidatingLock = threading.Lock()
+        self.__uncacheable = LRUShard(self.UNCACHEABLE_BYTES)
+        self.__failing = LRUShard(self.FAILING_BYTES)
         
         self.setCacheMethods(('GET', 'HEAD'))
         self.setCacheRules((("^.*$", "%(REQUEST_METHOD)s %(PATH_INFO)s?%(QUERY_STRING)s %(HTTP_COOKIE)s"),))
     
     
+    def setCacheKeys(self, settings):
+        if not settings:
+            return
+        self.__cacheKeySettings = dict(settings)
+        self.setCacheRules(self.__cacheRuleSettings)
+    
+    
     def setCacheMethods(self, methods):
         if not methods:
             return
@@ -52,124 +151,876 @@ class HTTPProxyServer:
         if not rules:
             return
         
-        self.__cacheRules = []
-        for pattern, format in rules:
-            cre = re.compile(pattern)
-            rule = cre, format
-            self.__cacheRules.append(rule)
+        self.__cacheRuleSettings = rules
+        cacheRules = []
+        for rule in rules:
+            pattern, format = rule[:2]
+            settings = dict(self.__cacheKeySettings)
+            settings['negative'] = dict(self.__negativeTimeouts)
+            if len(rule) > 2:
+                ruleSettings = dict(rule[2])
+                negative = ruleSettings.pop('negative', None) or {}
+                settings['negative'].update((str(status).lower(), timeout) for status, timeout in negative.iteritems())
+                settings.update(ruleSettings)
+            cacheRules.append(CacheRule(pattern, format, settings))
+        self.__cacheRules = CacheRuleSet(cacheRules)
     
     
-    def __call__(self, environ, startResponse):
-        self.environ = WSGIEnviron(environ)
-        self.startResponse = startResponse
-        return self
+    def getCacheRuleStats(self):
+        stats = {}
+        for rule in self.__cacheRules:
+            stats[rule.name] = rule.getStats()
+        return stats
     
     
-    def __iter__(self):
-        url = self.__assembleBackendURL()
-        cacheKey = self.__generateCacheKey(url)
+    def getCompressionStats(self):
+        stats = self.__compressor.getStats()
+        stats['enabled'] = self.__compression
+        return stats
+    
+    
+    def setCompression(self, settings):
+        if not settings:
+            return
+        self.__compression = settings.get('enabled', self.__compression)
+        self.__compressor = BodyCompressor(
+            settings.get('encodings'),
+            settings.get('level'),
+            settings.get('minsize'),
+            settings.get('types'))
+    
+    
+    def collectStats(self):
+        samples = []
+        for rule in self.__cacheRules:
+            stats = rule.getStats()
+            for outcome in ('hits', 'stale', 'misses'):
+                samples.append(('knit_cache_rule_lookups_total', 'counter', {'rule': rule.name, 'outcome': outcome}, stats[outcome]))
+            samples.append(('knit_cache_rule_hit_ratio', 'gauge', {'rule': rule.name}, stats['ratio']))
         
-        responseParts = None
-        saveToCache = False
-        if cacheKey:
-            responseParts = self.__cache.get(cacheKey)
+        if hasattr(self.__cache, 'getStats'):
+            samples.extend(getSamples('knit_cache', self.__cache.getStats()))
+        if hasattr(self.__cache, 'getDiskStats'):
+            samples.extend(getSamples('knit_disk', self.__cache.getDiskStats() or {}))
+        if self.__compression:
+            samples.extend(getSamples('knit_compression', self.getCompressionStats()))
+        for backend, stats in self.getConnectionPoolStats().iteritems():
+            samples.extend(getSamples('knit_pool', stats, {'backend': backend}))
+        return samples
+    
+    
+    def getStatsResponse(self, environ):
+        if not self.__statsPath or environ.get('PATH_INFO') != self.__statsPath:
+            return None
         
-        if not responseParts:
-            responseParts = self.__fetchFromBackend(url)
-            saveToCache = True
+        body = getStatsRegistry().render().encode('utf-8')
+        return '200 OK', [('Content-Type', CONTENT_TYPE), ('Content-Length', str(len(body))), ('Cache-Control', 'no-store')], body
+    
+    
+    def setStats(self, settings):
+        if not settings or not settings.get('enabled'):
+            return
+        
+        registry = getStatsRegistry()
+        registry.enable()
+        registry.addCollector(self.collectStats)
+        self.__statsPath = settings.get('path')
+        self.__phaseHistograms = {}
+        for phase in ('key', 'lookup', 'backend', 'store', 'request'):
+            self.__phaseHistograms[phase] = registry.getHistogram('knit_proxy_phase_seconds', phase = phase)
+    
+    
+    def getFlightGroup(self):
+        return self.__flights
+    
+    
+    def setCoalescing(self, settings):
+        if not settings:
+            return
+        self.__coalesce = settings.get('enabled', self.__coalesce)
+        self.__coalesceMesh = settings.get('mesh', self.__coalesceMesh)
+        self.__coalesceTimeout = settings.get('timeout', self.__coalesceTimeout)
+    
+    
+    def setNegativeCaching(self, settings):
+        if not settings:
+            return
+        self.__negativeCaching = settings.get('enabled', self.__negativeCaching)
+        self.__negativeReplicate = settings.get('replicate', self.__negativeReplicate)
+        self.__negativeTimeouts = dict((str(status).lower(), timeout) for status, timeout in (settings.get('ttl') or {}).iteritems())
+        self.setCacheRules(self.__cacheRuleSettings)
+    
+    
+    def setProtection(self, settings):
+        if not settings:
+            return
+        self.__protect = settings.get('enabled', self.__protect)
+        self.__protectRetention = settings.get('retention', self.__protectRetention)
+        self.__protectBackoff = settings.get('backoff', self.__protectBackoff)
+    
+    
+    def setRevalidation(self, settings):
+        if not settings:
+            return
+        self.__revalidation = settings.get('enabled', self.__revalidation)
+        self.__staleRetention = settings.get('retention', self.__staleRetention)
+    
+    
+    def commitCacheBuffer(self, cacheKey, buffer, status, responseHeaders, timeout):
+        start = time.time()
+        meta = self.__buildCacheMeta(responseHeaders, timeout)
+        if buffer.negative:
+            meta['negative'] = True
+        body = buffer.getvalue()
+        if self.__compression:
+            encoding, body = self.__compressor.compress(body, dict(responseHeaders))
+            if encoding:
+                meta['encoding'] = encoding
+        responseParts = body, status, responseHeaders, meta
+        storageTimeout = self.__calculateStorageTimeout(status, meta)
+        
+        # Varying responses are stored under a variant key, with a marker
+        # under the primary key naming the request headers to select by.
+        replicate = self.__negativeReplicate or not buffer.negative
+        if buffer.vary:
+            self.__storeCacheEntry(buffer.primaryKey, ('', None, [], {'vary': buffer.vary}), storageTimeout, replicate)
+        self.__storeCacheEntry(buffer.cacheKey or cacheKey, responseParts, storageTimeout, replicate)
+        self.__observePhase('store', start)
+    
+    
+    def getBackendRequest(self, environ):
+        request = ProxyRequest(environ)
+        method = request.environ['REQUEST_METHOD'] or 'GET'
+        return method, self.__assembleBackendPath(request), self.__assembleRequestHeaders(request)
+    
+    
+    def getFallbackEntry(self, cacheKey, environ):
+        # The last good copy stands in for a failed backend response for
+        # as long as stale-if-error, or protection mode, allows.
+        responseParts = self.__cache.get(cacheKey) if cacheKey else None
+        if not responseParts or len(responseParts) < 4 or self.__isVaryMarker(responseParts) or not self.__isGoodCopy(responseParts[1], responseParts[3]):
+            return None
+        if self.__getStaleness(responseParts) > self.__getErrorWindow(responseParts[1], responseParts[3]):
+            return None
+        self.__failing.set(cacheKey, True, self.__protectBackoff)
+        return self.__decodeCacheEntry(responseParts, self.__getAcceptEncoding(ProxyRequest(environ).environ))
+    
+    
+    def getRangeFilter(self, environ):
+        if environ.get('REQUEST_METHOD') != 'GET' or not environ.get('HTTP_RANGE'):
+            return None
+        return RangeFilter(environ['HTTP_RANGE'], environ.get('HTTP_IF_RANGE'))
+    
+    
+    def getResponseHeaders(self, headers):
+        return self.__assembleResponseHeaders(headers)
+    
+    
+    def getStreamChunkSize(self):
+        return self.__streamChunkSize
+    
+    
+    def hasRemoteLookups(self):
+        # Only mesh aware caches, which also take touches, look entries up
+        # on other nodes or processes, and can be asked not to.
+        return hasattr(self.__cache, 'touch')
+    
+    
+    def lookupCacheEntry(self, environ, fetch = True):
+        request = ProxyRequest(environ)
+        cacheKey, responseParts = self.__lookupCacheEntry(request, fetch)
+        if not cacheKey:
+            return None, None
+        
+        # Entries past their stale-while-revalidate window are fetched
+        # again in full rather than revalidated.
+        staleness = self.__getStaleness(responseParts)
+        if staleness > 0 and not self.__isBackingOff(cacheKey, responseParts, staleness):
+            if staleness > responseParts[3].get('swr', 0):
+                return cacheKey, None
+            self.__refreshInBackground(request, cacheKey, responseParts)
+        
+        if responseParts:
+            responseParts = self.__decodeCacheEntry(responseParts, self.__getAcceptEncoding(request.environ))
+        return cacheKey, responseParts
+    
+    
+    def openCacheBuffer(self, cacheKey, status, responseHeaders, environ = None):
+        if not cacheKey:
+            return None, -1
+        
+        headers = dict(responseHeaders)
+        vary = self.__parseVary(headers)
+        if environ is None:
+            if not self.__isCacheableSize(headers):
+                return None, -1
+            timeout = self.__calculateCacheTimeout(headers)
+            if timeout <= 0 or vary:
+                return None, -1
+            return StreamBuffer(self.__maxCacheableSize, cacheKey), timeout
+        
+        # The key looked up may have been a variant; the entry is filed
+        # under whatever the response varies on now.
+        request = ProxyRequest(environ)
+        rule = self.__matchCacheRule(request)
+        if not rule or status.startswith('206'):
+            return None, -1
+        
+        # Objects found not to be stored have their ranges passed on to
+        # the backend for a while, rather than being fetched in full.
+        primaryKey = rule.getKey(request.environ)
+        timeout, negative = self.__calculateResponseTimeout(rule, status, headers)
+        if timeout <= 0 or vary == '*' or not self.__isCacheableSize(headers):
+            self.__uncacheable.set(primaryKey, True, self.UNCACHEABLE_TIMEOUT)
+            return None, -1
+        
+        self.__uncacheable.delete(primaryKey)
+        if not vary:
+            buffer = StreamBuffer(self.__maxCacheableSize, primaryKey)
+        else:
+            variantKey = rule.getVariantKey(primaryKey, vary, request.environ)
+            buffer = StreamBuffer(self.__maxCacheableSize, variantKey, primaryKey, vary)
+        buffer.negative = negative
+        return buffer, timeout
+    
+    
+    def getConnectionPoolStats(self):
+        return getConnectionPoolStats()
+    
+    
+    def setConnectionPoolSettings(self, settings):
+        if not settings:
+            return
+        self.__poolSettings = dict(settings)
+    
+    
+    def setMaxCacheableSize(self, size):
+        if not size:
+            return
+        self.__maxCacheableSize = size
+    
+    
+    def setStreamChunkSize(self, size):
+        if not size:
+            return
+        self.__streamChunkSize = size
+    
+    
+    def __call__(self, environ, startResponse):
+        ranges = self.getRangeFilter(environ)
+        if ranges:
+            return ProxyResponse(environ, startResponse, lambda request: self.__respondToRange(request, ranges), self.__finishResponse)
+        return ProxyResponse(environ, startResponse, self.__respond, self.__finishResponse)
+    
+    
+    def __respond(self, request):
+        statsResponse = self.getStatsResponse(request.environ.data)
+        if statsResponse:
+            status, responseHeaders, body = statsResponse
+            request.startResponse(status, responseHeaders)
+            yield body
+            return
         
-        body, status, responseHeaders = responseParts
+        cacheKey, responseParts = self.__lookupCacheEntry(request)
+        staleness = self.__getStaleness(responseParts)
+        if staleness > 0 and staleness <= responseParts[3].get('swr', 0):
+            self.__refreshInBackground(request, cacheKey, responseParts)
+        elif staleness > 0 and not self.__isBackingOff(cacheKey, responseParts, staleness):
+            responseParts, fetched = self.__revalidate(request, cacheKey, responseParts, staleness)
+            if fetched:
+                conn, response = fetched
+                for chunk in self.__streamResponse(request, cacheKey, conn, response):
+                    yield chunk
+                return
         
-        if cacheKey and saveToCache:
-            timeout = self.__calculateCacheTimeout(dict(responseHeaders))
-            if timeout > 0:
-                self.__cache.set(cacheKey, responseParts, timeout)
+        if not responseParts and cacheKey and self.__coalesce:
+            flight, leader = self.__flights.begin(cacheKey)
+            if leader:
+                self.__reportFlight(cacheKey, True)
+                try:
+                    responseParts = self.__waitForRemoteFetch(cacheKey, flight)
+                    if not responseParts:
+                        for chunk in self.__streamFromBackend(request, cacheKey, flight):
+                            yield chunk
+                        return
+                finally:
+                    self.__flights.end(cacheKey, flight)
+                    self.__reportFlight(cacheKey, False)
+            else:
+                queue = self.__waitForFlight(request, flight)
+                if queue:
+                    for chunk in self.__streamFromFlight(cacheKey, queue):
+                        yield chunk
+                    return
         
-        self.startResponse(status, responseHeaders)
-        yield body
+        if responseParts:
+            body, status, responseHeaders = self.__decodeCacheEntry(responseParts, self.__getAcceptEncoding(request.environ))
+            request.startResponse(status, responseHeaders)
+            if isinstance(body, str) or request.ranges:
+                yield body
+                return
+            
+            # Bodies mapped from the disk tier are copied out a chunk at a
+            # time, since WSGI servers only accept strings.
+            for offset in xrange(0, len(body), self.__streamChunkSize):
+                yield body[offset:offset + self.__streamChunkSize]
+            return
+        
+        for chunk in self.__streamFromBackend(request, cacheKey):
+            yield chunk
     
     
-    def __assembleBackendURL(self):
+    def __assembleBackendURL(self, request):
         url = "%s://%s:%s%s" % (
-            self.environ['wsgi.url_scheme'],
+            request.environ['wsgi.url_scheme'],
             self.__backend['host'],
             self.__backend['port'],
-            self.environ['PATH_INFO'])
+            request.environ['PATH_INFO'])
         
-        if self.environ['QUERY_STRING']:
-            url += "?%s" % self.environ['QUERY_STRING']
+        if request.environ['QUERY_STRING']:
+            url += "?%s" % request.environ['QUERY_STRING']
         
         return url
     
     
-    def __assembleRequestHeaders(self):
+    def __assembleBackendPath(self, request):
+        # PATH_INFO arrives decoded, so the path goes out as the client sent
+        # it where the server passes that on, and quoted again otherwise.
+        environ = request.environ
+        uri = environ['RAW_URI'] or environ['REQUEST_URI']
+        if uri.startswith('/') and not environ['SCRIPT_NAME']:
+            return uri
+        
+        path = urllib.quote(environ['PATH_INFO'], self.PATH_SAFE)
+        if environ['QUERY_STRING']:
+            path += "?%s" % environ['QUERY_STRING']
+        return path
+    
+    
+    def __assembleRequestHeaders(self, request):
         headers = {}
-        for key, value in self.environ.iteritems():
+        for key, value in request.environ.iteritems():
             if key.startswith('HTTP_'):
                 key = key[5:].replace('_', '-').title()
                 if not is_hop_by_hop(key):
                    headers[key] = value
         
+        if 'Range' in headers and self.__isFetchedInFull(request):
+            headers.pop('Range')
+            headers.pop('If-Range', None)
+        
         headers['Host'] = self.__backend['host']
         return headers
     
     
     def __assembleResponseHeaders(self, headers):
         responseHeaders = []
-        for key, value in headers.iteritems():
+        for key, value in headers:
             if not is_hop_by_hop(key):
                 key = key.title()
                 responseHeaders.append((key, value))
         return responseHeaders
     
     
+    def __buildCacheMeta(self, responseHeaders, timeout):
+        headers = dict(responseHeaders)
+        meta = {'storedAt': time.time(), 'maxAge': timeout}
+        if 'Etag' in headers:
+            meta['etag'] = headers['Etag']
+        if 'Last-Modified' in headers:
+            meta['lastModified'] = headers['Last-Modified']
+        
+        controls = self.__parseCacheControl(headers)
+        if not any(control in controls for control in self.__revalidateControls):
+            meta['swr'] = self.__parseSeconds(controls.get('stale-while-revalidate'))
+            meta['sie'] = self.__parseSeconds(controls.get('stale-if-error'))
+        return meta
+    
+    
     def __calculateCacheTimeout(self, headers):
-        cacheControl = headers.get('Cache-Control', '').split(',')
-        cacheControl = [control.strip() for control in cacheControl]
-        if 'public' not in cacheControl:
+        controls = self.__parseCacheControl(headers)
+        if 'public' not in controls:
             return -1
         
-        maxAge = -1
-        for control in cacheControl:
-            if control in self.__preventCachingControls:
-                return -1
-            
-            try:
-                if "=" in control:
-                    parts = control.split('=')
-                    maxAge = int(parts[1])
-            except (ValueError, IndexError):
+        for control in self.__preventCachingControls:
+            if control in controls:
                 return -1
         
-        return maxAge
+        maxAge = controls.get('s-maxage', controls.get('max-age'))
+        if maxAge is None:
+            return -1
+        return self.__parseSeconds(maxAge) or -1
+    
+    
+    def __calculateResponseTimeout(self, rule, status, headers):
+        # Error responses are cached for the short time configured for
+        # their status, unless the backend marks them private.
+        negativeTimeout = rule.getNegativeTimeout(status) if self.__negativeCaching and status[:1] in ('4', '5') else 0
+        timeout = self.__calculateCacheTimeout(headers)
+        if not negativeTimeout:
+            return timeout, False
+        
+        controls = self.__parseCacheControl(headers)
+        if 'private' in controls or 'no-store' in controls:
+            return -1, True
+        if timeout > 0:
+            return min(timeout, negativeTimeout), True
+        return negativeTimeout, True
+    
+    
+    def __calculateStorageTimeout(self, status, meta):
+        # Stale entries are kept around while they can still be served or
+        # cheaply revalidated against their validators. Negative entries
+        # simply expire.
+        if meta.get('negative'):
+            return meta['maxAge']
+        
+        window = max(meta.get('swr', 0), meta.get('sie', 0))
+        if self.__revalidation and ('etag' in meta or 'lastModified' in meta):
+            window = max(window, self.__staleRetention)
+        if self.__protect and self.__isGoodCopy(status, meta):
+            window = max(window, self.__protectRetention)
+        return meta['maxAge'] + window
+    
+    
+    def __decodeCacheEntry(self, responseParts, acceptEncoding):
+        body, status, responseHeaders = responseParts[:3]
+        encoding = responseParts[3].get('encoding') if len(responseParts) > 3 else None
+        if not encoding:
+            return body, status, responseHeaders
+        
+        # Stored headers describe the identity body; the encoding and
+        # length are set for whichever form is sent, and the encoded form
+        # gets an entity tag of its own.
+        body, encoded = self.__compressor.decode(encoding, body, acceptEncoding)
+        headers = [(key, value) for key, value in responseHeaders if key not in ('Content-Length', 'Content-Encoding', 'Vary')]
+        if encoded:
+            headers = [(key, "%s-%s\"" % (value[:-1], encoding) if key == 'Etag' and value.endswith('"') else value) for key, value in headers]
+            headers.append(('Content-Encoding', encoding))
+        headers.append(('Content-Length', str(len(body))))
+        
+        vary = [name.strip() for name in dict(responseHeaders).get('Vary', '').split(',') if name.strip()]
+        if 'accept-encoding' not in [name.lower() for name in vary]:
+            vary.append('Accept-Encoding')
+        headers.append(('Vary', ', '.join(vary)))
+        return body, status, headers
+    
+    
+    def __drainResponse(self, cacheKey, chunks):
+        try:
+            for chunk in chunks:
+                pass
+        except Exception:
+            logging.exception("Failed to finish coalesced fetch for key %s" % cacheKey)
+    
+    
+    def __fetchFromBackend(self, request, extraHeaders = None):
+        method, path, headers = self.getBackendRequest(request.environ.data)
+        if extraHeaders:
+            headers.update(extraHeaders)
+        pool = self.__getConnectionPool(request)
+        
+        start = time.time()
+        response = pool.urlopen(method, path, headers)
+        self.__observePhase('backend', start)
+        return response
+    
+    
+    def __finishResponse(self, response):
+        self.__observePhase('request', response.started)
+    
+    
+    def __getAcceptEncoding(self, environ):
+        # Ranges are cut from the identity body, so range requests are
+        # always served decoded entries.
+        if environ['REQUEST_METHOD'] == 'GET' and environ['HTTP_RANGE']:
+            return ''
+        return environ['HTTP_ACCEPT_ENCODING']
+    
+    
+    def __getConnectionPool(self, request):
+        scheme = request.environ['wsgi.url_scheme'] or 'http'
+        return getConnectionPool(self.__backend, scheme, **self.__poolSettings)
+    
     
+    def __getErrorWindow(self, status, meta):
+        if self.__protect and self.__isGoodCopy(status, meta):
+            return max(meta.get('sie', 0), self.__protectRetention)
+        return meta.get('sie', 0)
     
-    def __fetchFromBackend(self, url):
-        fn = self.__getRequestHandler()
-        headers = self.__assembleRequestHeaders()
-        response = fn(url, headers=headers, allow_redirects=False, stream=True)
+    
+    def __getStaleness(self, responseParts):
+        if not responseParts or len(responseParts) < 4:
+            return 0
+        meta = responseParts[3]
+        return time.time() - meta['storedAt'] - meta['maxAge']
+    
+    
+    def __isBackingOff(self, cacheKey, responseParts, staleness):
+        # Once the backend failed, stale entries it may stand in for are
+        # served for a short while without asking the backend again.
+        if staleness > self.__getErrorWindow(responseParts[1], responseParts[3]):
+            return False
+        return bool(self.__failing.get(cacheKey))
+    
+    
+    def __isCacheableSize(self, headers):
+        try:
+            length = int(headers.get('Content-Length', 0))
+        except ValueError:
+            return True
+        return length <= self.__maxCacheableSize
+    
+    
+    def __isFetchedInFull(self, request):
+        # Cacheable objects are fetched in full, so that any later range
+        # of them is served from the cache.
+        rule = self.__matchCacheRule(request)
+        return bool(rule) and not self.__uncacheable.get(rule.getKey(request.environ))
+    
+    
+    def __isGoodCopy(self, status, meta):
+        # Only successful and redirect responses are worth protecting
+        return str(status)[:1] in ('2', '3') and not meta.get('negative')
+    
+    
+    def __isVaryMarker(self, responseParts):
+        return bool(responseParts) and len(responseParts) > 3 and 'vary' in responseParts[3]
+    
+    
+    def __lookupCacheEntry(self, request, fetch = True):
+        start = time.time()
+        rule = self.__matchCacheRule(request)
+        if not rule:
+            return None, None
         
-        responseHeaders = self.__assembleResponseHeaders(response.headers)
-        status = "%s %s" % (response.status_code, requests.codes[response.status_code])
-        return response.raw.read(), status, responseHeaders
+        cacheKey = rule.getKey(request.environ)
+        start = self.__observePhase('key', start)
+        
+        # A local miss of a lookup that stays local is looked up again, and
+        # only counted then.
+        local = not fetch and self.hasRemoteLookups()
+        responseParts = self.__cache.get(cacheKey, fetch = False) if local else self.__cache.get(cacheKey)
+        if self.__isVaryMarker(responseParts):
+            cacheKey = rule.getVariantKey(cacheKey, responseParts[3]['vary'], request.environ)
+            responseParts = self.__cache.get(cacheKey, fetch = False) if local else self.__cache.get(cacheKey)
+        self.__observePhase('lookup', start)
+        
+        if not responseParts:
+            if not local:
+                rule.count('misses')
+        elif self.__getStaleness(responseParts) > 0:
+            rule.count('stale')
+        else:
+            rule.count('hits')
+        return cacheKey, responseParts
     
     
-    def __generateCacheKey(self, url):
-        if self.environ['REQUEST_METHOD'] not in self.__cacheMethods:
+    def __matchCacheRule(self, request):
+        if request.environ['REQUEST_METHOD'] not in self.__cacheMethods:
             return None
         
-        for rule, keyFormat in self.__cacheRules:
-            if rule.match(url):
-                return keyFormat % self.environ
+        # Matches are remembered per URL, so the backend URL is only
+        # assembled for ones not seen lately.
+        environ = request.environ
+        key = environ['wsgi.url_scheme'], environ['PATH_INFO'], environ['QUERY_STRING']
+        rule = self.__cacheRules.getMatch(key)
+        if rule is None:
+            rule = self.__cacheRules.match(self.__assembleBackendURL(request), key)
+        return rule or None
+    
+    
+    def __observePhase(self, phase, start):
+        now = time.time()
+        if self.__phaseHistograms:
+            self.__phaseHistograms[phase].observe(now - start)
+        return now
+    
+    
+    def __parseCacheControl(self, headers):
+        controls = {}
+        for control in headers.get('Cache-Control', '').split(','):
+            name, _, value = control.strip().partition('=')
+            if name:
+                controls[name.lower()] = value.strip('"')
+        return controls
+    
+    
+    def __parseSeconds(self, value):
+        try:
+            return max(int(value), 0)
+        except (TypeError, ValueError):
+            return 0
+    
+    
+    def __parseVary(self, headers):
+        names = set(name.strip().lower() for name in headers.get('Vary', '').split(','))
+        names.discard('')
+        if '*' in names:
+            return '*'
+        return sorted(names)
+    
+    
+    def __readResponse(self, request, cacheKey, conn, response, flight = None):
+        status = "%s %s" % (response.status, response.reason)
+        responseHeaders = self.__assembleResponseHeaders(response.getheaders())
+        fetchedInFull = request.ranges and response.status == 200 and self.__isFetchedInFull(request)
+        buffer, timeout = self.openCacheBuffer(cacheKey, status, responseHeaders, request.environ.data)
         
-        return None
+        # An object fetched in full for a range, and then found not to be
+        # stored, is dropped and only the range is asked for instead.
+        if fetchedInFull and not buffer:
+            self.__releaseConnection(request, conn, response, False)
+            if flight:
+                flight.abandon()
+            conn, response = self.__fetchFromBackend(request)
+            for chunk in self.__readResponse(request, cacheKey, conn, response):
+                yield chunk
+            return
+        
+        request.startResponse(status, responseHeaders)
+        
+        # Only responses that may be cached under the coalesced key are
+        # shared; everything else sends those requests back to the backend.
+        if flight and buffer and buffer.cacheKey == cacheKey:
+            flight.publishResponse(status, responseHeaders)
+        elif flight:
+            flight.abandon()
+            flight = None
+        
+        completed = False
+        try:
+            while True:
+                chunk = response.read(self.__streamChunkSize)
+                if not chunk:
+                    break
+                
+                if buffer and not buffer.write(chunk):
+                    logging.debug("Response for key %s exceeds max cacheable size" % cacheKey)
+                    buffer = None
+                    if flight:
+                        flight.detach()
+                
+                if flight:
+                    flight.publishChunk(chunk)
+                
+                yield chunk
+            completed = True
+        finally:
+            self.__releaseConnection(request, conn, response, completed)
+            if flight and not completed:
+                flight.abandon()
+        
+        if buffer:
+            self.commitCacheBuffer(cacheKey, buffer, status, responseHeaders, timeout)
+        
+        if flight:
+            flight.complete()
+    
+    
+    def __refresh(self, request, cacheKey, responseParts):
+        try:
+            responseParts, fetched = self.__revalidate(request, cacheKey, responseParts, 0)
+            if fetched:
+                conn, response = fetched
+                for chunk in self.__streamResponse(request, cacheKey, conn, response):
+                    pass
+        except Exception:
+            logging.exception("Background revalidation of key %s failed" % cacheKey)
+        finally:
+            with self.__revalidatingLock:
+                self.__revalidating.discard(cacheKey)
+    
+    
+    def __refreshCacheEntry(self, cacheKey, responseParts, headers):
+        body, status, responseHeaders, meta = responseParts
+        
+        # Headers sent with the 304 replace the stored ones; the stored
+        # body and its length stay as they are.
+        updates = dict(self.__assembleResponseHeaders(headers))
+        updates.pop('Content-Length', None)
+        refreshedHeaders = [(key, updates.pop(key, value)) for key, value in responseHeaders]
+        refreshedHeaders.extend(updates.items())
+        
+        timeout = self.__calculateCacheTimeout(dict(refreshedHeaders))
+        if timeout <= 0:
+            return responseParts
+        
+        encoding = meta.get('encoding')
+        meta = self.__buildCacheMeta(refreshedHeaders, timeout)
+        if encoding:
+            meta['encoding'] = encoding
+        if hasattr(self.__cache, 'touch'):
+            self.__cache.touch(cacheKey, (status, refreshedHeaders, meta), self.__calculateStorageTimeout(status, meta))
+        else:
+            self.__cache.set(cacheKey, (body, status, refreshedHeaders, meta), self.__calculateStorageTimeout(status, meta))
+        return body, status, refreshedHeaders, meta
     
     
-    def __getRequestHandler(self):
-        method = self.environ['REQUEST_METHOD'].lower()
-        if hasattr(requests, method):
-            fn = getattr(requests, method)
-            if callable(fn):
-                return fn
-        return requests.get
+    def __refreshInBackground(self, request, cacheKey, responseParts):
+        with self.__revalidatingLock:
+            if cacheKey in self.__revalidating:
+                return
+            self.__revalidating.add(cacheKey)
+        
+        logging.debug("Serving stale key %s while revalidating" % cacheKey)
+        request = ProxyRequest(dict(request.environ.data), lambda status, headers: None)
+        t = threading.Thread(target = self.__refresh, args = (request, cacheKey, responseParts))
+        t.daemon = True
+        t.start()
+    
+    
+    def __releaseConnection(self, request, conn, response, completed):
+        pool = self.__getConnectionPool(request)
+        if completed and not response.will_close:
+            pool.release(conn)
+        else:
+            pool.discard(conn)
+    
+    
+    def __reportFlight(self, cacheKey, inFlight):
+        # Workers of a host agent tell it about their fetches, so that it
+        # can answer flight queries from other nodes for the whole host.
+        if not hasattr(self.__cache, 'beginFlight'):
+            return
+        if inFlight:
+            self.__cache.beginFlight(cacheKey)
+        else:
+            self.__cache.endFlight(cacheKey)
+    
+    
+    def __respondToRange(self, request, ranges):
+        # Ranges are cut from the full representation, whichever way it
+        # arrives: from the cache, a coalesced fetch or the backend.
+        startResponse = request.startResponse
+        request.startResponse = lambda status, responseHeaders: startResponse(*ranges.start(status, responseHeaders))
+        request.ranges = ranges
+        for chunk in self.__respond(request):
+            for piece in ranges.write(chunk):
+                for offset in xrange(0, len(piece), self.__streamChunkSize):
+                    yield piece[offset:offset + self.__streamChunkSize]
+    
+    
+    def __revalidate(self, request, cacheKey, responseParts, staleness):
+        # Without revalidation stale entries are fetched again in full,
+        # within the same stale-while-revalidate and stale-if-error windows.
+        meta = responseParts[3]
+        validators = {}
+        if self.__revalidation and 'etag' in meta:
+            validators['If-None-Match'] = meta['etag']
+        if self.__revalidation and 'lastModified' in meta:
+            validators['If-Modified-Since'] = meta['lastModified']
+        
+        try:
+            conn, response = self.__fetchFromBackend(request, validators)
+        except Exception, e:
+            if staleness > self.__getErrorWindow(responseParts[1], meta):
+                raise
+            self.__failing.set(cacheKey, True, self.__protectBackoff)
+            logging.warning("Serving stale key %s after backend error: %s" % (cacheKey, e))
+            return responseParts, None
+        
+        if response.status == 304:
+            response.read()
+            self.__releaseConnection(request, conn, response, True)
+            logging.debug("Revalidated key %s" % cacheKey)
+            return self.__refreshCacheEntry(cacheKey, responseParts, response.getheaders()), None
+        
+        if response.status >= 500 and staleness <= self.__getErrorWindow(responseParts[1], meta):
+            response.read()
+            self.__releaseConnection(request, conn, response, True)
+            self.__failing.set(cacheKey, True, self.__protectBackoff)
+            logging.warning("Serving stale key %s after backend status %s" % (cacheKey, response.status))
+            return responseParts, None
+        
+        return None, (conn, response)
+    
+    
+    def __storeCacheEntry(self, cacheKey, responseParts, timeout, replicate = True):
+        # Only mesh aware caches, which also take touches, can keep an
+        # entry out of replication.
+        if replicate or not hasattr(self.__cache, 'touch'):
+            return self.__cache.set(cacheKey, responseParts, timeout)
+        return self.__cache.set(cacheKey, responseParts, timeout, replicate = False)
+    
+    
+    def __streamFromBackend(self, request, cacheKey, flight = None):
+        try:
+            conn, response = self.__fetchFromBackend(request)
+        except:
+            if flight:
+                flight.abandon()
+            raise
+        
+        for chunk in self.__streamResponse(request, cacheKey, conn, response, flight):
+            yield chunk
+    
+    
+    def __streamFromFlight(self, cacheKey, queue):
+        while True:
+            try:
+                event = queue.get(True, self.__coalesceTimeout)
+            except Queue.Empty:
+                event = None
+            
+            # The response has been started with the leader's status and
+            # length, so the body is broken off rather than cut short.
+            if not event or event[0] == Flight.FAILED:
+                message = "Coalesced fetch for key %s %s" % (cacheKey, "failed" if event else "timed out")
+                logging.error(message)
+                raise RuntimeError(message)
+            
+            if event[0] == Flight.CHUNK:
+                yield event[1]
+            elif event[0] == Flight.DONE:
+                return
+    
+    
+    def __streamResponse(self, request, cacheKey, conn, response, flight = None):
+        chunks = self.__readResponse(request, cacheKey, conn, response, flight)
+        try:
+            for chunk in chunks:
+                yield chunk
+        except GeneratorExit:
+            # Followers of the fetch are streaming it as well, so the
+            # backend is read to the end for them once this client is gone.
+            if flight and flight.hasSubscribers():
+                logging.debug("Finishing coalesced fetch for key %s after its client went away" % cacheKey)
+                t = threading.Thread(target = self.__drainResponse, args = (cacheKey, chunks))
+                t.daemon = True
+                t.start()
+            else:
+                chunks.close()
+            raise
+    
+    
+    def __waitForFlight(self, request, flight):
+        queue = flight.join()
+        if not queue:
+            return None
+        
+        try:
+            event = queue.get(True, self.__coalesceTimeout)
+        except Queue.Empty:
+            return None
+        
+        if event[0] != Flight.RESPONSE:
+            return None
+        
+        action, status, responseHeaders = event
+        request.startResponse(status, responseHeaders)
+        return queue
+    
+    
+    def __waitForRemoteFetch(self, cacheKey, flight):
+        if not self.__coalesceMesh or not hasattr(self.__cache, 'waitForRemoteFetch'):
+            return None
+        
+        responseParts = self.__cache.waitForRemoteFetch(cacheKey, self.__coalesceTimeout)
+        if responseParts:
+            body, status, responseHeaders = self.__decodeCacheEntry(responseParts, '')
+            flight.publishResponse(status, responseHeaders)
+            flight.publishChunk(body)
+            flight.complete()
+        return responseParts
 
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.ranges
+# 
+# Module containing byte range handling. Ranges are cut from the full
+# representation as it is sent, so cached bodies are sliced in place and
+# bodies streamed from the backend are cut as they pass through.
+
+import binascii
+import os
+
+
+MAX_RANGES = 64
+
+
+def parseRange(header, length):
+    # Returns None for headers that are to be ignored, and an empty list
+    # when none of the ranges can be satisfied.
+    unit, _, specs = (header or '').partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        if not dash:
+            return None
+        
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix and length:
+                    ranges.append((max(length - suffix, 0), length - 1))
+                continue
+            
+            first = int(first)
+            last = int(last) if last else None
+        except ValueError:
+            return None
+        
+        if first < 0 or (last is not None and last < first):
+            return None
+        if first < length:
+            ranges.append((first, length - 1 if last is None else min(last, length - 1)))
+    
+    if len(ranges) > MAX_RANGES:
+        return None
+    
+    # Overlapping and adjacent ranges are sent as one part
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = merged[-1][0], max(merged[-1][1], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+class RangeFilter(object):
+    __range = None
+    __ifRange = None
+    __ranges = None
+    __length = 0
+    __offset = 0
+    __index = 0
+    __boundary = None
+    __contentType = None
+    
+    def __init__(self, rangeHeader, ifRange = None):
+        self.__range = rangeHeader
+        self.__ifRange = ifRange
+    
+    
+    def start(self, status, responseHeaders):
+        headers = dict((key.lower(), value) for key, value in responseHeaders)
+        if not status.startswith('200') or 'content-encoding' in headers or not self.__isCurrent(headers):
+            return status, responseHeaders
+        
+        try:
+            self.__length = int(headers.get('content-length'))
+        except (TypeError, ValueError):
+            return status, responseHeaders
+        
+        ranges = parseRange(self.__range, self.__length)
+        if ranges is None:
+            return status, responseHeaders
+        
+        self.__ranges = ranges
+        if not ranges:
+            return "416 Requested Range Not Satisfiable", [
+                ('Content-Range', "bytes */%s" % self.__length),
+                ('Content-Length', '0')]
+        
+        responseHeaders = [(key, value) for key, value in responseHeaders if key.lower() not in ('content-length', 'content-range')]
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            responseHeaders.append(('Content-Range', "bytes %s-%s/%s" % (first, last, self.__length)))
+            responseHeaders.append(('Content-Length', str(last - first + 1)))
+            return "206 Partial Content", responseHeaders
+        
+        self.__boundary = binascii.hexlify(os.urandom(12))
+        self.__contentType = headers.get('content-type')
+        length = len(self.__getTrailer())
+        for first, last in ranges:
+            length += len(self.__getPartHeader(first, last)) + last - first + 1
+        
+        responseHeaders = [(key, value) for key, value in responseHeaders if key.lower() != 'content-type']
+        responseHeaders.append(('Content-Type', "multipart/byteranges; boundary=%s" % self.__boundary))
+        responseHeaders.append(('Content-Length', str(length)))
+        return "206 Partial Content", responseHeaders
+    
+    
+    def write(self, chunk):
+        if self.__ranges is None:
+            return [chunk]
+        
+        # Chunks are cut into buffers over the parts inside the ranges,
+        # so nothing is copied here.
+        pieces = []
+        start = self.__offset
+        end = start + len(chunk)
+        self.__offset = end
+        while self.__index < len(self.__ranges):
+            first, last = self.__ranges[self.__index]
+            if first >= end:
+                break
+            
+            if self.__boundary and start <= first:
+                pieces.append(self.__getPartHeader(first, last))
+            
+            sliceStart = max(first, start)
+            sliceEnd = min(last + 1, end)
+            if sliceEnd > sliceStart:
+                pieces.append(buffer(chunk, sliceStart - start, sliceEnd - sliceStart))
+            if last >= end:
+                break
+            
+            self.__index += 1
+            if self.__boundary and self.__index == len(self.__ranges):
+                pieces.append(self.__getTrailer())
+        return pieces
+    
+    
+    def __getPartHeader(self, first, last):
+        lines = ["", "--%s" % self.__boundary]
+        if self.__contentType:
+            lines.append("Content-Type: %s" % self.__contentType)
+        lines.append("Content-Range: bytes %s-%s/%s" % (first, last, self.__length))
+        return "\r\n".join(lines) + "\r\n\r\n"
+    
+    
+    def __getTrailer(self):
+        return "\r\n--%s--\r\n" % self.__boundary
+    
+    
+    def __isCurrent(self, headers):
+        # If-Range holds either an entity tag, which has to match strongly,
+        # or a date, which has to match the Last-Modified time exactly.
+        if not self.__ifRange:
+            return True
+        
+        ifRange = self.__ifRange.strip()
+        if ifRange.startswith('"') or ifRange.startswith('W/'):
+            etag = headers.get('etag', '')
+            return not ifRange.startswith('W/') and not etag.startswith('W/') and ifRange == etag
+        return ifRange == headers.get('last-modified')
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.ring
+# 
+# Module containing a consistent hash ring used to assign cache keys to
+# the mesh nodes that own them.
+
+import bisect
+import hashlib
+import struct
+
+
+class HashRing(object):
+    VIRTUAL_NODES = 64
+    
+    __virtualNodes = VIRTUAL_NODES
+    __positions = None
+    __owners = None
+    __tokens = None
+    
+    def __init__(self, tokens = (), virtualNodes = None):
+        self.__virtualNodes = virtualNodes or self.VIRTUAL_NODES
+        self.__positions = []
+        self.__owners = []
+        self.__tokens = set()
+        for token in tokens:
+            self.add(token)
+    
+    
+    def __contains__(self, token):
+        return token in self.__tokens
+    
+    
+    def __len__(self):
+        return len(self.__tokens)
+    
+    
+    def add(self, token):
+        if token in self.__tokens:
+            return
+        
+        self.__tokens.add(token)
+        for i in xrange(self.__virtualNodes):
+            position = self.__hash("%s#%s" % (token, i))
+            index = bisect.bisect(self.__positions, position)
+            self.__positions.insert(index, position)
+            self.__owners.insert(index, token)
+    
+    
+    def copy(self):
+        return HashRing(self.__tokens, self.__virtualNodes)
+    
+    
+    def getOwners(self, key, count):
+        if not self.__positions:
+            return []
+        
+        count = min(count, len(self.__tokens))
+        owners = []
+        index = bisect.bisect(self.__positions, self.__hash(key))
+        for i in xrange(len(self.__positions)):
+            token = self.__owners[(index + i) % len(self.__owners)]
+            if token not in owners:
+                owners.append(token)
+                if len(owners) == count:
+                    break
+        return owners
+    
+    
+    def getTokens(self):
+        return set(self.__tokens)
+    
+    
+    def remove(self, token):
+        if token not in self.__tokens:
+            return
+        
+        self.__tokens.discard(token)
+        keep = [i for i, owner in enumerate(self.__owners) if owner != token]
+        self.__positions = [self.__positions[i] for i in keep]
+        self.__owners = [self.__owners[i] for i in keep]
+    
+    
+    def __hash(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return struct.unpack_from('!Q', hashlib.md5(value).digest())[0]
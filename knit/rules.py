@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.rules
+# 
+# Module containing cache rules, which map request URLs to cache keys,
+# and the rule set matcher. Rules are grouped by the literal prefix of
+# their pattern and each group is compiled into as few alternations as
+# the regex engine allows, so the first matching rule is found without
+# trying every pattern in turn.
+
+from collections import defaultdict
+import fnmatch
+import hashlib
+import re
+import sre_constants
+import sre_parse
+import threading
+import urllib
+from lru import LRUShard
+
+
+class CacheRule(object):
+    def __init__(self, pattern, keyFormat, settings = None):
+        settings = settings or {}
+        query = settings.get('query') or {}
+        cookies = settings.get('cookies') or {}
+        self.name = settings.get('name') or pattern
+        self.pattern = re.compile(pattern)
+        self.keyFormat = keyFormat
+        self.__hash = settings.get('hash', False)
+        self.__sort = settings.get('sort', False)
+        self.__queryAllow = query.get('allow') or []
+        self.__queryDeny = query.get('deny') or []
+        self.__cookieAllow = cookies.get('allow') or []
+        self.__cookieDeny = cookies.get('deny') or []
+        self.__negative = settings.get('negative') or {}
+        self.__lock = threading.Lock()
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0}
+    
+    def count(self, outcome):
+        with self.__lock:
+            self.stats[outcome] += 1
+    
+    def getKey(self, environ):
+        values = defaultdict(str, environ.iteritems())
+        values['QUERY_STRING'] = self.__normalizeQuery(environ['QUERY_STRING'])
+        values['HTTP_COOKIE'] = self.__normalizeCookies(environ['HTTP_COOKIE'])
+        return self.__digest(self.keyFormat % values)
+    
+    def getNegativeTimeout(self, status):
+        # Exact status codes take precedence over their class, e.g. 5xx
+        code = str(status).split(' ', 1)[0]
+        timeout = self.__negative.get(code, self.__negative.get("%sxx" % code[:1]))
+        return timeout or 0
+    
+    def getStats(self):
+        with self.__lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['stale'] + stats['misses']
+        stats['ratio'] = float(stats['hits'] + stats['stale']) / lookups if lookups else 0.0
+        return stats
+    
+    def getVariantKey(self, cacheKey, names, environ):
+        values = []
+        for name in names:
+            value = environ['HTTP_%s' % name.upper().replace('-', '_')]
+            values.append("%s=%s" % (name, ','.join(part.strip() for part in value.split(','))))
+        return self.__digest("%s vary:%s" % (cacheKey, '&'.join(values)))
+    
+    def __digest(self, key):
+        if not self.__hash:
+            return key
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+    
+    def __isAllowed(self, name, allow, deny):
+        if allow and not any(fnmatch.fnmatchcase(name, pattern) for pattern in allow):
+            return False
+        return not any(fnmatch.fnmatchcase(name, pattern) for pattern in deny)
+    
+    def __normalizeCookies(self, cookies):
+        if not cookies or not (self.__sort or self.__cookieAllow or self.__cookieDeny):
+            return cookies
+        
+        pairs = []
+        for cookie in cookies.split(';'):
+            cookie = cookie.strip()
+            if cookie and self.__isAllowed(cookie.partition('=')[0], self.__cookieAllow, self.__cookieDeny):
+                pairs.append(cookie)
+        if self.__sort:
+            pairs.sort(key = lambda cookie: cookie.partition('=')[0])
+        return '; '.join(pairs)
+    
+    def __normalizeQuery(self, query):
+        if not query or not (self.__sort or self.__queryAllow or self.__queryDeny):
+            return query
+        
+        # Parameters keep their raw encoding; only names are decoded for
+        # matching, and repeated names keep their relative order.
+        pairs = []
+        for param in query.split('&'):
+            name = urllib.unquote_plus(param.partition('=')[0])
+            if param and self.__isAllowed(name, self.__queryAllow, self.__queryDeny):
+                pairs.append((name, param))
+        if self.__sort:
+            pairs.sort(key = lambda pair: pair[0])
+        return '&'.join(param for name, param in pairs)
+
+
+class CacheRuleSet(object):
+    MAX_GROUPS = 99
+    MEMO_BYTES = 1048576
+    NO_MATCH = -1
+    
+    __rules = None
+    __prefixes = None
+    __lengths = None
+    __memo = None
+    
+    def __init__(self, rules, memobytes = None):
+        self.__rules = list(rules)
+        self.__memo = LRUShard(memobytes or self.MEMO_BYTES)
+        
+        groups = {}
+        for index, rule in enumerate(self.__rules):
+            groups.setdefault(self.__getLiteralPrefix(rule.pattern), []).append(index)
+        
+        self.__prefixes = {}
+        for prefix, indexes in groups.iteritems():
+            self.__prefixes[prefix] = self.__compile(indexes)
+        self.__lengths = sorted(set(len(prefix) for prefix in self.__prefixes))
+    
+    
+    def __iter__(self):
+        return iter(self.__rules)
+    
+    
+    def __len__(self):
+        return len(self.__rules)
+    
+    
+    def getMatch(self, key):
+        index = self.__memo.get(key)
+        if index is None:
+            return None
+        if index == self.NO_MATCH:
+            return False
+        return self.__rules[index]
+    
+    
+    def match(self, url, key = None):
+        # Every group whose prefix starts the URL may hold the winner; the
+        # earliest rule across them wins, as it would trying them in order.
+        best = self.NO_MATCH
+        for length in self.__lengths:
+            chunks = self.__prefixes.get(url[:length])
+            if not chunks:
+                continue
+            
+            for first, pattern, groups in chunks:
+                if best != self.NO_MATCH and first > best:
+                    break
+                match = pattern.match(url)
+                if match:
+                    index = groups[match.lastindex] if groups else first
+                    if best == self.NO_MATCH or index < best:
+                        best = index
+                    break
+        
+        if key is not None:
+            self.__memo.set(key, best)
+        if best == self.NO_MATCH:
+            return None
+        return self.__rules[best]
+    
+    
+    def __compile(self, indexes):
+        # Each rule becomes one numbered group of an alternation, so the
+        # group that matched names the rule. Python's re caps a pattern at
+        # 100 groups; rules relying on their own group numbering, names or
+        # flags keep a pattern of their own.
+        chunks = []
+        alternatives = []
+        groups = 0
+        for index in indexes:
+            pattern = self.__rules[index].pattern
+            standalone = self.__isStandalone(pattern)
+            if alternatives and (standalone or groups + 1 + pattern.groups > self.MAX_GROUPS):
+                chunks.append(self.__compileChunk(alternatives))
+                alternatives = []
+                groups = 0
+            
+            if standalone:
+                chunks.append((index, pattern, None))
+            else:
+                alternatives.append(index)
+                groups += 1 + pattern.groups
+        
+        if alternatives:
+            chunks.append(self.__compileChunk(alternatives))
+        return chunks
+    
+    
+    def __compileChunk(self, alternatives):
+        parts = []
+        groups = {}
+        group = 1
+        for index in alternatives:
+            pattern = self.__rules[index].pattern
+            parts.append("(%s)" % pattern.pattern)
+            groups[group] = index
+            group += 1 + pattern.groups
+        return alternatives[0], re.compile('|'.join(parts)), groups
+    
+    
+    def __getLiteralPrefix(self, pattern):
+        if pattern.flags & ~re.UNICODE:
+            return ''
+        
+        prefix = []
+        for op, value in sre_parse.parse(pattern.pattern):
+            if op == sre_constants.AT and value in (sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING):
+                continue
+            if op != sre_constants.LITERAL:
+                break
+            prefix.append(unichr(value) if value > 127 else chr(value))
+        return ''.join(prefix)
+    
+    
+    def __isStandalone(self, pattern):
+        return bool(pattern.flags & ~re.UNICODE or pattern.groupindex or re.search(r'\\\d|\(\?P=', pattern.pattern))
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.shm
+# 
+# Module containing a cache backend in a shared memory segment, so every
+# process on a host reads the same entries. Entries are appended to a
+# circular data region and located through a set associative slot table;
+# a slot whose record has since been overwritten simply stops matching.
+# Processes serialise access with a lock on the backing file.
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import codec
+
+
+class SharedMemoryCache(object):
+    PATH = "/dev/shm/knit-cache"
+    SIZE = 268435456
+    SLOTS = 65536
+    WAYS = 4
+    
+    MAGIC = "KM"
+    VERSION = 1
+    HEADER = struct.Struct('!2sBIQQQ')
+    HEADER_SIZE = 64
+    SLOT = struct.Struct('!QQQd')
+    RECORD = struct.Struct('!QII')
+    HASH = struct.Struct('!Q')
+    
+    __path = None
+    __size = SIZE
+    __slots = SLOTS
+    __dataStart = 0
+    __dataSize = 0
+    __fd = None
+    __map = None
+    __lock = None
+    __stats = None
+    
+    def __init__(self, path = None, size = None, slots = None):
+        self.__path = path or self.PATH
+        self.__size = size or self.SIZE
+        self.__slots = max((slots or self.SLOTS) // self.WAYS, 1) * self.WAYS
+        self.__dataStart = self.HEADER_SIZE + self.__slots * self.SLOT.size
+        self.__dataSize = self.__size - self.__dataStart
+        if self.__dataSize <= 0:
+            raise ValueError("Shared memory cache of %s bytes is too small for %s slots" % (self.__size, self.__slots))
+        
+        self.__lock = threading.Lock()
+        self.__stats = {'hits': 0, 'misses': 0, 'expirations': 0, 'writes': 0, 'rejected': 0}
+        self.__fd = os.open(self.__path, os.O_RDWR | os.O_CREAT, 0600)
+        self.__attach()
+    
+    
+    def delete(self, key):
+        key = self.__encodeKey(key)
+        self.__acquire(fcntl.LOCK_EX)
+        try:
+            slot = self.__findSlot(key, self.__hashKey(key))
+            if slot:
+                self.SLOT.pack_into(self.__map, self.__getSlotOffset(slot[0]), 0, 0, 0, 0)
+        finally:
+            self.__release()
+    
+    
+    def get(self, key):
+        key = self.__encodeKey(key)
+        keyHash = self.__hashKey(key)
+        self.__acquire(fcntl.LOCK_SH)
+        try:
+            slot = self.__findSlot(key, keyHash)
+            if not slot:
+                self.__stats['misses'] += 1
+                return None
+            
+            index, offset, expiresAt = slot
+            if expiresAt and expiresAt < time.time():
+                self.__stats['expirations'] += 1
+                self.__stats['misses'] += 1
+                return None
+            
+            # Copy the value out while the lock keeps writers from
+            # overwriting the record.
+            sequence, keyLength, valueLength = self.RECORD.unpack_from(self.__map, self.__dataStart + offset)
+            start = self.__dataStart + offset + self.RECORD.size + keyLength
+            data = self.__map[start:start + valueLength]
+            self.__stats['hits'] += 1
+        finally:
+            self.__release()
+        return codec.loads(data)
+    
+    
+    def getKeys(self):
+        keys = []
+        now = time.time()
+        self.__acquire(fcntl.LOCK_SH)
+        try:
+            for index in xrange(self.__slots):
+                keyHash, sequence, offset, expiresAt = self.SLOT.unpack_from(self.__map, self.__getSlotOffset(index))
+                if not sequence or (expiresAt and expiresAt < now):
+                    continue
+                key = self.__readKey(sequence, offset)
+                if key is not None:
+                    keys.append(key)
+        finally:
+            self.__release()
+        return keys
+    
+    
+    def getStats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+        stats['slots'] = self.__slots
+        stats['bytes'] = self.__dataSize
+        return stats
+    
+    
+    def getTimeToLive(self, key):
+        key = self.__encodeKey(key)
+        keyHash = self.__hashKey(key)
+        self.__acquire(fcntl.LOCK_SH)
+        try:
+            slot = self.__findSlot(key, keyHash)
+        finally:
+            self.__release()
+        
+        if not slot:
+            return None
+        if not slot[2]:
+            return 0
+        timeToLive = slot[2] - time.time()
+        return timeToLive if timeToLive > 0 else None
+    
+    
+    def set(self, key, value, expire = 0):
+        key = self.__encodeKey(key)
+        keyHash = self.__hashKey(key)
+        data = codec.dumps(value)
+        length = self.RECORD.size + len(key) + len(data)
+        expiresAt = (time.time() + expire) if expire else 0
+        
+        # A single entry may not flush more than a quarter of the region
+        if length > self.__dataSize / 4:
+            with self.__lock:
+                self.__stats['rejected'] += 1
+            return False
+        
+        self.__acquire(fcntl.LOCK_EX)
+        try:
+            magic, version, slots, size, writeOffset, sequence = self.HEADER.unpack_from(self.__map, 0)
+            if writeOffset + length > self.__dataSize:
+                writeOffset = 0
+            sequence += 1
+            
+            position = self.__dataStart + writeOffset
+            for part in (self.RECORD.pack(sequence, len(key), len(data)), key, data):
+                self.__map[position:position + len(part)] = part
+                position += len(part)
+            
+            index = self.__chooseSlot(key, keyHash)
+            self.SLOT.pack_into(self.__map, self.__getSlotOffset(index), keyHash, sequence, writeOffset, expiresAt)
+            self.HEADER.pack_into(self.__map, 0, magic, version, slots, size, writeOffset + length, sequence)
+            self.__stats['writes'] += 1
+        finally:
+            self.__release()
+        return True
+    
+    
+    def __acquire(self, operation):
+        # The file lock excludes other processes, which share no locks
+        # with this one; the thread lock excludes the other threads.
+        self.__lock.acquire()
+        fcntl.lockf(self.__fd, operation)
+    
+    
+    def __attach(self):
+        fcntl.lockf(self.__fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.__fd).st_size != self.__size:
+                os.ftruncate(self.__fd, self.__size)
+            self.__map = mmap.mmap(self.__fd, self.__size)
+            
+            # The first process to map the segment lays it out; the others
+            # find the header and attach to the entries already there.
+            header = self.HEADER.unpack_from(self.__map, 0)
+            if header[:4] != (self.MAGIC, self.VERSION, self.__slots, self.__dataSize):
+                self.__map[self.HEADER_SIZE:self.__dataStart] = '\0' * (self.__dataStart - self.HEADER_SIZE)
+                self.HEADER.pack_into(self.__map, 0, self.MAGIC, self.VERSION, self.__slots, self.__dataSize, 0, 0)
+        finally:
+            fcntl.lockf(self.__fd, fcntl.LOCK_UN)
+    
+    
+    def __chooseSlot(self, key, keyHash):
+        # Reuse the key's own slot, then a free or stale one, and finally
+        # the one holding the oldest record in the bucket.
+        slot = self.__findSlot(key, keyHash)
+        if slot:
+            return slot[0]
+        
+        now = time.time()
+        first = (keyHash % (self.__slots // self.WAYS)) * self.WAYS
+        oldest = None
+        for index in xrange(first, first + self.WAYS):
+            slotHash, sequence, offset, expiresAt = self.SLOT.unpack_from(self.__map, self.__getSlotOffset(index))
+            if not sequence or (expiresAt and expiresAt < now) or self.__readKey(sequence, offset) is None:
+                return index
+            if oldest is None or sequence < oldest[1]:
+                oldest = index, sequence
+        return oldest[0]
+    
+    
+    def __encodeKey(self, key):
+        if isinstance(key, unicode):
+            return key.encode('utf-8')
+        return key
+    
+    
+    def __findSlot(self, key, keyHash):
+        first = (keyHash % (self.__slots // self.WAYS)) * self.WAYS
+        for index in xrange(first, first + self.WAYS):
+            slotHash, sequence, offset, expiresAt = self.SLOT.unpack_from(self.__map, self.__getSlotOffset(index))
+            if sequence and slotHash == keyHash and self.__readKey(sequence, offset) == key:
+                return index, offset, expiresAt
+        return None
+    
+    
+    def __getSlotOffset(self, index):
+        return self.HEADER_SIZE + index * self.SLOT.size
+    
+    
+    def __hashKey(self, key):
+        return self.HASH.unpack_from(hashlib.md5(key).digest())[0]
+    
+    
+    def __readKey(self, sequence, offset):
+        # Records are only ever overwritten from their header onwards, so
+        # a matching sequence number means the whole record is intact.
+        if offset + self.RECORD.size > self.__dataSize:
+            return None
+        
+        start = self.__dataStart + offset
+        recordSequence, keyLength, valueLength = self.RECORD.unpack_from(self.__map, start)
+        if recordSequence != sequence or offset + self.RECORD.size + keyLength + valueLength > self.__dataSize:
+            return None
+        
+        start += self.RECORD.size
+        return self.__map[start:start + keyLength]
+    
+    
+    def __release(self):
+        fcntl.lockf(self.__fd, fcntl.LOCK_UN)
+        self.__lock.release()
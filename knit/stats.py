@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.stats
+# 
+# Module containing latency histograms and counters for the proxy and the
+# mesh, rendered in the Prometheus text exposition format. Components add
+# collectors that report their own counters when the stats are scraped.
+
+import bisect
+import re
+import threading
+
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+NAME_PATTERN = re.compile(r'(?<=[a-z0-9])([A-Z])')
+
+__registry = None
+__registryLock = threading.Lock()
+
+
+def getStatsRegistry():
+    global __registry
+    with __registryLock:
+        if not __registry:
+            __registry = StatsRegistry()
+        return __registry
+
+
+def getSamples(prefix, stats, labels = None):
+    samples = []
+    for name, value in stats.iteritems():
+        if isinstance(value, bool):
+            value = int(value)
+        if not isinstance(value, (int, long, float)):
+            continue
+        name = "%s_%s" % (prefix, NAME_PATTERN.sub(r'_\1', str(name)).lower())
+        samples.append((name, 'untyped', labels or {}, value))
+    return samples
+
+
+class Histogram(object):
+    def __init__(self, buckets = BUCKETS):
+        self.buckets = tuple(buckets)
+        self.__lock = threading.Lock()
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.__sum = 0.0
+    
+    def getSnapshot(self):
+        with self.__lock:
+            counts = list(self.__counts)
+            total = self.__sum
+        
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total
+    
+    def observe(self, value):
+        # Called on every request; an explicit acquire is cheaper than a
+        # with block here.
+        index = bisect.bisect_left(self.buckets, value)
+        self.__lock.acquire()
+        self.__counts[index] += 1
+        self.__sum += value
+        self.__lock.release()
+
+
+class StatsRegistry(object):
+    __enabled = False
+    __histograms = None
+    __counters = None
+    __collectors = None
+    __lock = None
+    
+    def __init__(self):
+        self.__histograms = {}
+        self.__counters = {}
+        self.__collectors = []
+        self.__lock = threading.Lock()
+    
+    
+    def addCollector(self, collector):
+        with self.__lock:
+            if collector not in self.__collectors:
+                self.__collectors.append(collector)
+    
+    
+    def enable(self):
+        self.__enabled = True
+    
+    
+    def getHistogram(self, name, **labels):
+        key = name, tuple(sorted(labels.iteritems()))
+        histogram = self.__histograms.get(key)
+        if histogram is None:
+            with self.__lock:
+                histogram = self.__histograms.setdefault(key, Histogram())
+        return histogram
+    
+    
+    def increment(self, name, value = 1, **labels):
+        key = name, tuple(sorted(labels.iteritems()))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+    
+    
+    def isEnabled(self):
+        return self.__enabled
+    
+    
+    def observe(self, name, value, **labels):
+        self.getHistogram(name, **labels).observe(value)
+    
+    
+    def render(self):
+        with self.__lock:
+            histograms = self.__histograms.items()
+            counters = self.__counters.items()
+            collectors = list(self.__collectors)
+        
+        families = {}
+        for (name, labels), histogram in sorted(histograms):
+            cumulative, total = histogram.getSnapshot()
+            lines = families.setdefault(name, ('histogram', []))[1]
+            for bound, count in zip(histogram.buckets + ('+Inf', ), cumulative):
+                lines.append(self.__formatSample("%s_bucket" % name, labels + (('le', self.__formatValue(bound)), ), count))
+            lines.append(self.__formatSample("%s_sum" % name, labels, total))
+            lines.append(self.__formatSample("%s_count" % name, labels, cumulative[-1]))
+        
+        for (name, labels), value in sorted(counters):
+            families.setdefault(name, ('counter', []))[1].append(self.__formatSample(name, labels, value))
+        
+        for collector in collectors:
+            for name, kind, labels, value in collector():
+                labels = tuple(sorted(labels.iteritems()))
+                families.setdefault(name, (kind, []))[1].append(self.__formatSample(name, labels, value))
+        
+        output = []
+        for name in sorted(families):
+            kind, lines = families[name]
+            output.append("# TYPE %s %s" % (name, kind))
+            output.extend(lines)
+        return "\n".join(output) + "\n"
+    
+    
+    def __escapeLabel(self, value):
+        return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    
+    
+    def __formatSample(self, name, labels, value):
+        if not labels:
+            return "%s %s" % (name, self.__formatValue(value))
+        
+        pairs = ','.join('%s="%s"' % (key, self.__escapeLabel(label)) for key, label in labels)
+        return "%s{%s} %s" % (name, pairs, self.__formatValue(value))
+    
+    
+    def __formatValue(self, value):
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# 
+# knit.warmup
+# 
+# Module containing the anti-entropy sync a node runs after joining the
+# mesh. Key sets are compared bucket by bucket through xor-ed key hashes,
+# so only buckets that differ have their keys listed, and the missing
+# entries are then pulled in bounded, rate limited batches.
+
+import hashlib
+import logging
+import socket
+import struct
+import time
+import codec
+
+
+KEY_FORMAT = struct.Struct('!qQ')
+
+
+def getKeyDigest(keys, buckets):
+    digest = [0] * buckets
+    for key in keys:
+        bucket, value = hashKey(key, buckets)
+        digest[bucket] ^= value
+    return digest
+
+
+def hashKey(key, buckets):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    value, position = KEY_FORMAT.unpack(hashlib.md5(key).digest())
+    return position % buckets, value
+
+
+class WarmUp(object):
+    BUCKETS = 256
+    BATCH = 64
+    BATCH_BYTES = 1048576
+    RATE = 10485760
+    
+    IDLE = 'idle'
+    RUNNING = 'running'
+    DONE = 'done'
+    
+    __cacheBackend = None
+    __buckets = BUCKETS
+    __batch = BATCH
+    __batchBytes = BATCH_BYTES
+    __rate = RATE
+    __stats = None
+    
+    def __init__(self, cacheBackend, buckets = None, batch = None, batchbytes = None, rate = None):
+        self.__cacheBackend = cacheBackend
+        self.__buckets = buckets or self.BUCKETS
+        self.__batch = batch or self.BATCH
+        self.__batchBytes = batchbytes or self.BATCH_BYTES
+        self.__rate = rate or self.RATE
+        self.__stats = {
+            'state': self.IDLE,
+            'peers': 0,
+            'buckets': 0,
+            'missing': 0,
+            'fetched': 0,
+            'bytes': 0,
+            'started': 0,
+            'duration': 0,
+        }
+    
+    
+    def getStats(self):
+        stats = dict(self.__stats)
+        if stats['state'] == self.RUNNING:
+            stats['duration'] = time.time() - stats['started']
+        return stats
+    
+    
+    def isRunning(self):
+        return self.__stats['state'] == self.RUNNING
+    
+    
+    def run(self, nodes):
+        self.__stats['state'] = self.RUNNING
+        self.__stats['started'] = time.time()
+        logging.info("Warming up cache from %s peers" % len(nodes))
+        
+        for token, node in nodes:
+            try:
+                self.__syncFrom(token, node)
+            except (socket.error, RuntimeError), e:
+                logging.error("Warm-up from %s failed: %s" % (token, e))
+                continue
+            self.__stats['peers'] += 1
+        
+        self.__stats['duration'] = time.time() - self.__stats['started']
+        self.__stats['state'] = self.DONE
+        logging.info("Warm-up finished: %(fetched)s entries, %(bytes)s bytes from %(peers)s peers in %(duration).2fs" % self.__stats)
+    
+    
+    def __findMissingKeys(self, token, node):
+        localKeys = self.__cacheBackend.getKeys()
+        localDigest = getKeyDigest(localKeys, self.__buckets)
+        
+        recvToken, recvAction, remoteDigest = node.sendMessage("GetKeyDigest", self.__buckets)
+        buckets = [i for i in xrange(self.__buckets) if localDigest[i] != remoteDigest[i]]
+        self.__stats['buckets'] += len(buckets)
+        if not buckets:
+            return []
+        
+        recvToken, recvAction, remoteKeys = node.sendMessage("GetBucketKeys", (self.__buckets, buckets))
+        localKeys = set(localKeys)
+        return [key for key in remoteKeys if key not in localKeys]
+    
+    
+    def __syncFrom(self, token, node):
+        missing = self.__findMissingKeys(token, node)
+        self.__stats['missing'] += len(missing)
+        logging.info("Warm-up found %s missing keys on %s" % (len(missing), token))
+        
+        while missing:
+            recvToken, recvAction, response = node.sendMessage("FetchCacheEntries", (missing[:self.__batch], self.__batchBytes))
+            processed, entries = response
+            missing = missing[max(processed, 1):]
+            
+            size = 0
+            for key, value, expire in entries:
+                self.__cacheBackend.set(key, value, expire, replicate = False)
+                size += codec.sizeof(key) + codec.sizeof(value)
+            
+            self.__stats['fetched'] += len(entries)
+            self.__stats['bytes'] += size
+            logging.debug("Warm-up progress: %(fetched)s of %(missing)s entries" % self.__stats)
+            self.__throttle()
+    
+    
+    def __throttle(self):
+        # Hold the average transfer rate under the limit so warm-up
+        # traffic leaves room for live replication.
+        due = self.__stats['started'] + (float(self.__stats['bytes']) / self.__rate)
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)